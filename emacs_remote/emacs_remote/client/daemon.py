@@ -6,6 +6,7 @@ import signal
 import socket
 import subprocess
 import sys
+from concurrent.futures import Future
 from pathlib import Path
 from queue import Empty as EmptyQueue
 from queue import Queue
@@ -13,15 +14,28 @@ from threading import Event, Lock, Thread
 from time import sleep
 
 from emacs_remote import utils
+from emacs_remote.client.prefetch import Prefetcher
+from emacs_remote.client.relay import RequestRelay
 from emacs_remote.client.utils import get_client_parser
-from emacs_remote.messages import (Request, Response, ServerTerminateRequest,
-                                   ShellRequest)
+from emacs_remote.messages import (BatchRequest, ListDirRequest, Priority,
+                                   Request, Response, ServerTerminateRequest,
+                                   ShellRequest, WatchRequest)
 from emacs_remote.messages.startup import SERVER_STARTUP_MSG
 from emacs_remote.utils.atomic import AtomicInt
+from emacs_remote.utils.dir_listing import LocalListingCache
+from emacs_remote.utils.file_cache import FileCache
+from emacs_remote.utils.mux import MultiplexedConnection
+from emacs_remote.utils.scheduler import RequestScheduler
+from emacs_remote.utils.spill import FrameLimits
+from emacs_remote.utils.ssh import SSHConnections
 from emacs_remote.utils.stcp import SecureTCP
 from emacs_remote.utils.stcp_socket import SecureTCPSocket
+from emacs_remote.utils.stdio import StdioTransport
 from emacs_remote.workspace import Workspace
 
+# Longest wait in seconds between attempts to reconnect to the server
+MAX_RECONNECT_DELAY = 30
+
 
 class ClientDaemon:
     def __init__(
@@ -29,41 +43,113 @@ class ClientDaemon:
         emacs_remote_path: str,
         host: str,
         workspace: str,
-        num_clients: int = 1,
+        num_clients: int = 2,
         logging_level: str = "info",
+        max_frame_size: int = FrameLimits.max_frame_size,
+        spill_threshold: int = FrameLimits.spill_threshold,
+        transport: str = "tcp",
+        ssh_standby: bool = False,
     ):
         self.workspace = Workspace(host, emacs_remote_path, workspace, logging_level)
+        self.num_clients = num_clients
+        self.transport = transport
+        self.limits = FrameLimits(
+            max_frame_size, spill_threshold, self.workspace.workspace_path
+        )
+
+        self.file_cache = FileCache(
+            self.workspace.workspace_path.joinpath("file_cache"),
+            self.workspace.local_path,
+        )
+
+        self.dir_listings = LocalListingCache(self.fetch_listings)
+
+        self.logger = self.workspace.logger("client.daemon")
+        # Shared by the workspaces of a host, so their masters are reused
+        self.ssh = SSHConnections(
+            host,
+            self.workspace.emacs_remote_path.joinpath("ssh"),
+            standby=ssh_standby,
+            logger=self.logger,
+        )
+        self.prefetcher = Prefetcher(
+            self,
+            self.workspace.workspace_path.joinpath("history"),
+            logger=self.logger,
+        )
 
         self.session = None
         self.server = None
+        self.scheduler = None
+        self.watcher = None
+        self.relay = RequestRelay(self, self.logger, self.limits)
 
         self.finished = Event()
+        # Set once the server can be reached through the relay
+        self.connected = Event()
         self.daemon_lock = Lock()
 
-        self.logger = self.workspace.logger("client.daemon")
-
     def stcp_session(self):
+        """
+        Runs the server with ssh port forwarding and talks to it over the ports
+
+        Each forwarded port gets a connection of its own, so bulk transfers can be
+        kept off the connection used by interactive requests. Starting the server
+        is retried until it succeeds or the daemon is stopped.
+        """
+        self.logger.info(f"Establishing ssh connection with {self.workspace.host}...")
+        self.ssh.start()
+        if not self.connect(self.connect_stcp):
+            self.shutdown()
+            return
+
+        self.relay.start()
+        self.prefetcher.start()
+        self.connected.set()
+
+        self.logger.info("Client Daemon Initialized!")
+
+        self.finished.wait()
+        self.shutdown()
+
+    def connect(self, connect) -> bool:
+        """
+        Calls connect until it succeeds, backing off between attempts
+
+        Returns:
+            Whether it succeeded before the daemon was stopped
+        """
+        delay = 1
         while True:
-            self.logger.info(f"Establishing ssh connection with {self.host}...")
+            try:
+                connect()
+                return True
+            except Exception as e:
+                self.logger.info(f"Failed to connect, retrying in {delay}s: {e}")
 
-        def get_cmd(session):
-            cmd = []
-            # Add args
-            cmd.append(f'WORKSPACE="{self.workspace}"')
-            cmd.append(f'PORTS="{" ".join(session.server_ports)}"')
-            cmd.append(f'LEVEL="{self.workspace, logging_level}"')
+            if self.finished.wait(delay):
+                return False
 
-            script_path = Path(sys.prefix, "emacs_remote_scripts", "server.sh")
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            self.ssh.failover()
 
-            cmd.append("bash -s")
-            cmd.append("<")
-            cmd.append(str(script_path.resolve()))
+    def connect_stcp(self):
+        """
+        Starts the server through the active ssh master with a port forwarded per
+        connection, and connects to it over the ports
+        """
 
-            return cmd
+        def get_cmd(session):
+            return [
+                SecureTCP.server_script_command(
+                    self.workspace.workspace,
+                    session.server_ports,
+                    self.workspace.logging_level,
+                )
+            ]
 
         def check_started(session):
-            port = session.next_client_port()
-            for line in process.stdout:
+            for line in session.process.stdout:
                 line = line.decode("utf-8").strip()
                 self.logger.debug(line)
 
@@ -72,45 +158,203 @@ class ClientDaemon:
 
             return False
 
-        self.server = SecureTCP(self.workspace, self.num_clients)
-        self.server.start(get_cmd, check_started)
-
-        self.logger.info("Client Daemon Initialized!")
+        server = SecureTCP(
+            self.workspace, self.num_clients, logger=self.logger, connections=self.ssh
+        )
+        server.start(get_cmd, check_started)
+
+        try:
+            connections = [
+                MultiplexedConnection.connect(
+                    "localhost", int(port), logger=self.logger, limits=self.limits
+                )
+                for port in server.client_ports
+            ]
+        except:
+            server.stop()
+            raise
 
-        self.finished.wait()
+        self.server = server
+        self.scheduler = RequestScheduler(connections, logger=self.logger)
+        self.watch(self.scheduler)
 
+    def shutdown(self):
+        """
+        Stops the server and everything talking to it
+        """
         self.logger.info("Shutting down Client Daemon")
+        self.connected.clear()
+        self.prefetcher.stop()
+        self.relay.stop()
 
-        self.requests.put(ServerTerminateRequest())
+        if self.server is not None:
+            try:
+                self.scheduler.request(ServerTerminateRequest(), timeout=10)
+            except Exception as e:
+                self.logger.debug(f"    Failed to terminate the server: {e}")
 
-        self.logger.debug("    Waiting for request queue to be flushed")
-        while not self.requests.empty():
-            self.logger.debug("    Request queue is not empty")
-            sleep(1)
-
-        self.logger.debug("    Terminating Client Handlers")
-        while not self.terminate_queue.empty():
-            terminate_event = self.terminate_queue.get()
-            terminate_event.set()
-
-        while self.active_requests:
-            self.logger.debug("    Number of active requests is > 0")
-            sleep(1)
+        if self.scheduler is not None:
+            self.scheduler.close()
 
         self.logger.debug("    Stopping server")
-        if server:
-            server.stop()
+        if self.server is not None:
+            self.server.stop()
 
         self.logger.info("Successfully shutdown Client Daemon")
 
+    def stdio_session(self):
+        """
+        Runs the server with a single ssh exec and talks to it over the ssh pipe
+
+        Nothing is forwarded, so no ports have to be free on either host. All
+        requests share the one connection, with bulk transfers kept from holding up
+        interactive requests by the scheduler and the per stream credit.
+
+        The server runs through an ssh master that outlives the daemon. If the
+        connection drops, the server is started again through the standby master.
+        """
+        self.logger.info(f"Establishing ssh connection with {self.workspace.host}...")
+        self.ssh.start()
+        if not self.connect(self.connect_stdio):
+            self.shutdown()
+            return
+
+        self.relay.start()
+        self.prefetcher.start()
+        self.connected.set()
+
+        self.logger.info("Client Daemon Initialized!")
+
+        while not self.finished.wait(1):
+            if self.server is not None and not self.scheduler.closed:
+                continue
+
+            self.logger.info("Lost connection to the server, reconnecting...")
+            self.ssh.failover()
+            if not self.connect(self.connect_stdio):
+                break
+
+        self.shutdown()
+
+    def connect_stdio(self):
+        """
+        Starts the server through the active ssh master and connects to it over
+        the ssh pipe, replacing any previous connection
+        """
+        if self.server is not None:
+            self.scheduler.close()
+            self.server.stop(timeout=1)
+            self.server = None
+
+        transport = StdioTransport.ssh(
+            self.workspace.host,
+            StdioTransport.server_script_command(
+                self.workspace.workspace, self.workspace.logging_level
+            ),
+            connections=self.ssh,
+            logger=self.logger,
+            limits=self.limits,
+        )
+        connection = transport.start()
+        self.server = transport
+        self.scheduler = RequestScheduler([connection], logger=self.logger)
+        self.watch(self.scheduler)
+
+    def watch(self, scheduler: RequestScheduler):
+        """
+        Invalidates the local copies of files as they change on the server
+
+        The server pushes batches of changed files over the connection, so nothing
+        is polled. Runs in the background until the connection is closed.
+        """
+
+        def run():
+            try:
+                for notification in scheduler.stream(WatchRequest()):
+                    if notification.changed or notification.deleted:
+                        self.logger.debug(
+                            f"{len(notification.changed)} files changed and "
+                            f"{len(notification.deleted)} deleted on the server"
+                        )
+                    notification.run(self)
+            except ConnectionError as e:
+                self.logger.debug(f"Stopped watching for changes: {e}")
+
+        self.watcher = Thread(target=run)
+        self.watcher.daemon = True
+        self.watcher.start()
+
+    def send_request(self, request, priority: Priority = None):
+        return self.scheduler.request(request, timeout=300, priority=priority)
+
+    def server_capabilities(self, priority: Priority = None):
+        """
+        Returns the `Capabilities` negotiated with the server
+        """
+        return self.scheduler.peer
+
+    def stream_request(self, request, priority: Priority = None):
+        return self.scheduler.stream(request, priority)
+
+    def cancel(self, future) -> bool:
+        return self.scheduler.cancel(future)
+
+    def fetch_listings(self, paths):
+        """
+        Lists directories on the server in a single round trip
+
+        Args:
+            paths: (path, validator) tuples. See `LocalListingCache`
+        Returns:
+            A future that resolves to the results expected by `LocalListingCache`
+        """
+        requests = [
+            ListDirRequest(path, absolute=True, prefetch=False, validator=validator)
+            for path, validator in paths
+        ]
+        if len(requests) == 1:
+            batch = None
+            inner = self.scheduler.submit(requests[0])
+        else:
+            batch = BatchRequest.of(requests)
+            inner = self.scheduler.submit(batch)
+
+        def listing(response, error):
+            if error is None:
+                error = response.error
+            if error is not None:
+                return OSError(error)
+            if response.not_modified:
+                return None
+            return response.listing
+
+        future = Future()
+
+        def done(inner):
+            try:
+                if batch is None:
+                    results = [listing(inner.result(), None)]
+                else:
+                    results = [listing(*result) for result in inner.result().results()]
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(results)
+
+        inner.add_done_callback(done)
+        return future
+
     def start(self):
-        self.session = Thread(target=self.stcp_session)
+        if self.transport == "stdio":
+            self.session = Thread(target=self.stdio_session)
+        else:
+            self.session = Thread(target=self.stcp_session)
         self.session.daemon = True
         self.session.start()
 
     def stop(self):
         with self.daemon_lock:
-            self.finish.set()
+            self.finished.set()
 
         if self.session:
             self.session.join()
@@ -123,44 +367,73 @@ class ClientDaemon:
         self.stop()
 
     def listen(self):
+        """
+        Runs the requests of client interfaces until the daemon is stopped
+
+        The port is written to daemon.port in the workspace directory, where the
+        interfaces look for it. Interfaces keep their connection open, so each one
+        is served on a thread of its own.
+        """
+        daemon_port = self.workspace.workspace_path.joinpath("daemon.port")
+
         with SecureTCPSocket(logger=self.logger) as s:
             s.bind("localhost", 0)
             port = s.getsockname()[1]
             self.logger.debug(f"Daemon bound socket to localhost:{port}")
 
-            daemon_port = self.workspace_path.joinpath("daemon.port")
-            daemon_port.write_text(str(port))
-
             s.listen()
+            daemon_port.write_text(str(port))
             self.logger.debug(f"Listening on port {port}")
 
+            def close():
+                self.finished.wait()
+                s.close()
+
+            # Wakes up accept once the daemon is stopped
+            closer = Thread(target=close)
+            closer.daemon = True
+            closer.start()
+
+            try:
+                while not self.finished.is_set():
+                    try:
+                        conn, addr = s.accept()
+                    except OSError:
+                        break
+
+                    thread = Thread(target=self.serve, args=(conn,))
+                    thread.daemon = True
+                    thread.start()
+            finally:
+                daemon_port.unlink(missing_ok=True)
+
+        self.logger.debug("Finish Client Daemon")
+
+    def serve(self, conn: SecureTCPSocket):
+        """
+        Runs the requests sent by a client interface until it disconnects
+        """
+        with conn:
             while not self.finished.is_set():
                 try:
-                    conn, addr = s.accept()
-                    self.logger.debug(f"Connection accepted from {addr}")
-
-                    with conn:
-                        request = conn.recvall(timeout=5)
-                        if not request:
-                            continue
-
-                        if not isinstance(request, Request):
-                            self.logger.debug(
-                                f"Expected type Request. Got: {type(request)}"
-                            )
+                    request = conn.recvall()
+                    if not request:
+                        break
 
-                        response = request.run(self)
+                    if not isinstance(request, Request):
+                        raise TypeError(f"Expected type Request. Got: {type(request)}")
 
-                        if not isinstance(response, Response):
-                            self.logger.debug(
-                                f"Expected type Response. Got: {type(response)}"
-                            )
+                    response = request.run(self)
 
-                        conn.sendall(response)
-                finally:
-                    daemon_port.unlink()
+                    if not isinstance(response, Response):
+                        raise TypeError(
+                            f"Expected type Response. Got: {type(response)}"
+                        )
 
-            self.logger.debug("Finish Client Daemon")
+                    conn.sendall(response)
+                except Exception as e:
+                    self.logger.error(f"Failed to serve client interface: {e}")
+                    break
 
     @staticmethod
     def start_new_session(emacs_remote_path, host, workspace, logging_level):
@@ -190,6 +463,10 @@ def main(args):
         host=args.host,
         workspace=args.workspace,
         logging_level=args.level,
+        max_frame_size=args.max_frame_size,
+        spill_threshold=args.spill_threshold,
+        transport=args.transport,
+        ssh_standby=args.ssh_standby,
     ) as daemon:
         daemon.listen()
 
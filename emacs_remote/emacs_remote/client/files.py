@@ -0,0 +1,61 @@
+from emacs_remote.messages import (FileDeltaResponse, GetFileDeltaRequest,
+                                   GetFileRequest)
+
+# Local copies smaller than this are fetched in full instead of as a delta
+DELTA_MIN_SIZE = 64 * 1024
+
+
+def get_file(client, file_path: str, absolute: bool = False, priority=None):
+    """
+    Fetches a file from the server into the local mirror
+
+    Nothing is transferred if the cached local copy is up to date. If there is a
+    large enough local copy and the server computes deltas, only the changes are
+    transferred. Otherwise the file is fetched in chunks.
+
+    Args:
+        client: the client interface or daemon to fetch with. Must have workspace,
+            file_cache, server_capabilities, send_request and stream_request
+        file_path: path of the file relative to the workspace, or an absolute path
+        absolute: whether file_path is absolute
+        priority: the Priority to send the requests with. Defaults to the
+            priority of their types
+    Returns:
+        The final GetFileResponse or FileDeltaResponse. Its file_path is None if the
+        file was not found
+    """
+    validator = client.file_cache.validator(file_path, absolute)
+    local_path = client.workspace.local_path(file_path, absolute)
+    server = client.server_capabilities(priority)
+
+    if (
+        server.supports(GetFileDeltaRequest)
+        and local_path.is_file()
+        and local_path.stat().st_size >= DELTA_MIN_SIZE
+    ):
+        request = GetFileDeltaRequest.from_local(client, file_path, absolute, validator)
+        response = client.send_request(request, priority)
+        if not isinstance(response, FileDeltaResponse):
+            raise TypeError(
+                f"Expected response FileDeltaResponse. Got: {type(response)}"
+            )
+
+        response.run(client)
+    else:
+        # Servers that can't stream send the whole file in a single response
+        request = GetFileRequest(
+            file_path,
+            absolute,
+            chunked=server.has("streams"),
+            chunk_size=server.chunk_size,
+            validator=validator,
+        )
+        stream = client.stream_request(request, priority)
+        response = request.receive(client, stream)
+
+    if response.file_path is not None:
+        client.file_cache.update(
+            file_path, absolute, response.mtime_ns, response.size, response.digest
+        )
+
+    return response
@@ -1,26 +1,57 @@
 import argparse
 import os
 import shlex
+import sys
 from pathlib import Path
 from time import sleep
 
+import msgpack
+
 from emacs_remote import utils
 from emacs_remote.client.daemon import ClientDaemon
+from emacs_remote.client.files import get_file
 from emacs_remote.client.utils import add_client_subparsers
-from emacs_remote.messages import (GetFileRequest, PortRequest, Request,
-                                   Response, ServerTerminateRequest,
-                                   ShellRequest)
+from emacs_remote.messages import (BatchRequest, FileSignatureRequest,
+                                   FuzzyFindRequest, GetFileRangeRequest,
+                                   ListDirRequest, PortRequest, PortResponse,
+                                   PrefetchRequest, Priority,
+                                   ProjectIndexRequest, Request, Response,
+                                   SearchDone, SearchRequest, SendFileRequest,
+                                   ServerTerminateRequest, ShellExitStatus,
+                                   ShellRequest, StatRequest,
+                                   SymbolLookupRequest)
+from emacs_remote.utils.compression import CompressionPolicy
+from emacs_remote.utils.file_cache import FileCache, content_digest
+from emacs_remote.utils.files import AtomicFileWriter, map_file
 from emacs_remote.utils.logging import LoggerFactory
+from emacs_remote.utils.mux import MultiplexedConnection
+from emacs_remote.utils.spill import FrameLimits
 from emacs_remote.utils.stcp_socket import SecureTCPSocket
+from emacs_remote.workspace import Workspace
 
 
 class ClientInterface:
     def __init__(
-        self, emacs_remote_path: str, host: str, workspace: str, logging_level: str
+        self,
+        emacs_remote_path: str,
+        host: str,
+        workspace: str,
+        logging_level: str,
+        compression: str = "default",
+        max_frame_size: int = FrameLimits.max_frame_size,
+        spill_threshold: int = FrameLimits.spill_threshold,
     ):
         self.workspace = Workspace(host, emacs_remote_path, workspace)
+        self.compression = CompressionPolicy.get(compression)
+        self.limits = FrameLimits(
+            max_frame_size, spill_threshold, self.workspace.workspace_path
+        )
+        self.file_cache = FileCache(
+            self.workspace.workspace_path.joinpath("file_cache"),
+            self.workspace.local_path,
+        )
 
-        port_file = self.workspace_path.joinpath("daemon.port")
+        port_file = self.workspace.workspace_path.joinpath("daemon.port")
         if not port_file.exists():
             ClientDaemon.start_new_session(
                 emacs_remote_path, host, workspace, logging_level
@@ -38,6 +69,8 @@ class ClientInterface:
 
         self.port = int(port_file.read_text().strip())
         self.socket = SecureTCPSocket()
+        # priority -> persistent connection to the server
+        self.connections = {}
 
         self.logger = self.workspace.logger("client.daemon")
 
@@ -47,20 +80,308 @@ class ClientInterface:
         return self
 
     def __exit__(self, *args):
+        for connection in self.connections.values():
+            connection.close()
+
         self.socket.__exit__(*args)
 
-    def send_request(self, request):
-        self.socket.sendall(PortRequest())
-        response = self.socket.recvall()
+    def get_connection(self, priority: Priority = Priority.interactive):
+        """
+        Returns the persistent connection to the server for requests of a priority,
+        opening it if needed
+
+        The client daemon picks the forwarded port, so bulk requests are kept off
+        the connection it uses for interactive ones.
+        """
+        connection = self.connections.get(priority)
+        if connection is None or connection.closed:
+            self.socket.sendall(PortRequest(bulk=priority == Priority.bulk))
+            response = self.socket.recvall()
+
+            if not isinstance(response, PortResponse):
+                raise TypeError(
+                    f"Expected response PortResponse. Got: {type(response)}"
+                )
+
+            connection = MultiplexedConnection.connect(
+                "localhost",
+                int(response.port),
+                logger=self.logger,
+                compression=self.compression,
+                limits=self.limits,
+            )
+            self.connections[priority] = connection
+
+        return connection
+
+    def send_daemon_request(self, request):
+        """
+        Sends a request to be run by the client daemon rather than the server
+        """
+        with SecureTCPSocket() as s:
+            s.connect("localhost", self.port)
+            s.sendall(request)
+            return s.recvall()
+
+    def submit_request(self, request, priority: Priority = None):
+        """
+        Sends a request to the server without waiting for the response
+
+        Args:
+            request: the request to send
+            priority: overrides the priority of the request's type
+        Returns:
+            A future that resolves to the response
+        """
+        if priority is None:
+            priority = request.priority
+        return self.get_connection(priority).submit(request)
+
+    def server_capabilities(self, priority: Priority = None):
+        """
+        Returns the `Capabilities` negotiated with the server
+        """
+        if priority is None:
+            priority = Priority.interactive
+        return self.get_connection(priority).peer
+
+    def send_request(self, request, priority: Priority = None):
+        future = self.submit_request(request, priority)
+        try:
+            # wait up to 5 mins for response
+            return future.result(timeout=300)
+        except KeyboardInterrupt:
+            self.cancel(future)
+            raise
+
+    def stream_request(self, request, priority: Priority = None):
+        """
+        Sends a request whose response is streamed back in multiple messages
+
+        Returns:
+            An iterator over the messages of the response
+        """
+        if priority is None:
+            priority = request.priority
+        return self.get_connection(priority).stream(request)
+
+    def cancel(self, future) -> bool:
+        """
+        Cancels a request, see `MultiplexedConnection.cancel`
+
+        Args:
+            future: the future or stream returned when the request was sent
+        """
+        return any(
+            connection.cancel(future) for connection in self.connections.values()
+        )
+
+    def consume(self, stream):
+        """
+        Iterates over a streamed response, cancelling the request on C-g
+
+        Emacs interrupts the client with SIGINT, which would otherwise leave the
+        server running the request and sending its output.
+        """
+        try:
+            yield from stream
+        except KeyboardInterrupt:
+            stream.cancel()
+            raise
+
+    def send_batch(self, requests, ordered: bool = False):
+        """
+        Sends many small requests in a single round trip
+
+        Args:
+            requests: the requests to send. They can't stream their response
+            ordered: whether the server must run the requests in order
+        Returns:
+            A (response, error) tuple for each request, in order
+        """
+        response = self.send_request(BatchRequest.of(requests, ordered))
+        return response.results()
+
+    def stat(self, file_paths, absolute: bool = False):
+        """
+        Gets the attributes of files on the server in a single round trip
+
+        Returns:
+            A StatResponse for each file, in order
+        """
+        results = self.send_batch(
+            [StatRequest(file_path, absolute) for file_path in file_paths]
+        )
+        for response, error in results:
+            if error is not None:
+                raise RuntimeError(error)
+
+        return [response for response, _ in results]
+
+    def list_dir(self, file_path: str, absolute: bool = False, prefetch: bool = True):
+        """
+        Lists a directory on the server
+
+        The listing comes from the client daemon's cache when it can, and the
+        subdirectories are prefetched for the next completion.
+
+        Returns:
+            The ListDirResponse
+        """
+        return self.send_daemon_request(ListDirRequest(file_path, absolute, prefetch))
+
+    def get_file(self, file_path: str, absolute: bool = False):
+        """
+        Fetches a file from the server into the local mirror, see `get_file`
+
+        The client daemon is then told the file was opened so that it can prefetch
+        the files likely to be opened next.
 
-        if not isinstance(response, PortResponse):
-            self.logger.debug(f"Expected response PortResponse. Got: {type(response)}")
-        else:
-            port = response.port
-            with SecureTCPSocket() as s:
-                s.connect("localhost", port)
-                s.sendall(request)
-                return s.recvall(timeout=300)  # wait up to 5 mins for response
+        Returns:
+            The final GetFileResponse or FileDeltaResponse. Its file_path is None if
+            the file was not found
+        """
+        response = get_file(self, file_path, absolute)
+        if response.file_path is not None and not absolute:
+            try:
+                self.send_daemon_request(PrefetchRequest(file_path))
+            except OSError as e:
+                self.logger.debug(f"Failed to notify daemon of {file_path}: {e}")
+
+        return response
+
+    def save_file(self, file_path: str, absolute: bool = False):
+        """
+        Sends the local copy of a file to the server
+
+        If the server has a copy of the file only the changes are transferred.
+
+        Returns:
+            The SendFileResponse
+        """
+        response = self.send_request(FileSignatureRequest(file_path, absolute))
+        signature = response.signature if response.file_path is not None else None
+        request = SendFileRequest.from_local(self, file_path, absolute, signature)
+        response = self.send_request(request)
+
+        if response.success:
+            with map_file(self.workspace.local_path(file_path, absolute)) as m:
+                digest = content_digest(m)
+
+            self.file_cache.update(
+                file_path, absolute, response.mtime_ns, request.size, digest
+            )
+
+        return response
+
+    def get_project_index(self):
+        """
+        Gets the list of files in the project that aren't ignored by .gitignore
+
+        The last index received is kept in workspace_path, so usually only the
+        changes since then are transferred.
+
+        Returns:
+            The sorted paths relative to the workspace, encoded as bytes
+        """
+        index_path = self.workspace.workspace_path.joinpath("project.index")
+        try:
+            index_id, generation, data = msgpack.unpackb(
+                index_path.read_bytes(), raw=False
+            )
+            paths = data.split(b"\0") if data else []
+        except (FileNotFoundError, ValueError, TypeError):
+            index_id, generation, paths = None, 0, []
+
+        response = self.send_request(ProjectIndexRequest(index_id, generation))
+        if response.is_snapshot:
+            paths = response.paths()
+        elif response.added or response.removed:
+            paths = set(paths)
+            paths.difference_update(response.removed)
+            paths.update(response.added)
+            paths = sorted(paths)
+        elif response.generation == generation:
+            return paths
+
+        data = msgpack.packb(
+            [response.index_id, response.generation, b"\0".join(paths)],
+            use_bin_type=True,
+        )
+        with AtomicFileWriter(index_path) as writer:
+            writer.write(data)
+            writer.commit()
+
+        return paths
+
+    def fuzzy_find(self, query: str, k: int = 20):
+        """
+        Finds the k files in the project that best match a query
+
+        Returns:
+            The FuzzyFindResponse
+        """
+        return self.send_request(FuzzyFindRequest(query, k))
+
+    def search(
+        self,
+        pattern: str,
+        regex: bool = False,
+        ignore_case: bool = False,
+        include=None,
+        exclude=None,
+        max_results: int = 1000,
+    ):
+        """
+        Searches the contents of the files in the project
+
+        Returns:
+            An iterator over the SearchMatches batches of the search, followed by a
+            SearchDone
+        """
+        request = SearchRequest(
+            pattern, regex, ignore_case, include, exclude, max_results
+        )
+        return self.stream_request(request)
+
+    def lookup_symbol(
+        self,
+        name: str = "",
+        prefix: bool = False,
+        file_path: str = None,
+        max_results: int = 100,
+    ):
+        """
+        Looks up definitions in the server's symbol index
+
+        Returns:
+            The SymbolLookupResponse
+        """
+        return self.send_request(
+            SymbolLookupRequest(name, prefix, file_path, max_results)
+        )
+
+    def get_file_range(
+        self,
+        file_path: str,
+        start: int = 0,
+        end: int = None,
+        lines: bool = False,
+        absolute: bool = False,
+        follow: bool = False,
+    ):
+        """
+        Reads a byte or line range of a file on the server
+
+        Returns:
+            The GetFileRangeResponse, or if following, an iterator over the range
+            followed by FileChunks of the data appended to the file
+        """
+        request = GetFileRangeRequest(file_path, absolute, start, end, lines, follow)
+        if follow:
+            return self.stream_request(request)
+
+        return self.send_request(request)
 
     def execute(self, args):
         if args.command == "exit":
@@ -68,13 +389,91 @@ class ClientInterface:
             response = self.socket.recvall()
             self.logger.info("Client Daemon Succesfully Terminated!")
         elif args.command == "get":
-            self.socket.sendall(GetFileRequest(args.filename, args.absolute))
-            response = self.socket.recvall()
-            if response:
-                if isinstance(response, Response):
-                    raise TypeError(f"Expected response type. Got: {type(response)}")
+            response = self.get_file(args.filename, args.absolute)
+            if response.file_path is None:
+                self.logger.info(f"File not found: {args.filename}")
+        elif args.command == "save":
+            response = self.save_file(args.filename, args.absolute)
+            if not response.success:
+                self.logger.info(f"Failed to save {args.filename}: {response.error}")
+        elif args.command == "stat":
+            for response in self.stat(args.filenames, args.absolute):
+                if not response.exists:
+                    print(f"{response.file_path}: not found")
+                else:
+                    kind = "directory" if response.is_dir else "file"
+                    print(
+                        f"{response.file_path}: {kind} size={response.size} "
+                        f"mtime_ns={response.mtime_ns} mode={response.mode:o}"
+                    )
+        elif args.command == "ls":
+            response = self.list_dir(args.dirname, args.absolute)
+            if response.error is not None:
+                self.logger.info(f"Failed to list {args.dirname}: {response.error}")
+            else:
+                for name, kind, size, mtime_ns in response.listing.entries():
+                    suffix = "/" if kind == "d" else ""
+                    print(f"{kind} {size:>12} {mtime_ns} {name}{suffix}")
+        elif args.command == "index":
+            # NUL separated like `find -print0`, for projectile-generic-command
+            for path in self.get_project_index():
+                sys.stdout.buffer.write(path + b"\0")
+            sys.stdout.flush()
+        elif args.command == "find":
+            response = self.fuzzy_find(args.query, args.k)
+            for path, _, _ in response.matches:
+                print(path)
+        elif args.command == "search":
+            stream = self.search(
+                args.pattern,
+                args.regex,
+                args.ignore_case,
+                args.include,
+                args.exclude,
+                args.max_results,
+            )
+            for response in self.consume(stream):
+                if isinstance(response, SearchDone):
+                    if response.truncated:
+                        self.logger.info(
+                            f"Stopped after {response.num_results} matches"
+                        )
+                else:
+                    response.run(self)
+        elif args.command == "symbol":
+            response = self.lookup_symbol(
+                args.name, args.prefix, args.file, args.max_results
+            )
+            for name, kind, path, line in response.symbols:
+                print(f"{path}:{line}:{kind}:{name}")
+        elif args.command == "range":
+            responses = self.get_file_range(
+                args.filename,
+                args.start,
+                args.end,
+                args.lines,
+                args.absolute,
+                args.follow,
+            )
+            if args.follow:
+                responses = self.consume(responses)
+            else:
+                responses = [responses]
+
+            for response in responses:
+                data = getattr(response, "data", b"")
+                sys.stdout.buffer.write(data)
+                sys.stdout.flush()
+        elif args.command == "shell":
+            returncode = None
+            stream = self.stream_request(ShellRequest(args.cmd, stream=True))
+            for response in self.consume(stream):
+                if isinstance(response, ShellExitStatus):
+                    returncode = response.returncode
+                else:
+                    response.run(self)
 
-                response.run(self)
+            return returncode
 
     def prompt(self):
         parser = argparse.ArgumentParser()
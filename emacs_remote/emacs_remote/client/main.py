@@ -15,6 +15,9 @@ def run(args):
         host=args.host,
         workspace=args.workspace,
         logging_level=args.level,
+        compression=args.compression,
+        max_frame_size=args.max_frame_size,
+        spill_threshold=args.spill_threshold,
     ) as client:
         if args.command == "prompt":
             client.prompt()
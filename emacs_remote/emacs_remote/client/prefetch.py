@@ -0,0 +1,326 @@
+import heapq
+import posixpath
+import re
+import time
+from pathlib import Path
+from threading import Condition, Thread
+
+import msgpack
+
+from emacs_remote.client.files import get_file
+from emacs_remote.messages import Priority
+from emacs_remote.utils.files import AtomicFileWriter
+
+# Candidates are fetched in this order
+PRIORITY_IMPORT = 0
+PRIORITY_HISTORY = 1
+PRIORITY_SIBLING = 2
+
+# Only the start of a file is scanned for imports
+IMPORT_SCAN_SIZE = 256 * 1024
+
+_PYTHON_FROM = re.compile(
+    rb"^[ \t]*from[ \t]+(\.*)([\w.]*)[ \t]+import[ \t]+\(?([\w, \t]*)", re.M
+)
+_PYTHON_IMPORT = re.compile(rb"^[ \t]*import[ \t]+([\w.]+)", re.M)
+_C_INCLUDE = re.compile(rb'^[ \t]*#[ \t]*include[ \t]*"([^"]+)"', re.M)
+_JS_IMPORT = re.compile(
+    rb"""(?:\bfrom|\brequire\(|\bimport\()[ \t]*['"](\.{1,2}/[^'"]+)['"]"""
+)
+_ELISP_REQUIRE = re.compile(rb"\(require[ \t]+'([\w-]+)")
+
+_JS_EXTENSIONS = [".ts", ".tsx", ".js", ".jsx", ".mjs"]
+
+
+def _python_module(base: str, module: str):
+    if not module:
+        return [posixpath.join(base, "__init__.py")]
+
+    path = posixpath.join(base, *module.split("."))
+    return [f"{path}.py", posixpath.join(path, "__init__.py")]
+
+
+def import_candidates(file_path: str, data: bytes):
+    """
+    Guesses the files that a file imports from its contents
+
+    Only imports of files in the project are considered, and the guesses are not
+    checked to exist.
+
+    Args:
+        file_path: the path of the file relative to the workspace
+        data: the start of the contents of the file
+    Returns:
+        The paths relative to the workspace of the files possibly imported
+    """
+    directory = posixpath.dirname(file_path)
+    top = file_path.split("/", 1)[0] if "/" in file_path else ""
+    extension = posixpath.splitext(file_path)[1]
+
+    candidates = []
+    if extension in (".py", ".pyi"):
+        for match in _PYTHON_FROM.finditer(data):
+            dots, module, names = (group.decode() for group in match.groups())
+            if dots:
+                base = directory
+                for _ in range(len(dots) - 1):
+                    base = posixpath.dirname(base)
+                candidates += _python_module(base, module)
+                if not module:
+                    for name in names.replace(",", " ").split():
+                        candidates += _python_module(base, name)
+            else:
+                candidates += _python_module("", module)
+                candidates += _python_module(top, module)
+        for match in _PYTHON_IMPORT.finditer(data):
+            module = match.group(1).decode()
+            candidates += _python_module("", module)
+            candidates += _python_module(top, module)
+    elif extension in (".c", ".h", ".cc", ".cpp", ".cxx", ".hh", ".hpp", ".hxx"):
+        for match in _C_INCLUDE.finditer(data):
+            include = match.group(1).decode()
+            candidates += [
+                posixpath.join(directory, include),
+                include,
+                posixpath.join("include", include),
+            ]
+    elif extension in _JS_EXTENSIONS:
+        for match in _JS_IMPORT.finditer(data):
+            path = posixpath.join(directory, match.group(1).decode())
+            candidates.append(path)
+            candidates += [path + ext for ext in _JS_EXTENSIONS]
+            candidates += [
+                posixpath.join(path, "index" + ext) for ext in _JS_EXTENSIONS
+            ]
+    elif extension == ".el":
+        for match in _ELISP_REQUIRE.finditer(data):
+            name = match.group(1).decode()
+            candidates.append(posixpath.join(directory, f"{name}.el"))
+
+    paths = []
+    for path in candidates:
+        path = posixpath.normpath(path)
+        if path.startswith("../") or path in (".", "..", file_path):
+            continue
+        if path not in paths:
+            paths.append(path)
+
+    return paths
+
+
+class Prefetcher:
+    """
+    Fetches the files likely to be opened next into the local mirror
+
+    Every time a file is opened, the files it imports, the recently opened files
+    and the files next to it are queued in that order. They are fetched one at a
+    time in the background, and only once no file has been opened for idle_delay
+    seconds, so prefetching never competes with files the user is waiting for.
+    What is fetched is bounded by a byte budget that refills over time.
+
+    Args:
+        client: the client daemon. Its file_cache, dir_listings and workspace are
+            used and files are fetched as bulk requests with its scheduler
+        history_path: the file the recently opened files are saved in
+        max_bytes: the byte budget. Files are skipped when the budget runs out
+        refill_rate: bytes per second added back to the budget
+        max_file_size: files bigger than this are never prefetched
+        max_siblings: the maximum number of files next to the opened one to fetch
+        max_history: the number of recently opened files to remember
+        history_candidates: the number of recently opened files queued
+        idle_delay: the number of seconds to wait after a file is opened
+        logger: the logger to use
+    """
+
+    def __init__(
+        self,
+        client,
+        history_path,
+        max_bytes: int = 64 * 1024 * 1024,
+        refill_rate: int = 1024 * 1024,
+        max_file_size: int = 1024 * 1024,
+        max_siblings: int = 16,
+        max_history: int = 256,
+        history_candidates: int = 8,
+        idle_delay: float = 0.5,
+        logger=None,
+    ):
+        self.client = client
+        self.history_path = Path(history_path)
+        self.max_bytes = max_bytes
+        self.refill_rate = refill_rate
+        self.max_file_size = max_file_size
+        self.max_siblings = max_siblings
+        self.max_history = max_history
+        self.history_candidates = history_candidates
+        self.idle_delay = idle_delay
+        self.logger = logger
+
+        self.budget = max_bytes
+        self.refilled_at = time.monotonic()
+        self.last_opened = 0
+
+        self.history = self.load_history()
+        self.opened_files = []
+        self.queue = []
+        self.sequence = 0
+
+        self.condition = Condition()
+        self.stopped = False
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+    def load_history(self):
+        try:
+            history = msgpack.unpackb(self.history_path.read_bytes(), raw=False)
+        except (FileNotFoundError, ValueError, TypeError):
+            return []
+
+        return [path for path in history if isinstance(path, str)]
+
+    def save_history(self):
+        with AtomicFileWriter(self.history_path) as writer:
+            writer.write(msgpack.packb(self.history, use_bin_type=True))
+            writer.commit()
+
+    def opened(self, file_path: str):
+        """
+        Records that a file was opened and queues the files likely to be next
+
+        Args:
+            file_path: the path of the file relative to the workspace
+        """
+        with self.condition:
+            self.last_opened = time.monotonic()
+            if file_path in self.history:
+                self.history.remove(file_path)
+            self.history.insert(0, file_path)
+            del self.history[self.max_history :]
+            self.save_history()
+
+            # Speculation based on older files is less likely to be right
+            self.queue.clear()
+            self.opened_files.append(file_path)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and not self.opened_files and not self.queue:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+
+                opened_files, self.opened_files = self.opened_files, []
+
+            try:
+                for file_path in opened_files:
+                    self.enqueue(file_path)
+                self.fetch_next()
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.error(f"Prefetching failed: {e}")
+
+    def enqueue(self, file_path: str):
+        candidates = []
+
+        local_path = self.client.workspace.local_path(file_path)
+        try:
+            with open(local_path, "rb") as f:
+                data = f.read(IMPORT_SCAN_SIZE)
+        except OSError:
+            data = b""
+
+        for path in import_candidates(file_path, data):
+            size = self.remote_size(path)
+            if size is not None:
+                candidates.append((PRIORITY_IMPORT, path, size))
+
+        with self.condition:
+            history = self.history[1 : self.history_candidates + 1]
+        for path in history:
+            size = self.remote_size(path)
+            if size is not None:
+                candidates.append((PRIORITY_HISTORY, path, size))
+
+        directory = posixpath.dirname(file_path)
+        extension = posixpath.splitext(file_path)[1]
+        listing = self.listing(directory)
+        siblings = [
+            (name, size, mtime_ns)
+            for name, kind, size, mtime_ns in (listing.entries() if listing else [])
+            if kind == "f" and name != posixpath.basename(file_path)
+        ]
+        # Files of the same type first, then the most recently modified
+        siblings.sort(key=lambda s: (posixpath.splitext(s[0])[1] != extension, -s[2]))
+        for name, size, _ in siblings[: self.max_siblings]:
+            path = posixpath.join(directory, name)
+            candidates.append((PRIORITY_SIBLING, path, size))
+
+        with self.condition:
+            for priority, path, size in candidates:
+                if size > self.max_file_size:
+                    continue
+                self.sequence += 1
+                heapq.heappush(self.queue, (priority, self.sequence, path, size))
+
+    def listing(self, directory: str):
+        path = str(self.client.workspace.remote_path(directory))
+        try:
+            return self.client.dir_listings.get(path)
+        except OSError:
+            return None
+
+    def remote_size(self, file_path: str):
+        """
+        Returns the size of a file on the server, or None if there is no such file
+        """
+        listing = self.listing(posixpath.dirname(file_path))
+        if listing is None:
+            return None
+
+        name = posixpath.basename(file_path)
+        for entry_name, kind, size, _ in listing.entries():
+            if entry_name == name and kind == "f":
+                return size
+
+        return None
+
+    def fetch_next(self):
+        # Yield to the files being opened
+        while True:
+            with self.condition:
+                if self.stopped or self.opened_files or not self.queue:
+                    return
+                wait = self.last_opened + self.idle_delay - time.monotonic()
+                if wait <= 0:
+                    _, _, file_path, size = heapq.heappop(self.queue)
+                    break
+                self.condition.wait(wait)
+
+        now = time.monotonic()
+        self.budget = min(
+            self.max_bytes, self.budget + (now - self.refilled_at) * self.refill_rate
+        )
+        self.refilled_at = now
+        if size > self.budget:
+            return
+
+        self.client.file_cache.reload()
+        if self.client.file_cache.get(file_path) is not None:
+            return
+
+        response = get_file(self.client, file_path, priority=Priority.bulk)
+        if response.file_path is not None and not response.not_modified:
+            self.budget -= response.size
+            if self.logger is not None:
+                self.logger.debug(f"Prefetched {file_path}")
@@ -0,0 +1,161 @@
+from concurrent.futures import CancelledError
+from threading import Lock, Thread
+
+from emacs_remote.messages import CancelledResponse, Priority
+from emacs_remote.messages.cancel_request import CancelRequest, CreditRequest
+from emacs_remote.messages.handshake_request import Capabilities
+from emacs_remote.messages.registry import MessageTypeRegistry
+from emacs_remote.utils.compression import CompressionPolicy
+from emacs_remote.utils.stcp_socket import SecureTCPSocket
+
+
+class RequestRelay:
+    """
+    Serves the protocol of the server on a local port and relays the requests to
+    the server over the daemon's scheduler
+
+    Client interfaces connect to it as if it was the server, on the port of the
+    priority of their requests. Every request then goes through the scheduler, so
+    it sees all of the traffic when spreading requests over the connections. It is
+    also the only way to reach the server when the daemon talks to it over the ssh
+    pipe.
+
+    Responses are relayed as they arrive, and credit for streamed responses is
+    granted to the server as they are, so a slow interface slows the server down.
+    Cancelling a request on the local connection cancels it on the server.
+
+    Args:
+        daemon: the client daemon whose scheduler requests are sent with
+        logger: the logger to use
+        limits: the limits on frames received from the interfaces
+    """
+
+    def __init__(self, daemon: "ClientDaemon", logger=None, limits=None):
+        self.daemon = daemon
+        self.logger = logger
+        # Frames only go over the loopback, so they are never compressed
+        self.sockets = {
+            priority: SecureTCPSocket(
+                logger=logger,
+                compression=CompressionPolicy.get("none"),
+                limits=limits,
+            )
+            for priority in Priority
+        }
+        # priority -> port to connect to
+        self.ports = {}
+
+    def start(self):
+        """
+        Starts accepting connections in the background
+        """
+        for priority, s in self.sockets.items():
+            s.bind("localhost", 0)
+            self.ports[priority] = s.getsockname()[1]
+            s.listen()
+            self.logger.debug(
+                f"Relaying {priority.name} requests from "
+                f"localhost:{self.ports[priority]}"
+            )
+
+            thread = Thread(target=self._accept, args=(s, priority))
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        for s in self.sockets.values():
+            s.close()
+
+    def _accept(self, s: SecureTCPSocket, priority: Priority):
+        while True:
+            try:
+                conn, _ = s.accept()
+            except OSError:
+                # Closed by stop
+                return
+
+            thread = Thread(target=self._serve, args=(conn, priority))
+            thread.daemon = True
+            thread.start()
+
+    def capabilities(self, conn: SecureTCPSocket) -> Capabilities:
+        """
+        Returns what the server supports, as far as relaying allows
+        """
+        server = self.daemon.scheduler.peer
+        return Capabilities(
+            version=server.version,
+            codecs=[],
+            max_frame_size=min(conn.limits.max_frame_size, server.max_frame_size),
+            chunk_size=server.chunk_size,
+            features=list(server.features),
+            # Servers that predate the handshake are assumed to know every type
+            message_types=server.message_types or MessageTypeRegistry.table(),
+        )
+
+    def _serve(self, conn: SecureTCPSocket, priority: Priority):
+        # interface request id -> stream of the relayed request
+        streams = {}
+        lock = Lock()
+        try:
+            conn.negotiate(initiator=False, local=self.capabilities(conn))
+
+            while True:
+                request_id, request, _ = conn.recv_message()
+                if request is None:
+                    break
+
+                if isinstance(request, CancelRequest):
+                    with lock:
+                        stream = streams.get(request.request_id)
+                    if stream is not None:
+                        stream.cancel()
+                    continue
+
+                if isinstance(request, CreditRequest):
+                    # Credit is granted to the server as responses are relayed
+                    continue
+
+                thread = Thread(
+                    target=self._relay,
+                    args=(conn, request_id, request, priority, streams, lock),
+                )
+                thread.daemon = True
+                thread.start()
+        except Exception as e:
+            self.logger.debug(f"Relay connection failed: {e}")
+        finally:
+            conn.close()
+            with lock:
+                pending = list(streams.values())
+            for stream in pending:
+                stream.cancel()
+
+    def _relay(self, conn, request_id, request, priority, streams, lock):
+        try:
+            # May wait for a bulk slot
+            stream = self.daemon.scheduler.stream(request, priority)
+        except Exception as e:
+            self.logger.debug(f"Failed to relay {type(request).__name__}: {e}")
+            conn.close()
+            return
+
+        with lock:
+            streams[request_id] = stream
+
+        try:
+            for message, last in stream.frames():
+                conn.sendall(message, request_id, more=not last)
+        except CancelledError:
+            # The interface keeps the id reserved until the request is over
+            try:
+                conn.sendall(CancelledResponse(), request_id)
+            except OSError:
+                pass
+        except Exception as e:
+            # Without the server the interface has nothing left to wait for
+            self.logger.debug(f"Failed to relay request {request_id}: {e}")
+            conn.close()
+        finally:
+            with lock:
+                streams.pop(request_id, None)
@@ -2,6 +2,8 @@ import argparse
 import os
 from pathlib import Path
 
+from emacs_remote.utils.spill import FrameLimits
+
 
 def get_client_parser():
     parser = argparse.ArgumentParser(
@@ -34,6 +36,36 @@ def get_client_parser():
         default="info",
         help="Logger level",
     )
+    parser.add_argument(
+        "-c",
+        "--compression",
+        choices=["default", "fast", "strong", "none"],
+        default="default",
+        help="Compression policy. Use fast on LAN links and strong on slow links",
+    )
+    parser.add_argument(
+        "--max_frame_size",
+        type=int,
+        default=FrameLimits.max_frame_size,
+        help="Size in bytes of the largest message accepted from the server",
+    )
+    parser.add_argument(
+        "--spill_threshold",
+        type=int,
+        default=FrameLimits.spill_threshold,
+        help="Size in bytes from which messages are received to disk, not memory",
+    )
+    parser.add_argument(
+        "--transport",
+        choices=["tcp", "stdio"],
+        default="tcp",
+        help="Connect over forwarded ports or over the stdin and stdout of ssh",
+    )
+    parser.add_argument(
+        "--ssh_standby",
+        action="store_true",
+        help="Keep a second authenticated ssh connection to fail over to",
+    )
     return parser
 
 
@@ -52,3 +84,151 @@ def add_client_subparsers(subparsers):
         action="store_true",
         help="If provided, assume file name is an absolute path, not a relative one",
     )
+
+    save_parser = subparsers.add_parser(
+        "save", help="Command to send the local copy of a file to the server"
+    )
+    save_parser.add_argument("filename", help="Name of the file to save")
+    save_parser.add_argument(
+        "-a",
+        "--absolute",
+        action="store_true",
+        help="If provided, assume file name is an absolute path, not a relative one",
+    )
+
+    stat_parser = subparsers.add_parser(
+        "stat", help="Command to check whether files exist on the server"
+    )
+    stat_parser.add_argument("filenames", nargs="+", help="Names of the files")
+    stat_parser.add_argument(
+        "-a",
+        "--absolute",
+        action="store_true",
+        help="If provided, assume file names are absolute paths, not relative ones",
+    )
+
+    ls_parser = subparsers.add_parser(
+        "ls", help="Command to list a directory on the server"
+    )
+    ls_parser.add_argument(
+        "dirname", nargs="?", default="", help="Name of the directory to list"
+    )
+    ls_parser.add_argument(
+        "-a",
+        "--absolute",
+        action="store_true",
+        help="If provided, assume directory name is an absolute path",
+    )
+
+    subparsers.add_parser(
+        "index", help="Command to list the files in the project, NUL separated"
+    )
+
+    find_parser = subparsers.add_parser(
+        "find", help="Command to fuzzy find files in the project"
+    )
+    find_parser.add_argument("query", help="Characters to match, in order")
+    find_parser.add_argument(
+        "-k", type=int, default=20, help="Number of matches to print"
+    )
+
+    search_parser = subparsers.add_parser(
+        "search", help="Command to search the contents of the files in the project"
+    )
+    search_parser.add_argument("pattern", help="Text to search for")
+    search_parser.add_argument(
+        "-e",
+        "--regex",
+        action="store_true",
+        help="If provided, pattern is a regular expression instead of literal text",
+    )
+    search_parser.add_argument(
+        "-i", "--ignore_case", action="store_true", help="Ignore case"
+    )
+    search_parser.add_argument(
+        "--include",
+        action="append",
+        help="Only search files matching this glob. Can be given more than once",
+    )
+    search_parser.add_argument(
+        "--exclude",
+        action="append",
+        help="Skip files matching this glob. Can be given more than once",
+    )
+    search_parser.add_argument(
+        "-m",
+        "--max_results",
+        type=int,
+        default=1000,
+        help="Stop after this many matches",
+    )
+
+    symbol_parser = subparsers.add_parser(
+        "symbol", help="Command to look up definitions in the project"
+    )
+    symbol_parser.add_argument(
+        "name", nargs="?", default="", help="Name of the symbol to look up"
+    )
+    symbol_parser.add_argument(
+        "-p",
+        "--prefix",
+        action="store_true",
+        help="If provided, look up every symbol starting with name",
+    )
+    symbol_parser.add_argument(
+        "-f",
+        "--file",
+        default=None,
+        help="If provided, list the definitions in this file instead",
+    )
+    symbol_parser.add_argument(
+        "-m",
+        "--max_results",
+        type=int,
+        default=100,
+        help="Maximum number of definitions to print",
+    )
+
+    range_parser = subparsers.add_parser(
+        "range", help="Command to print part of a file on the server"
+    )
+    range_parser.add_argument("filename", help="Name of the file to read")
+    range_parser.add_argument(
+        "-s",
+        "--start",
+        type=int,
+        default=0,
+        help="First byte (or line) to read. Negative values count from the end",
+    )
+    range_parser.add_argument(
+        "-e",
+        "--end",
+        type=int,
+        default=None,
+        help="Byte (or line) after the last one to read",
+    )
+    range_parser.add_argument(
+        "-n",
+        "--lines",
+        action="store_true",
+        help="If provided, start and end are line numbers instead of byte offsets",
+    )
+    range_parser.add_argument(
+        "-f",
+        "--follow",
+        action="store_true",
+        help="If provided, keep printing data as it is appended to the file",
+    )
+    range_parser.add_argument(
+        "-a",
+        "--absolute",
+        action="store_true",
+        help="If provided, assume file name is an absolute path, not a relative one",
+    )
+
+    shell_parser = subparsers.add_parser(
+        "shell", help="Command to run a shell command on the server"
+    )
+    shell_parser.add_argument(
+        "cmd", nargs=argparse.REMAINDER, help="The command to run"
+    )
@@ -1,12 +1,30 @@
 #!/usr/bin/env python3
 
-from .file_request import GetFileRequest, GetFileResponse
-from .message import Request, Response
+from .batch_request import BatchRequest, BatchResponse
+from .cancel_request import CancelledResponse, CancelRequest, CreditRequest
+from .compression_request import CompressionRequest, CompressionResponse
+from .file_request import (FileChunk, FileDeltaResponse, FileSignatureRequest,
+                           FileSignatureResponse, GetFileDeltaRequest,
+                           GetFileRangeRequest, GetFileRangeResponse,
+                           GetFileRequest, GetFileResponse, SendFileRequest,
+                           SendFileResponse)
+from .fuzzy_find_request import FuzzyFindRequest, FuzzyFindResponse
+from .handshake_request import (Capabilities, HandshakeRequest,
+                                HandshakeResponse)
+from .list_dir_request import ListDirRequest, ListDirResponse
+from .message import Execution, Priority, Request, Response
 from .port_request import PortRequest, PortResponse
+from .prefetch_request import PrefetchRequest, PrefetchResponse
+from .project_index_request import ProjectIndexRequest, ProjectIndexResponse
 from .registry import MessageTypeRegistry
+from .search_request import SearchDone, SearchMatches, SearchRequest
 # Message Types
-from .shell_request import ShellRequest, ShellResponse
+from .shell_request import (ShellExitStatus, ShellOutputChunk, ShellRequest,
+                            ShellResponse)
+from .stat_request import StatRequest, StatResponse
+from .symbol_lookup_request import SymbolLookupRequest, SymbolLookupResponse
 from .terminate_request import (ClientTerminateRequest,
                                 ClientTerminateResponse,
                                 ServerTerminateRequest,
                                 ServerTerminateResponse)
+from .watch_request import FilesChangedNotification, WatchRequest
@@ -0,0 +1,80 @@
+from dataclasses import dataclass, field
+from typing import List
+
+from .message import Request, Response
+from .registry import MessageTypeRegistry
+
+
+@dataclass
+class BatchResponse(Response):
+    """
+    Args:
+        responses: the packed response of each request of the batch, in order. None
+            for the requests that failed
+        errors: the error raised by each request, in order. None for the requests
+            that succeeded
+    """
+
+    responses: List[list] = field(default_factory=list)
+    errors: List[str] = field(default_factory=list)
+
+    def results(self) -> list:
+        """
+        Returns:
+            A (response, error) tuple for each request of the batch, in order
+        """
+        return [
+            (None if response is None else MessageTypeRegistry.unpack(response), error)
+            for response, error in zip(self.responses, self.errors)
+        ]
+
+    def run(self, client):
+        for response, _ in self.results():
+            if response is not None:
+                response.run(client)
+
+
+@dataclass
+class BatchRequest(Request):
+    """
+    Runs many small requests in a single round trip
+
+    Each request runs on the pool for its own `execution` type, concurrently unless
+    ordered is set. A request that fails doesn't fail the batch, its error is
+    returned in its place. Requests that stream their response can't be batched.
+
+    Args:
+        requests: the packed requests. Use `BatchRequest.of` to build a batch
+        ordered: whether to run the requests one after the other, in order
+    """
+
+    requests: List[list] = field(default_factory=list)
+    ordered: bool = False
+
+    @staticmethod
+    def of(requests, ordered: bool = False):
+        return BatchRequest(
+            [MessageTypeRegistry.pack(request) for request in requests], ordered
+        )
+
+    def run(self, daemon):
+        requests = [MessageTypeRegistry.unpack(request) for request in self.requests]
+        for request in requests:
+            if not isinstance(request, Request) or isinstance(request, BatchRequest):
+                raise TypeError(f"Can't batch {type(request)}")
+
+        daemon.logger.debug(f"Running batch of {len(requests)} requests")
+        responses, errors = [], []
+        for result in daemon.executor.run_batch(requests, self.ordered):
+            if isinstance(result, Exception):
+                responses.append(None)
+                errors.append(f"{type(result).__name__}: {result}")
+            else:
+                responses.append(MessageTypeRegistry.pack(result))
+                errors.append(None)
+
+        return BatchResponse(responses, errors)
+
+
+MessageTypeRegistry.register(BatchRequest, 50)
+MessageTypeRegistry.register(BatchResponse, 51)
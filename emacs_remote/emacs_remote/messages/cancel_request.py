@@ -0,0 +1,58 @@
+from dataclasses import dataclass
+
+from .message import Execution, Request, Response
+from .registry import MessageTypeRegistry
+
+
+@dataclass
+class CancelledResponse(Response):
+    """
+    The final message of a request that was cancelled, sent in place of its
+    response. Once it arrives the request id can be reused
+    """
+
+
+@dataclass
+class CancelRequest(Request):
+    """
+    Cancels a request in flight on the same connection
+
+    A request that hasn't started is never run. A running one is stopped, which
+    kills its subprocess or closes its stream, and any of its messages not yet sent
+    are dropped.
+
+    Args:
+        request_id: the id of the request to cancel
+    """
+
+    request_id: int
+
+    execution = Execution.control
+
+    def run(self, requests: "ConnectionRequests"):
+        requests.cancel(self.request_id)
+
+
+@dataclass
+class CreditRequest(Request):
+    """
+    Lets a request in flight on the same connection send more of its streamed
+    response
+
+    Args:
+        request_id: the id of the request
+        credit: the number of bytes the client has consumed and can take again
+    """
+
+    request_id: int
+    credit: int
+
+    execution = Execution.control
+
+    def run(self, requests: "ConnectionRequests"):
+        requests.grant(self.request_id, self.credit)
+
+
+MessageTypeRegistry.register(CancelRequest, 12)
+MessageTypeRegistry.register(CancelledResponse, 13)
+MessageTypeRegistry.register(CreditRequest, 14)
@@ -0,0 +1,100 @@
+from dataclasses import fields, is_dataclass
+from operator import attrgetter
+
+import msgpack
+
+# Placeholder for a bytes field that is sent after the packed fields instead of
+# inside them. Its data is the size of the field as 8 big endian bytes
+EXT_BUFFER = 1
+
+# Bytes fields at least this big are sent out of band. Smaller ones are cheaper to
+# pack inline
+OUT_OF_BAND_SIZE = 64 * 1024
+
+
+class MessageCodec:
+    """
+    Converts the messages of one type to and from the lists that are packed
+
+    Everything that can be worked out from the type is done once when the type is
+    registered, so encoding a message is a single C level attribute lookup for all
+    of its fields and decoding is a single call of its `__init__`.
+
+    Args:
+        type: the message type
+        type_id: the id of the type on the wire
+    """
+
+    def __init__(self, type, type_id: int):
+        self.type = type
+        self.type_id = type_id
+
+        if not is_dataclass(type):
+            # str, list, tuple or dict
+            self.names = None
+            self.bytes_fields = []
+            return
+
+        self.names = tuple(f.name for f in fields(type))
+        self.bytes_fields = [
+            i for i, f in enumerate(fields(type)) if f.type in (bytes, "bytes")
+        ]
+
+        if len(self.names) == 1:
+            name = self.names[0]
+            self.getter = lambda message: (getattr(message, name),)
+        elif self.names:
+            self.getter = attrgetter(*self.names)
+        else:
+            self.getter = lambda message: ()
+
+    def encode(self, message, buffers: list = None) -> list:
+        """
+        Returns the fields of a message as a list that msgpack can pack
+
+        Unlike `dataclasses.astuple`, nested values are not copied.
+
+        Args:
+            message: the message to encode
+            buffers: if given, big bytes fields are appended to it and replaced by
+                EXT_BUFFER placeholders, so the caller can send them as they are
+        """
+        if self.names is None:
+            return [message] if isinstance(message, str) else message
+
+        values = list(self.getter(message))
+        if buffers is not None:
+            for i in self.bytes_fields:
+                value = values[i]
+                if value is not None and len(value) >= OUT_OF_BAND_SIZE:
+                    size = len(value).to_bytes(8, "big")
+                    values[i] = msgpack.ExtType(EXT_BUFFER, size)
+                    buffers.append(value)
+
+        return values
+
+    def decode(self, values, buffers: memoryview = None, copy: bool = True):
+        """
+        Builds a message from the fields returned by `encode`
+
+        Args:
+            values: the unpacked fields
+            buffers: the bytes sent after the packed fields, if any
+            copy: whether to copy the fields taken from buffers. If False they are
+                views of it, so buffers must outlive the message
+        """
+        if buffers is not None:
+            offset = 0
+            for i in self.bytes_fields:
+                value = values[i] if i < len(values) else None
+                if isinstance(value, msgpack.ExtType) and value.code == EXT_BUFFER:
+                    size = int.from_bytes(value.data, "big")
+                    view = buffers[offset : offset + size]
+                    values[i] = bytes(view) if copy else view
+                    offset += size
+
+        if isinstance(values, dict):
+            return self.type(**values)
+
+        # The __init__ generated for dataclasses beats filling in __dict__
+        return self.type(*values)
@@ -0,0 +1,42 @@
+from dataclasses import dataclass
+from typing import List
+
+from ..utils.compression import available_codecs, negotiate_codecs
+from .message import Execution, Request, Response
+from .registry import MessageTypeRegistry
+
+# Listed among the codecs by clients that want a handshake to follow. Servers that
+# know the handshake list it back, older ones drop it like any unknown codec
+HANDSHAKE_PROBE = "handshake"
+
+
+@dataclass
+class CompressionResponse(Response):
+    codecs: List[str]
+
+
+@dataclass
+class CompressionRequest(Request):
+    """
+    Sent right after connecting to agree on the codecs that both sides support
+
+    Also sent ahead of a `HandshakeRequest` to find out whether the server knows
+    it, see HANDSHAKE_PROBE.
+
+    Args:
+        codecs: the codecs supported by the sender in order of preference
+    """
+
+    codecs: List[str]
+
+    execution = Execution.inline
+
+    def run(self, daemon):
+        codecs = negotiate_codecs(self.codecs, available_codecs())
+        if HANDSHAKE_PROBE in self.codecs:
+            codecs.append(HANDSHAKE_PROBE)
+        return CompressionResponse(codecs)
+
+
+MessageTypeRegistry.register(CompressionRequest, 10)
+MessageTypeRegistry.register(CompressionResponse, 11)
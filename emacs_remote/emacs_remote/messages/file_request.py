@@ -1,53 +1,594 @@
-from dataclasses import dataclass
+import mmap
+import os
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import List
 
-from .message import Request, Response
+from ..utils.cancel import current_token
+from ..utils.delta import (DEFAULT_BLOCK_SIZE, FileSignature, apply_delta,
+                           compute_delta)
+from ..utils.file_cache import content_digest, content_hasher, is_not_modified
+from ..utils.files import AtomicFileWriter, map_file
+from ..utils.line_index import line_indexes
+from .message import Execution, Request, Response
 from .registry import MessageTypeRegistry
 
 
 @dataclass
 class GetFileResponse(Response):
+    """
+    Args:
+        file_path: the requested file path. None if the file does not exist
+        absolute: whether file_path is absolute
+        file_contents: the contents of the file. None for chunked transfers
+        size: the size of the file in bytes
+        checksum: crc32 checksum of the file contents
+        mtime_ns: the modification time of the file on the server
+        digest: the content hash of the file, recorded in the client's `FileCache`
+        not_modified: whether the client's copy matched the validator of the
+            request. No contents are sent if True
+    """
+
     file_path: str = None
     absolute: bool = False
     file_contents: bytes = None
+    size: int = None
+    checksum: int = None
+    mtime_ns: int = None
+    digest: str = None
+    not_modified: bool = False
 
     def run(self, client):
-        if file_contents:
-            file_path = client.base_path.joinpath(self.file_path)
-            file_path.write_bytes(self.file_contents)
+        if self.file_contents is not None:
+            local_path = client.workspace.local_path(self.file_path, self.absolute)
+            with AtomicFileWriter(local_path) as writer:
+                writer.write(self.file_contents)
+                writer.commit(self.size, self.checksum)
+
+
+@dataclass
+class FileChunk(Response):
+    """
+    Part of the contents of a file sent by a chunked `GetFileRequest`
+
+    Args:
+        offset: the offset of the chunk in the file
+        data: the contents of the chunk
+    """
+
+    offset: int
+    data: bytes
 
 
 @dataclass
 class GetFileRequest(Request):
+    """
+    Fetches a file from the server into the local mirror
+
+    Args:
+        file_path: path of the file relative to the workspace, or an absolute path
+        absolute: whether file_path is absolute
+        chunked: if True, the file is served from an mmap and streamed back in
+            `FileChunk` messages followed by a `GetFileResponse` without contents.
+            Use `receive` to write the chunks to the local mirror
+        chunk_size: the size of each chunk in bytes
+        validator: the validator of the client's cached copy. If the file has not
+            changed since, a `GetFileResponse` with not_modified set is sent instead
+            of the contents
+    """
+
+    file_path: str
+    absolute: bool = False
+    chunked: bool = False
+    chunk_size: int = 1024 * 1024
+    validator: list = None
+
+    def run(self, daemon):
+        daemon.logger.debug(f"Getting file {self.file_path}")
+
+        file_path = daemon.workspace.remote_path(self.file_path, self.absolute)
+        if not file_path.is_file():
+            return GetFileResponse()
+
+        # The file is stat-ed before it is read so that a concurrent write can only
+        # make the client's validator stale, never wrongly fresh
+        stat = file_path.stat()
+        if is_not_modified(self.validator, file_path, stat):
+            daemon.logger.debug(f"File {self.file_path} not modified")
+            return GetFileResponse(
+                self.file_path,
+                self.absolute,
+                size=stat.st_size,
+                mtime_ns=stat.st_mtime_ns,
+                digest=self.validator[2],
+                not_modified=True,
+            )
+
+        if self.chunked:
+            return self.run_chunked(file_path, stat)
+
+        contents = file_path.read_bytes()
+        return GetFileResponse(
+            self.file_path,
+            self.absolute,
+            contents,
+            len(contents),
+            zlib.crc32(contents),
+            stat.st_mtime_ns,
+            content_digest(contents),
+        )
+
+    def run_chunked(self, file_path, stat):
+        size = 0
+        checksum = 0
+        hasher = content_hasher()
+        with file_path.open("rb") as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    size = len(m)
+                    for offset in range(0, size, self.chunk_size):
+                        # Only the current chunk is ever copied out of the page cache
+                        chunk = m[offset : offset + self.chunk_size]
+                        checksum = zlib.crc32(chunk, checksum)
+                        hasher.update(chunk)
+                        yield FileChunk(offset, chunk)
+
+        return GetFileResponse(
+            self.file_path,
+            self.absolute,
+            None,
+            size,
+            checksum,
+            stat.st_mtime_ns,
+            hasher.hexdigest(),
+        )
+
+    def receive(self, client, responses):
+        """
+        Writes the response to this request into the local mirror
+
+        Chunks are written straight to a temporary file next to the destination,
+        which is renamed into place once the checksum has been verified.
+
+        Args:
+            client: the client whose workspace to write into
+            responses: the messages sent in response to this request
+        Returns:
+            The final GetFileResponse
+        """
+        local_path = client.workspace.local_path(self.file_path, self.absolute)
+        with AtomicFileWriter(local_path) as writer:
+            for response in responses:
+                if isinstance(response, FileChunk):
+                    if response.offset != writer.size:
+                        raise ValueError(
+                            f"Expected chunk at offset {writer.size}. "
+                            f"Got {response.offset}"
+                        )
+
+                    writer.write(response.data)
+                elif not isinstance(response, GetFileResponse):
+                    raise TypeError(
+                        f"Expected type GetFileResponse. Got: {type(response)}"
+                    )
+                elif response.file_path is None or response.not_modified:
+                    writer.abort()
+                    return response
+                else:
+                    if response.file_contents is not None:
+                        writer.write(response.file_contents)
+
+                    writer.commit(response.size, response.checksum)
+                    return response
+
+            raise ConnectionError(f"Response to get {self.file_path} ended early")
+
+
+@dataclass
+class GetFileRangeResponse(Response):
+    """
+    Args:
+        file_path: the requested file path. None if the file does not exist
+        absolute: whether file_path is absolute
+        start: the byte offset of the returned data in the file
+        data: the contents of the file in the requested range
+        size: the size of the file in bytes when the range was read
+    """
+
+    file_path: str = None
+    absolute: bool = False
+    start: int = 0
+    data: bytes = b""
+    size: int = 0
+
+
+@dataclass
+class GetFileRangeRequest(Request):
+    """
+    Reads part of a file on the server without transferring the whole file
+
+    Line ranges are resolved using a line offset index that is built lazily and
+    cached per file, so repeated reads of a huge file only scan it once.
+
+    Args:
+        file_path: path of the file relative to the workspace, or an absolute path
+        absolute: whether file_path is absolute
+        start: the first byte (or line) of the range. Negative values count back
+            from the end of the file
+        end: the byte (or line) after the range. None to read to the end of the file
+        lines: whether start and end are 0-based line numbers instead of offsets
+        follow: if True, the range is sent as the first message of a stream, and
+            data appended to the file afterwards is streamed as `FileChunk`
+            messages until the file is truncated or replaced, like `tail -f`
+        poll_interval: seconds between checks for appended data when following
+        chunk_size: the maximum size of each streamed chunk when following
+    """
+
     file_path: str
     absolute: bool = False
+    start: int = 0
+    end: int = None
+    lines: bool = False
+    follow: bool = False
+    poll_interval: float = 0.5
+    chunk_size: int = 1024 * 1024
+
+    @property
+    def execution(self):
+        # Following only ends when the client cancels it
+        return Execution.watch if self.follow else Execution.io
+
+    def read_range(self, file_path):
+        with file_path.open("rb") as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_size == 0:
+                return GetFileRangeResponse(self.file_path, self.absolute), stat
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                size = len(m)
+                if self.lines:
+                    index = line_indexes.get(file_path, stat.st_ino, size)
+                    start, end = index.line_range(m, self.start, self.end)
+                else:
+                    start, end, _ = slice(self.start, self.end).indices(size)
+
+                data = m[start:end] if start < end else b""
+
+        response = GetFileRangeResponse(
+            self.file_path, self.absolute, start, data, size
+        )
+        return response, stat
 
     def run(self, daemon):
-        daemon.logger.debug(f"Getting file {file_name}")
+        daemon.logger.debug(f"Getting range of file {self.file_path}")
+
+        file_path = daemon.workspace.remote_path(self.file_path, self.absolute)
+        if not file_path.is_file():
+            return GetFileRangeResponse()
 
-        if self.absolute:
-            pass
-        else:
-            file_path = daemon.workspace.joinpath(self.file_path)
-            if not file_path.exists():
-                return GetFileResponse()
+        response, stat = self.read_range(file_path)
+        if not self.follow:
+            return response
 
-            return GetFileResponse(self.file_path, self.absolute, file_path.read_bytes)
+        return self.run_follow(file_path, response, stat)
+
+    def run_follow(self, file_path, response, stat):
+        token = current_token()
+        yield response
+
+        offset = response.size
+        with file_path.open("rb") as f:
+            # Make sure we are following the same file that the range was read from
+            if os.fstat(f.fileno()).st_ino != stat.st_ino:
+                return GetFileRangeResponse(self.file_path, self.absolute, offset)
+
+            f.seek(offset)
+            while True:
+                data = f.read(self.chunk_size)
+                if data:
+                    yield FileChunk(offset, data)
+                    offset += len(data)
+                    continue
+
+                time.sleep(self.poll_interval)
+                token.check()
+
+                try:
+                    current = file_path.stat()
+                except FileNotFoundError:
+                    break
+
+                if current.st_ino != stat.st_ino or current.st_size < offset:
+                    # The file was replaced or truncated
+                    break
+
+        return GetFileRangeResponse(self.file_path, self.absolute, offset)
+
+
+@dataclass
+class FileSignatureResponse(Response):
+    """
+    Block signatures of the server's copy of a file
+
+    Args:
+        file_path: the requested file path. None if the file does not exist
+        absolute: whether file_path is absolute
+        block_size: the size of each signed block
+        weak: the rolling checksum of each block
+        strong: the concatenated strong hashes of the blocks
+    """
+
+    file_path: str = None
+    absolute: bool = False
+    block_size: int = DEFAULT_BLOCK_SIZE
+    weak: List[int] = field(default_factory=list)
+    strong: bytes = b""
+
+    @property
+    def signature(self) -> FileSignature:
+        return FileSignature(self.block_size, self.weak, self.strong)
+
+
+@dataclass
+class FileSignatureRequest(Request):
+    """
+    Gets the block signatures of a file on the server so that a save can be sent as
+    a delta
+
+    Args:
+        file_path: path of the file relative to the workspace, or an absolute path
+        absolute: whether file_path is absolute
+        block_size: the size of each signed block
+    """
+
+    file_path: str
+    absolute: bool = False
+    block_size: int = DEFAULT_BLOCK_SIZE
+
+    def run(self, daemon):
+        daemon.logger.debug(f"Getting signature of file {self.file_path}")
+
+        file_path = daemon.workspace.remote_path(self.file_path, self.absolute)
+        if not file_path.is_file():
+            return FileSignatureResponse()
+
+        with map_file(file_path) as m:
+            signature = FileSignature.compute(m, self.block_size)
+
+        return FileSignatureResponse(
+            self.file_path,
+            self.absolute,
+            signature.block_size,
+            signature.weak,
+            signature.strong,
+        )
+
+
+@dataclass
+class FileDeltaResponse(Response):
+    """
+    The changes between the client's copy of a file and the server's copy
+
+    Args:
+        file_path: the requested file path. None if the file does not exist
+        absolute: whether file_path is absolute
+        block_size: the block size of the signature the delta was computed against
+        delta: the instructions returned by `compute_delta`
+        size: the size of the server's copy in bytes
+        checksum: crc32 checksum of the server's copy
+        mtime_ns: the modification time of the server's copy
+        digest: the content hash of the server's copy
+        not_modified: whether the client's copy matched the validator of the
+            request. The delta is empty if True
+    """
+
+    file_path: str = None
+    absolute: bool = False
+    block_size: int = DEFAULT_BLOCK_SIZE
+    delta: list = field(default_factory=list)
+    size: int = None
+    checksum: int = None
+    mtime_ns: int = None
+    digest: str = None
+    not_modified: bool = False
+
+    def run(self, client):
+        if self.file_path is None or self.not_modified:
+            return
+
+        local_path = client.workspace.local_path(self.file_path, self.absolute)
+        with map_file(local_path) as basis, AtomicFileWriter(local_path) as writer:
+            apply_delta(basis, self.delta, self.block_size, writer.write)
+            writer.commit(self.size, self.checksum)
+
+
+@dataclass
+class GetFileDeltaRequest(Request):
+    """
+    Re-fetches a file that already has a local copy by sending only the changes
+
+    The client sends the signature of its copy and the server replies with a
+    `FileDeltaResponse` made of copy instructions for the blocks the client already
+    has and literal bytes for everything else.
+
+    Args:
+        file_path: path of the file relative to the workspace, or an absolute path
+        absolute: whether file_path is absolute
+        block_size: the size of each signed block
+        weak: the rolling checksum of each block of the local copy
+        strong: the concatenated strong hashes of the blocks of the local copy
+        validator: the validator of the client's cached copy. If the file has not
+            changed since, no delta is computed
+    """
+
+    file_path: str
+    absolute: bool = False
+    block_size: int = DEFAULT_BLOCK_SIZE
+    weak: List[int] = field(default_factory=list)
+    strong: bytes = b""
+    validator: list = None
+
+    execution = Execution.cpu
+
+    @staticmethod
+    def from_local(client, file_path: str, absolute: bool = False, validator=None):
+        """
+        Creates a request carrying the signature of the local copy of a file
+        """
+        local_path = client.workspace.local_path(file_path, absolute)
+        with map_file(local_path) as m:
+            signature = FileSignature.compute(m)
+
+        return GetFileDeltaRequest(
+            file_path,
+            absolute,
+            signature.block_size,
+            signature.weak,
+            signature.strong,
+            validator,
+        )
+
+    def run(self, daemon):
+        daemon.logger.debug(f"Getting delta of file {self.file_path}")
+
+        file_path = daemon.workspace.remote_path(self.file_path, self.absolute)
+        if not file_path.is_file():
+            return FileDeltaResponse()
+
+        stat = file_path.stat()
+        if is_not_modified(self.validator, file_path, stat):
+            daemon.logger.debug(f"File {self.file_path} not modified")
+            return FileDeltaResponse(
+                self.file_path,
+                self.absolute,
+                size=stat.st_size,
+                mtime_ns=stat.st_mtime_ns,
+                digest=self.validator[2],
+                not_modified=True,
+            )
+
+        signature = FileSignature(self.block_size, self.weak, self.strong)
+        with map_file(file_path) as m:
+            delta = compute_delta(signature, m)
+            size = len(m)
+            checksum = zlib.crc32(m)
+            digest = content_digest(m)
+
+        return FileDeltaResponse(
+            self.file_path,
+            self.absolute,
+            self.block_size,
+            delta,
+            size,
+            checksum,
+            stat.st_mtime_ns,
+            digest,
+        )
 
 
 @dataclass
 class SendFileResponse(Response):
+    """
+    Args:
+        success: whether the file was written
+        error: the reason the file could not be written
+        mtime_ns: the modification time of the written file
+    """
+
     success: bool
+    error: str = None
+    mtime_ns: int = None
 
 
 @dataclass
 class SendFileRequest(Request):
+    """
+    Writes a file on the server
+
+    The file is either sent in full or as a delta against the server's copy, computed
+    from a `FileSignatureResponse`. Either way the new contents are written to a
+    temporary file and only moved into place once the checksum has been verified.
+
+    Args:
+        file_path: path of the file relative to the workspace, or an absolute path
+        absolute: whether file_path is absolute
+        file_contents: the full contents of the file. None when sending a delta
+        block_size: the block size of the signature the delta was computed against
+        delta: the instructions returned by `compute_delta`. None when sending the
+            full contents
+        size: the size of the new file in bytes
+        checksum: crc32 checksum of the new file
+    """
+
+    file_path: str
+    absolute: bool = False
+    file_contents: bytes = None
+    block_size: int = DEFAULT_BLOCK_SIZE
+    delta: list = None
+    size: int = None
+    checksum: int = None
+
+    @staticmethod
+    def from_local(client, file_path: str, absolute: bool = False, signature=None):
+        """
+        Creates a request from the local copy of a file
+
+        Args:
+            client: the client whose workspace to read from
+            file_path: path of the file relative to the workspace, or an absolute path
+            absolute: whether file_path is absolute
+            signature: the signature of the server's copy. If None the full contents
+                are sent
+        """
+        local_path = client.workspace.local_path(file_path, absolute)
+        with map_file(local_path) as m:
+            size = len(m)
+            checksum = zlib.crc32(m)
+            if signature is None:
+                return SendFileRequest(
+                    file_path, absolute, bytes(m), size=size, checksum=checksum
+                )
+
+            delta = compute_delta(signature, m)
+
+        return SendFileRequest(
+            file_path,
+            absolute,
+            block_size=signature.block_size,
+            delta=delta,
+            size=size,
+            checksum=checksum,
+        )
+
     def run(self, daemon):
-        # daemon.logger.debug("Running Terminate Request")
-        # daemon.finish.set()
-        return ClientTerminateResponse(True)
+        daemon.logger.debug(f"Sending file {self.file_path}")
+
+        file_path = daemon.workspace.remote_path(self.file_path, self.absolute)
+        try:
+            with AtomicFileWriter(file_path) as writer:
+                if self.delta is None:
+                    writer.write(self.file_contents)
+                else:
+                    with map_file(file_path) as basis:
+                        apply_delta(basis, self.delta, self.block_size, writer.write)
+
+                writer.commit(self.size, self.checksum)
+        except (OSError, ValueError) as e:
+            daemon.logger.error(f"Failed to write {self.file_path}: {e}")
+            return SendFileResponse(False, str(e))
+
+        return SendFileResponse(True, mtime_ns=file_path.stat().st_mtime_ns)
 
 
-MessageTypeRegistry.register(GetFileRequest)
-MessageTypeRegistry.register(GetFileResponse)
-MessageTypeRegistry.register(SendFileRequest)
-MessageTypeRegistry.register(SendFileResponse)
+MessageTypeRegistry.register(GetFileRequest, 30)
+MessageTypeRegistry.register(GetFileResponse, 31)
+MessageTypeRegistry.register(FileChunk, 32)
+MessageTypeRegistry.register(GetFileRangeRequest, 33)
+MessageTypeRegistry.register(GetFileRangeResponse, 34)
+MessageTypeRegistry.register(FileSignatureRequest, 35)
+MessageTypeRegistry.register(FileSignatureResponse, 36)
+MessageTypeRegistry.register(GetFileDeltaRequest, 37)
+MessageTypeRegistry.register(FileDeltaResponse, 38)
+MessageTypeRegistry.register(SendFileRequest, 39)
+MessageTypeRegistry.register(SendFileResponse, 40)
@@ -0,0 +1,53 @@
+from dataclasses import dataclass, field
+from typing import List
+
+from .message import Request, Response
+from .registry import MessageTypeRegistry
+
+
+@dataclass
+class FuzzyFindResponse(Response):
+    """
+    Args:
+        query: the query that was matched
+        num_candidates: the number of paths that matched the query
+        matches: the best matches as [path, score, positions] lists, from best to
+            worst. positions are the indexes of the matched characters in path
+    """
+
+    query: str
+    num_candidates: int = 0
+    matches: List[list] = field(default_factory=list)
+
+
+@dataclass
+class FuzzyFindRequest(Request):
+    """
+    Fuzzy matches a query against the files in the project
+
+    Paths are matched on the server against its `ProjectIndex`, so only the best k
+    matches are sent back. Completing a path keystroke by keystroke is cheap as
+    each query reuses the candidates of the query it extends.
+
+    Args:
+        query: the characters to match, in order. Case and spaces are ignored
+        k: the number of matches to return
+    """
+
+    query: str
+    k: int = 20
+
+    def run(self, daemon):
+        daemon.project_index.start(daemon.finish.is_set)
+
+        num_candidates, matches = daemon.fuzzy_finder.find(self.query, self.k)
+        daemon.logger.debug(
+            f"Fuzzy query {self.query!r} matched {num_candidates} files"
+        )
+        return FuzzyFindResponse(
+            self.query, num_candidates, [list(match) for match in matches]
+        )
+
+
+MessageTypeRegistry.register(FuzzyFindRequest, 52)
+MessageTypeRegistry.register(FuzzyFindResponse, 53)
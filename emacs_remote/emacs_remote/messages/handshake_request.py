@@ -0,0 +1,192 @@
+from dataclasses import asdict, dataclass, field, fields
+from typing import Dict, List
+
+from ..utils.compression import available_codecs, negotiate_codecs
+from .compression_request import HANDSHAKE_PROBE, CompressionRequest
+from .message import Execution, Request, Response
+from .registry import MessageTypeRegistry
+
+# Version 1 negotiated codecs with CompressionRequest and nothing else
+PROTOCOL_VERSION = 2
+MIN_PROTOCOL_VERSION = 1
+
+# Frame level features
+# streams: responses streamed over multiple frames with credit based flow control
+# buffers: big bytes fields sent after the packed message, see FLAG_BUFFERS
+FEATURES = ["streams", "buffers"]
+
+DEFAULT_MAX_FRAME_SIZE = 1024 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass
+class Capabilities:
+    """
+    What one end of a connection supports, or what both ends agreed on
+
+    Sent as a dict so that newer versions can add keys that older peers ignore.
+
+    Args:
+        version: the protocol version
+        codecs: the compression codecs in order of preference
+        max_frame_size: the size in bytes of the largest payload accepted
+        chunk_size: the preferred size in bytes of the chunks of a streamed file
+        features: the supported frame level features, see FEATURES
+        message_types: message type ids keyed by type name. None if unknown, in
+            which case the peer is assumed to know every type
+    """
+
+    version: int = PROTOCOL_VERSION
+    codecs: List[str] = field(default_factory=available_codecs)
+    max_frame_size: int = DEFAULT_MAX_FRAME_SIZE
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+    features: List[str] = field(default_factory=lambda: list(FEATURES))
+    message_types: Dict[str, int] = field(default_factory=MessageTypeRegistry.table)
+
+    @staticmethod
+    def legacy(codecs: List[str] = None):
+        """
+        Capabilities of a peer that predates the handshake
+        """
+        return Capabilities(
+            version=1,
+            codecs=["zlib"] if codecs is None else codecs,
+            features=["streams"],
+            message_types=None,
+        )
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    @staticmethod
+    def from_dict(data: dict):
+        names = {f.name for f in fields(Capabilities)}
+        return Capabilities(**{k: v for k, v in data.items() if k in names})
+
+    def negotiate(self, peer, initiator: bool):
+        """
+        Agrees on how to talk to the peer
+
+        Args:
+            peer: the capabilities the peer sent
+            initiator: whether this end's codec preferences win
+        Returns:
+            The capabilities to use when sending to the peer
+        Raises:
+            ValueError: if the peer's protocol version is too old or its message
+                type ids clash with the local ones
+        """
+        if peer.version < MIN_PROTOCOL_VERSION:
+            raise ValueError(
+                f"Peer protocol version {peer.version} is older than the oldest "
+                f"supported version {MIN_PROTOCOL_VERSION}"
+            )
+
+        if peer.message_types is not None:
+            clashes = [
+                name
+                for name, type_id in peer.message_types.items()
+                if self.message_types.get(name, type_id) != type_id
+            ]
+            if clashes:
+                raise ValueError(f"Peer uses different ids for: {', '.join(clashes)}")
+
+        if initiator:
+            codecs = negotiate_codecs(self.codecs, peer.codecs)
+        else:
+            codecs = negotiate_codecs(peer.codecs, self.codecs)
+
+        return Capabilities(
+            version=min(self.version, peer.version),
+            codecs=codecs,
+            max_frame_size=peer.max_frame_size,
+            chunk_size=min(self.chunk_size, peer.chunk_size),
+            features=[name for name in self.features if name in peer.features],
+            message_types=peer.message_types,
+        )
+
+    def has(self, feature: str) -> bool:
+        return feature in self.features
+
+    def supports(self, message_type: type) -> bool:
+        """
+        Returns whether the peer knows a message type
+        """
+        if self.message_types is None:
+            return True
+
+        return self.message_types.get(message_type.__name__) == (
+            MessageTypeRegistry.get_index(message_type)
+        )
+
+
+@dataclass
+class HandshakeResponse(Response):
+    """
+    Args:
+        capabilities: the server's `Capabilities` as a dict
+        error: why the handshake was refused, if it was
+    """
+
+    capabilities: dict
+    error: str = None
+
+
+@dataclass
+class HandshakeRequest(Request):
+    """
+    Sent right after connecting to exchange versions and capabilities
+
+    Each end then sends with what the other end supports. Servers that predate
+    the handshake drop the connection on it, so clients first send a
+    `CompressionRequest` with HANDSHAKE_PROBE, which every server answers, and
+    only follow up with the handshake if the server lists the probe back. Servers
+    still answer the plain `CompressionRequest` of clients that predate the
+    handshake.
+
+    Args:
+        capabilities: the client's `Capabilities` as a dict
+    """
+
+    capabilities: dict
+
+    execution = Execution.inline
+
+    def run(self, daemon):
+        # The first one is answered by the connection, which knows its own limits
+        return HandshakeResponse({}, error="Handshake already completed")
+
+
+def is_handshake_probe(request) -> bool:
+    """
+    Returns whether the first message sent on a connection announces a handshake
+    """
+    return isinstance(request, CompressionRequest) and HANDSHAKE_PROBE in (
+        request.codecs
+    )
+
+
+def accept_handshake(request, local: Capabilities):
+    """
+    Answers the first message sent on a connection
+
+    Args:
+        request: the HandshakeRequest, or the CompressionRequest of an old client
+        local: the capabilities of this end
+    Returns:
+        A (response, capabilities) tuple. capabilities are the ones to use when
+        sending to the peer
+    """
+    if isinstance(request, CompressionRequest):
+        response = request.run(None)
+        return response, Capabilities.legacy(response.codecs)
+
+    if not isinstance(request, HandshakeRequest):
+        raise TypeError(f"Expected type HandshakeRequest. Got: {type(request)}")
+
+    peer = Capabilities.from_dict(request.capabilities)
+    return HandshakeResponse(local.to_dict()), local.negotiate(peer, initiator=False)
+
+
+MessageTypeRegistry.register(HandshakeRequest, 8)
+MessageTypeRegistry.register(HandshakeResponse, 9)
@@ -0,0 +1,90 @@
+from dataclasses import dataclass
+
+from ..utils.dir_listing import DirListing, LocalListingCache
+from .message import Request, Response
+from .registry import MessageTypeRegistry
+
+
+@dataclass
+class ListDirResponse(Response):
+    """
+    The entries of a directory, in the columnar encoding of a `DirListing`
+
+    Args:
+        file_path: the directory that was listed
+        absolute: whether file_path is absolute
+        error: why the directory couldn't be listed. None if it was listed
+        not_modified: whether the listing matches the validator of the request, in
+            which case no entries are sent
+        mtime_ns, names, kinds, sizes, mtimes: see `DirListing`
+    """
+
+    file_path: str
+    absolute: bool = False
+    error: str = None
+    not_modified: bool = False
+    mtime_ns: int = 0
+    names: bytes = b""
+    kinds: bytes = b""
+    sizes: bytes = b""
+    mtimes: bytes = b""
+
+    @property
+    def listing(self) -> DirListing:
+        return DirListing(
+            self.mtime_ns, self.names, self.kinds, self.sizes, self.mtimes
+        )
+
+
+@dataclass
+class ListDirRequest(Request):
+    """
+    Lists a directory on the server
+
+    The server keeps recent listings (see `ListingCache`). Sent to the client
+    daemon instead, the listing comes from the daemon's own `LocalListingCache`,
+    which only goes to the server on a miss and prefetches the subdirectories in
+    the background so that completing the next path component is instant.
+
+    Args:
+        file_path: path of the directory relative to the workspace, or an absolute
+            path
+        absolute: whether file_path is absolute
+        prefetch: whether the client daemon should prefetch the subdirectories
+        validator: the digest of a listing the sender already has. If the listing
+            still matches, no entries are sent back
+    """
+
+    file_path: str
+    absolute: bool = False
+    prefetch: bool = True
+    validator: str = None
+
+    def run(self, daemon):
+        path = str(daemon.workspace.remote_path(self.file_path, self.absolute))
+        try:
+            if isinstance(daemon.dir_listings, LocalListingCache):
+                listing = daemon.dir_listings.get(path, self.prefetch)
+            else:
+                listing = daemon.dir_listings.get(path)
+        except OSError as e:
+            return ListDirResponse(self.file_path, self.absolute, str(e))
+
+        if self.validator is not None and listing.digest() == self.validator:
+            return ListDirResponse(self.file_path, self.absolute, not_modified=True)
+
+        return ListDirResponse(
+            self.file_path,
+            self.absolute,
+            None,
+            False,
+            listing.mtime_ns,
+            listing.names,
+            listing.kinds,
+            listing.sizes,
+            listing.mtimes,
+        )
+
+
+MessageTypeRegistry.register(ListDirRequest, 48)
+MessageTypeRegistry.register(ListDirResponse, 49)
@@ -1,4 +1,37 @@
 import abc
+from enum import Enum
+
+
+class Execution(Enum):
+    """
+    Where the server runs a request
+
+    inline: on the thread that received it. Only for requests that return instantly
+    io: on the thread pool. For requests that mostly wait on disk or subprocesses
+    cpu: on the process pool. For requests that are bound by computation
+    control: by the connection it arrived on, against the requests in flight on
+        that connection. For flow control and cancellation. There is no response
+    watch: on a thread pool of its own. For requests that wait on changes for as
+        long as the client wants, so they never hold up io bound requests
+    """
+
+    inline = 0
+    io = 1
+    cpu = 2
+    control = 3
+    watch = 4
+
+
+class Priority(Enum):
+    """
+    How urgently the client needs the response to a request
+
+    interactive: someone is waiting on it, e.g. opening a file or completing a path
+    bulk: large transfers and background work, e.g. searches and index builds
+    """
+
+    interactive = 0
+    bulk = 1
 
 
 class Response(abc.ABC):
@@ -7,6 +40,9 @@ class Response(abc.ABC):
 
 
 class Request(abc.ABC):
+    execution = Execution.io
+    priority = Priority.interactive
+
     @abc.abstractmethod
     def run(self, daemon) -> Response:
         pass
@@ -1,8 +1,11 @@
 from dataclasses import dataclass
 
-from .message import Request, Response
+from .message import Execution, Priority, Request, Response
 from .registry import MessageTypeRegistry
 
+# Seconds to wait for the client daemon to connect to the server
+CONNECT_TIMEOUT = 60
+
 
 @dataclass
 class PortResponse(Response):
@@ -11,12 +14,28 @@ class PortResponse(Response):
 
 @dataclass
 class PortRequest(Request):
-    file_path: str
-    absolute: bool = False
+    """
+    Asks the client daemon for a port to connect to the server on
+
+    The port is the daemon's `RequestRelay`, which sends each request on the least
+    loaded of its connections to the server, see `RequestScheduler`. Answered once
+    the daemon is connected to the server.
+
+    Args:
+        bulk: whether the connection will be used for bulk requests
+    """
+
+    bulk: bool = False
+
+    execution = Execution.inline
 
     def run(self, daemon: "ClientDaemon"):
-        return PortResponse(daemon.server.next_client_port())
+        if not daemon.connected.wait(CONNECT_TIMEOUT):
+            raise ConnectionError("The client daemon isn't connected to the server")
+
+        priority = Priority.bulk if self.bulk else Priority.interactive
+        return PortResponse(str(daemon.relay.ports[priority]))
 
 
-MessageTypeRegistry.register(PortRequest)
-MessageTypeRegistry.register(PortResponse)
+MessageTypeRegistry.register(PortRequest, 16)
+MessageTypeRegistry.register(PortResponse, 17)
@@ -0,0 +1,34 @@
+from dataclasses import dataclass
+
+from .message import Execution, Request, Response
+from .registry import MessageTypeRegistry
+
+
+@dataclass
+class PrefetchResponse(Response):
+    pass
+
+
+@dataclass
+class PrefetchRequest(Request):
+    """
+    Tells the client daemon that a file was opened
+
+    The daemon's `Prefetcher` then fetches the files likely to be opened next into
+    the local mirror in the background.
+
+    Args:
+        file_path: path of the opened file relative to the workspace
+    """
+
+    file_path: str
+
+    execution = Execution.inline
+
+    def run(self, daemon):
+        daemon.prefetcher.opened(self.file_path)
+        return PrefetchResponse()
+
+
+MessageTypeRegistry.register(PrefetchRequest, 62)
+MessageTypeRegistry.register(PrefetchResponse, 63)
@@ -0,0 +1,81 @@
+from dataclasses import dataclass
+from typing import List
+
+from ..utils.project_index import decode_blocks
+from .message import Priority, Request, Response
+from .registry import MessageTypeRegistry
+
+
+@dataclass
+class ProjectIndexResponse(Response):
+    """
+    Either a full snapshot of the project index or the changes since a generation
+
+    Args:
+        index_id: identifies the build of the index the generation belongs to
+        generation: the generation of the index
+        count: the number of files in the index
+        blocks: the front coded blocks of a snapshot. None if this is a delta
+        added: the paths added since the requested generation. None for snapshots
+        removed: the paths removed since the requested generation. None for
+            snapshots
+    """
+
+    index_id: str
+    generation: int
+    count: int
+    blocks: List[list] = None
+    added: List[bytes] = None
+    removed: List[bytes] = None
+
+    @property
+    def is_snapshot(self):
+        return self.blocks is not None
+
+    def paths(self) -> List[bytes]:
+        """
+        Decodes the paths of a snapshot
+        """
+        return decode_blocks(self.blocks)
+
+
+@dataclass
+class ProjectIndexRequest(Request):
+    """
+    Gets the list of files in the project that aren't ignored by .gitignore
+
+    The index is kept in memory by the server and updated as files change. If the
+    client already has a copy of the index, only the changes since its generation
+    are sent. A full snapshot is sent when the changes are no longer known.
+
+    Args:
+        index_id: the index_id of the client's copy. None if there is no copy
+        generation: the generation of the client's copy
+    """
+
+    index_id: str = None
+    generation: int = 0
+
+    priority = Priority.bulk
+
+    def run(self, daemon):
+        index = daemon.project_index
+        index.start(daemon.finish.is_set)
+
+        if self.index_id is not None:
+            changes = index.changes_since(self.index_id, self.generation)
+            if changes is not None:
+                daemon.logger.debug(
+                    f"Sending project index changes since {self.generation}"
+                )
+                generation, count, added, removed = changes
+                return ProjectIndexResponse(
+                    self.index_id, generation, count, None, added, removed
+                )
+
+        daemon.logger.debug("Sending project index snapshot")
+        return ProjectIndexResponse(*index.snapshot())
+
+
+MessageTypeRegistry.register(ProjectIndexRequest, 65)
+MessageTypeRegistry.register(ProjectIndexResponse, 66)
@@ -1,50 +1,111 @@
 #!/usr/bin/env python3
-from collections import OrderedDict
 from dataclasses import is_dataclass
 
+from .codec import MessageCodec
+
+# Type ids are sent in a single byte of the frame header
+MAX_TYPE_ID = 127
+
 
 class MessageTypeRegistry:
-    registered_types = []
+    """
+    Maps message types to the ids they are sent with
+
+    Every type is registered with an explicit id, so both ends agree on the ids
+    no matter which modules they import or in which order. Ids must never be
+    reused for a different type.
+    """
+
+    registered_types = {}
     type_dict = {}
+    codecs = {}
 
     @staticmethod
-    def register(type):
-        if type not in MessageTypeRegistry.type_dict:
-            if not is_dataclass(type) and type not in (str, list, tuple, dict):
-                raise TypeError(
-                    "Expected data to be one of [str, list, tuple, dict, dataclass]. "
-                    f"Got {type(data)}"
+    def register(type, type_id: int):
+        if type in MessageTypeRegistry.type_dict:
+            if MessageTypeRegistry.type_dict[type] != type_id:
+                raise ValueError(
+                    f"{type.__name__} is already registered with id "
+                    f"{MessageTypeRegistry.type_dict[type]}"
                 )
+            return
+
+        if not is_dataclass(type) and type not in (str, list, tuple, dict):
+            raise TypeError(
+                "Expected data to be one of [str, list, tuple, dict, dataclass]. "
+                f"Got {type}"
+            )
+
+        if not 0 <= type_id <= MAX_TYPE_ID:
+            raise ValueError(f"Type id {type_id} is not in [0, {MAX_TYPE_ID}]")
 
-            MessageTypeRegistry.type_dict[type] = len(
-                MessageTypeRegistry.registered_types
+        if type_id in MessageTypeRegistry.registered_types:
+            raise ValueError(
+                f"Type id {type_id} is already used by "
+                f"{MessageTypeRegistry.registered_types[type_id].__name__}"
             )
-            MessageTypeRegistry.registered_types.append(type)
+
+        codec = MessageCodec(type, type_id)
+        MessageTypeRegistry.type_dict[type] = type_id
+        MessageTypeRegistry.registered_types[type_id] = type
+        MessageTypeRegistry.codecs[type] = codec
+        MessageTypeRegistry.codecs[type_id] = codec
+
+    @staticmethod
+    def get_codec(type_or_id) -> MessageCodec:
+        """
+        Returns the codec of a registered type, looked up by type or by id
+
+        Raises:
+            KeyError: if the type is not registered
+        """
+        return MessageTypeRegistry.codecs[type_or_id]
 
     @staticmethod
     def get_type(index: int, data=None):
-        assert isinstance(index, int) and (
-            0 <= index < len(MessageTypeRegistry.registered_types)
-        )
         _type = MessageTypeRegistry.registered_types[index]
 
         if data is None:
             return _type
-        elif isinstance(data, (list, tuple)):
-            return _type(*data)
         elif isinstance(data, dict):
-            return _type(**data)
+            return MessageTypeRegistry.codecs[index].decode(data)
+        elif isinstance(data, (list, tuple)):
+            return MessageTypeRegistry.codecs[index].decode(list(data))
         else:
             return TypeError(
                 "Expected list, tuple or dict for data. " f"Got: {type(data)}"
             )
 
+    @staticmethod
+    def table() -> dict:
+        """
+        Returns the ids of the registered types keyed by type name
+        """
+        return {
+            type.__name__: type_id
+            for type_id, type in MessageTypeRegistry.registered_types.items()
+        }
+
     @staticmethod
     def get_index(type):
         return MessageTypeRegistry.type_dict[type]
 
+    @staticmethod
+    def pack(message) -> list:
+        """
+        Packs a message so that it can be nested inside another message
+
+        Returns:
+            A [type id, fields] list. Use `unpack` to get the message back
+        """
+        codec = MessageTypeRegistry.codecs[type(message)]
+        return [codec.type_id, codec.encode(message)]
+
+    @staticmethod
+    def unpack(data):
+        return MessageTypeRegistry.codecs[data[0]].decode(data[1])
+
 
-MessageTypeRegistry.register(str)
-MessageTypeRegistry.register(list)
-MessageTypeRegistry.register(dict)
-MessageTypeRegistry.register(list)
+MessageTypeRegistry.register(str, 0)
+MessageTypeRegistry.register(list, 1)
+MessageTypeRegistry.register(dict, 2)
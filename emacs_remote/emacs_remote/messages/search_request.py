@@ -0,0 +1,275 @@
+import mmap
+import os
+import re
+import sys
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import List
+
+from ..utils.cancel import current_token
+from ..utils.gitignore import translate_glob
+from .message import Priority, Request, Response
+from .registry import MessageTypeRegistry
+
+# Files with a NUL byte in their first block are treated as binary and skipped
+_BINARY_CHECK_SIZE = 8192
+
+
+@lru_cache(maxsize=16)
+def _compile(pattern: str, regex: bool, ignore_case: bool):
+    if not regex:
+        pattern = re.escape(pattern)
+
+    flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+    return re.compile(pattern.encode("utf-8"), flags)
+
+
+def search_files(
+    root: str,
+    paths: List[str],
+    pattern: str,
+    regex: bool,
+    ignore_case: bool,
+    max_results: int,
+    max_line_length: int,
+):
+    """
+    Searches files for a pattern. Runs in the worker processes
+
+    Every file is mapped into memory and searched with a single regex scan, so only
+    the lines that match are ever decoded.
+
+    Returns:
+        A list of [path, line, column, text] matches, one per matching line
+    """
+    compiled = _compile(pattern, regex, ignore_case)
+
+    results = []
+    for path in paths:
+        try:
+            with open(os.path.join(root, path), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    continue
+
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    if m.find(b"\0", 0, _BINARY_CHECK_SIZE) != -1:
+                        continue
+
+                    line = 1
+                    counted = 0
+                    position = 0
+                    while len(results) < max_results:
+                        match = compiled.search(m, position)
+                        if match is None:
+                            break
+
+                        start = match.start()
+                        line_start = m.rfind(b"\n", 0, start) + 1
+                        line_end = m.find(b"\n", start)
+                        if line_end == -1:
+                            line_end = len(m)
+
+                        # mmap has no count, but only the gap since the last
+                        # match is copied
+                        line += m[counted:line_start].count(b"\n")
+                        counted = line_start
+
+                        text = m[
+                            line_start : min(line_end, line_start + max_line_length)
+                        ]
+                        results.append(
+                            [
+                                path,
+                                line,
+                                start - line_start,
+                                text.decode("utf-8", errors="replace"),
+                            ]
+                        )
+                        # Only the first match on each line is reported
+                        position = line_end + 1
+        except (OSError, ValueError):
+            continue
+
+        if len(results) >= max_results:
+            break
+
+    return results
+
+
+def _glob_regex(globs: List[str]):
+    """
+    Combines globs into one regex. Like in .gitignore, globs without a slash match
+    the basename and a glob matching a directory matches everything in it
+    """
+    if not globs:
+        return None
+
+    parts = []
+    for glob in globs:
+        glob = glob.strip("/")
+        regex = translate_glob(glob)
+        if "/" not in glob:
+            regex = "(?:.*/)?" + regex
+        parts.append(f"{regex}(?:/|\\Z)")
+
+    return re.compile("|".join(parts))
+
+
+@dataclass
+class SearchMatches(Response):
+    """
+    A batch of matches found by a `SearchRequest`
+
+    Args:
+        matches: [path, line, column, text] lists. line is 1-based and column is the
+            byte offset of the match in the line
+    """
+
+    matches: List[list] = field(default_factory=list)
+
+    def run(self, client):
+        for path, line, column, text in self.matches:
+            sys.stdout.write(f"{path}:{line}:{column + 1}:{text}\n")
+        sys.stdout.flush()
+
+
+@dataclass
+class SearchDone(Response):
+    """
+    Args:
+        num_results: the number of matches sent
+        files_searched: the number of files that were searched
+        truncated: whether the search stopped early because of the result cap
+    """
+
+    num_results: int = 0
+    files_searched: int = 0
+    truncated: bool = False
+
+
+@dataclass
+class SearchRequest(Request):
+    """
+    Searches the contents of the files in the project
+
+    The files of the server's `ProjectIndex` (so files ignored by .gitignore are
+    skipped) are split into chunks that are searched in parallel on the process
+    pool. Matches are streamed back in `SearchMatches` batches as soon as each chunk
+    is done, followed by a `SearchDone`. The first chunks are small so that the
+    first matches come back quickly. Closing the stream cancels the chunks that have
+    not started yet.
+
+    Args:
+        pattern: the text or regex to search for
+        regex: whether pattern is a regex. Otherwise it is matched literally
+        ignore_case: whether to ignore case
+        include: globs of the files to search. All files if None
+        exclude: globs of the files to skip
+        max_results: the search stops after this many matches
+        chunk_size: the maximum number of files searched by a worker at once
+        max_line_length: matched lines are cut to this many bytes
+    """
+
+    pattern: str
+    regex: bool = False
+    ignore_case: bool = False
+    include: List[str] = None
+    exclude: List[str] = None
+    max_results: int = 1000
+    chunk_size: int = 256
+    max_line_length: int = 512
+
+    priority = Priority.bulk
+
+    def run(self, daemon):
+        # Fail before streaming starts if the pattern is invalid
+        _compile(self.pattern, self.regex, self.ignore_case)
+
+        daemon.project_index.start(daemon.finish.is_set)
+        paths = [os.fsdecode(path) for path in daemon.project_index.paths()]
+
+        include, exclude = _glob_regex(self.include), _glob_regex(self.exclude)
+        if include is not None:
+            paths = [path for path in paths if include.match(path)]
+        if exclude is not None:
+            paths = [path for path in paths if not exclude.match(path)]
+
+        daemon.logger.debug(f"Searching {len(paths)} files for {self.pattern!r}")
+        return self.run_search(daemon, paths)
+
+    def chunks(self, paths: List[str]):
+        # Start small so that the first results come back fast, then grow the
+        # chunks to cut down on the overhead of each one
+        size, start = 8, 0
+        while start < len(paths):
+            yield paths[start : start + size]
+            start += size
+            size = min(size * 2, self.chunk_size)
+
+    def run_search(self, daemon, paths: List[str]):
+        pool = daemon.executor.get_process_pool()
+        max_pending = 2 * daemon.executor.cpu_workers
+        root = str(daemon.workspace.workspace)
+
+        chunks = self.chunks(paths)
+        pending = {}
+        num_results = 0
+        files_searched = 0
+
+        # Wakes up the wait for the workers as soon as the request is cancelled
+        token = current_token()
+        cancelled = Future()
+
+        def wake():
+            cancelled.set_result(None)
+
+        token.add_callback(wake)
+        try:
+            while True:
+                while len(pending) < max_pending:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+
+                    future = pool.submit(
+                        search_files,
+                        root,
+                        chunk,
+                        self.pattern,
+                        self.regex,
+                        self.ignore_case,
+                        self.max_results - num_results,
+                        self.max_line_length,
+                    )
+                    pending[future] = len(chunk)
+
+                if not pending:
+                    break
+
+                done, _ = wait([cancelled, *pending], return_when=FIRST_COMPLETED)
+                token.check()
+
+                matches = []
+                for future in done:
+                    files_searched += pending.pop(future)
+                    matches.extend(future.result())
+
+                matches = matches[: self.max_results - num_results]
+                if matches:
+                    num_results += len(matches)
+                    yield SearchMatches(matches)
+
+                if num_results >= self.max_results:
+                    return SearchDone(num_results, files_searched, True)
+
+            return SearchDone(num_results, files_searched, False)
+        finally:
+            token.remove_callback(wake)
+            for future in pending:
+                future.cancel()
+
+
+MessageTypeRegistry.register(SearchRequest, 55)
+MessageTypeRegistry.register(SearchMatches, 56)
+MessageTypeRegistry.register(SearchDone, 57)
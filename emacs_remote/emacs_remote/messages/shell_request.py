@@ -1,27 +1,93 @@
 #!/usr/bin/env python3
 
+import os
+import selectors
 import subprocess
+import sys
 from dataclasses import dataclass
 from typing import List
 
+from ..utils.cancel import current_token
 from .message import Request, Response
 from .registry import MessageTypeRegistry
 
 
 @dataclass
 class ShellRequest(Request):
+    """
+    Runs a command on the server
+
+    The command is killed if the request is cancelled.
+
+    Args:
+        cmd: the command to run
+        stream: if True, the output is streamed back in `ShellOutputChunk` messages
+            as it is produced, followed by a `ShellExitStatus`. Otherwise a single
+            `ShellResponse` is sent once the command exits
+        chunk_size: the maximum number of bytes in each streamed chunk
+    """
+
     cmd: List[str]
+    stream: bool = False
+    chunk_size: int = 64 * 1024
 
     def run(self, daemon):
-        p = subprocess.run(
+        if self.stream:
+            return self.run_streaming(daemon)
+
+        token = current_token()
+        p = subprocess.Popen(
             self.cmd,
+            stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
         )
+        token.add_callback(p.kill)
+        try:
+            stdout, stderr = p.communicate()
+        finally:
+            token.remove_callback(p.kill)
 
+        token.check()
         return ShellResponse(
-            p.returncode, p.stdout.decode("utf-8"), p.stderr.decode("utf-8")
+            p.returncode, stdout.decode("utf-8"), stderr.decode("utf-8")
+        )
+
+    def run_streaming(self, daemon):
+        p = subprocess.Popen(
+            self.cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
         )
+        # The stream may be parked or waiting on output when it is cancelled
+        token = current_token()
+        token.add_callback(p.kill)
+
+        # Only one chunk is held at a time. The process blocks on a full pipe while
+        # the previous chunk is being sent, so output never builds up in memory
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(p.stdout, selectors.EVENT_READ, "stdout")
+                selector.register(p.stderr, selectors.EVENT_READ, "stderr")
+
+                while selector.get_map():
+                    for key, _ in selector.select():
+                        data = os.read(key.fileobj.fileno(), self.chunk_size)
+                        if not data:
+                            selector.unregister(key.fileobj)
+                            key.fileobj.close()
+                            continue
+
+                        yield ShellOutputChunk(key.data, data)
+
+            return ShellExitStatus(p.wait())
+        finally:
+            token.remove_callback(p.kill)
+            # The stream was abandoned before the process finished
+            if p.poll() is None:
+                p.kill()
+                p.wait()
 
 
 @dataclass
@@ -31,5 +97,31 @@ class ShellResponse(Response):
     stderr: str
 
 
-MessageTypeRegistry.register(ShellRequest)
-MessageTypeRegistry.register(ShellResponse)
+@dataclass
+class ShellOutputChunk(Response):
+    """
+    Part of the output of a streamed `ShellRequest`
+
+    Args:
+        stream: the name of the stream the output was written to (stdout or stderr)
+        data: the raw output. May end partway through a multi-byte character
+    """
+
+    stream: str
+    data: bytes
+
+    def run(self, client):
+        out = sys.stderr if self.stream == "stderr" else sys.stdout
+        out.buffer.write(self.data)
+        out.flush()
+
+
+@dataclass
+class ShellExitStatus(Response):
+    returncode: int
+
+
+MessageTypeRegistry.register(ShellRequest, 24)
+MessageTypeRegistry.register(ShellResponse, 25)
+MessageTypeRegistry.register(ShellOutputChunk, 26)
+MessageTypeRegistry.register(ShellExitStatus, 27)
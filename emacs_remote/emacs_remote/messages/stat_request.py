@@ -0,0 +1,60 @@
+import os
+import stat
+from dataclasses import dataclass
+
+from .message import Request, Response
+from .registry import MessageTypeRegistry
+
+
+@dataclass
+class StatResponse(Response):
+    """
+    Args:
+        file_path: the path that was checked
+        exists: whether the path exists
+        is_dir: whether the path is a directory
+        size: the size of the file in bytes
+        mtime_ns: the modification time of the file in nanoseconds
+        mode: the permission bits of the file
+    """
+
+    file_path: str
+    exists: bool = False
+    is_dir: bool = False
+    size: int = 0
+    mtime_ns: int = 0
+    mode: int = 0
+
+
+@dataclass
+class StatRequest(Request):
+    """
+    Checks whether a file exists on the server and gets its attributes
+
+    Args:
+        file_path: path of the file relative to the workspace, or an absolute path
+        absolute: whether file_path is absolute
+    """
+
+    file_path: str
+    absolute: bool = False
+
+    def run(self, daemon):
+        path = daemon.workspace.remote_path(self.file_path, self.absolute)
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return StatResponse(self.file_path)
+
+        return StatResponse(
+            self.file_path,
+            True,
+            stat.S_ISDIR(st.st_mode),
+            st.st_size,
+            st.st_mtime_ns,
+            stat.S_IMODE(st.st_mode),
+        )
+
+
+MessageTypeRegistry.register(StatRequest, 45)
+MessageTypeRegistry.register(StatResponse, 46)
@@ -0,0 +1,62 @@
+from dataclasses import dataclass, field
+from typing import List
+
+from .message import Request, Response
+from .registry import MessageTypeRegistry
+
+
+@dataclass
+class SymbolLookupResponse(Response):
+    """
+    Args:
+        symbols: [name, kind, path, line] lists. line is 1-based and kind is one of
+            function, class, type, variable or macro
+    """
+
+    symbols: List[list] = field(default_factory=list)
+
+
+@dataclass
+class SymbolLookupRequest(Request):
+    """
+    Looks up definitions in the server's `SymbolIndex`
+
+    Finds the definitions of a name for xref, the names starting with a prefix for
+    completion, or every definition in a file for imenu.
+
+    Args:
+        name: the name to look up. If file_path is set, only the definitions in the
+            file starting with name are returned
+        prefix: whether to return the definitions of every name starting with name
+        file_path: the file to list the definitions of, relative to the workspace
+        max_results: the maximum number of definitions to return
+    """
+
+    name: str = ""
+    prefix: bool = False
+    file_path: str = None
+    max_results: int = 100
+
+    def run(self, daemon):
+        daemon.project_index.start(daemon.finish.is_set)
+        daemon.symbol_index.start(
+            daemon.project_index, daemon.executor.get_process_pool()
+        )
+
+        if self.file_path is not None:
+            symbols = [
+                [name, kind, self.file_path, line]
+                for name, kind, line in daemon.symbol_index.file_symbols(self.file_path)
+                if name.startswith(self.name)
+            ][: self.max_results]
+        else:
+            symbols = daemon.symbol_index.lookup(
+                self.name, self.prefix, self.max_results
+            )
+
+        daemon.logger.debug(f"Found {len(symbols)} definitions of {self.name!r}")
+        return SymbolLookupResponse(symbols)
+
+
+MessageTypeRegistry.register(SymbolLookupRequest, 68)
+MessageTypeRegistry.register(SymbolLookupResponse, 69)
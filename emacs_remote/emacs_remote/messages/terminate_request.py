@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 
-from .message import Request, Response
+from .message import Execution, Request, Response
 from .registry import MessageTypeRegistry
 
 
@@ -11,6 +11,8 @@ class ServerTerminateResponse(Response):
 
 @dataclass
 class ServerTerminateRequest(Request):
+    execution = Execution.inline
+
     def run(self, daemon):
         daemon.logger.debug("Running Terminate Request")
         daemon.finish.set()
@@ -24,13 +26,15 @@ class ClientTerminateResponse(Response):
 
 @dataclass
 class ClientTerminateRequest(Request):
+    execution = Execution.inline
+
     def run(self, daemon):
         # daemon.logger.debug("Running Terminate Request")
         # daemon.finish.set()
         return ClientTerminateResponse(True)
 
 
-MessageTypeRegistry.register(ServerTerminateRequest)
-MessageTypeRegistry.register(ServerTerminateResponse)
-MessageTypeRegistry.register(ClientTerminateRequest)
-MessageTypeRegistry.register(ClientTerminateResponse)
+MessageTypeRegistry.register(ServerTerminateRequest, 20)
+MessageTypeRegistry.register(ServerTerminateResponse, 21)
+MessageTypeRegistry.register(ClientTerminateRequest, 22)
+MessageTypeRegistry.register(ClientTerminateResponse, 23)
@@ -0,0 +1,95 @@
+from dataclasses import dataclass, field
+from typing import List
+
+from ..utils.cancel import current_token
+from ..utils.watcher import DEFAULT_IGNORE, create_watcher
+from .message import Execution, Request, Response
+from .registry import MessageTypeRegistry
+
+
+@dataclass
+class FilesChangedNotification(Response):
+    """
+    A batch of files in the workspace that changed on the server
+
+    Args:
+        changed: paths relative to the workspace of files that were created or
+            modified
+        deleted: paths relative to the workspace of files that were deleted
+        overflow: whether changes were lost. If True, every file should be assumed
+            to have changed
+    """
+
+    changed: List[str] = field(default_factory=list)
+    deleted: List[str] = field(default_factory=list)
+    overflow: bool = False
+
+    def run(self, client):
+        if self.overflow:
+            client.file_cache.invalidate(everything=True)
+            client.dir_listings.invalidate(everything=True)
+        elif self.changed or self.deleted:
+            paths = self.changed + self.deleted
+            client.file_cache.invalidate(paths)
+            client.dir_listings.invalidate(
+                [str(client.workspace.remote_path(path)) for path in paths]
+            )
+
+
+@dataclass
+class WatchRequest(Request):
+    """
+    Watches the workspace for changes until the server shuts down
+
+    Changes are pushed back as a stream of `FilesChangedNotification` messages.
+    inotify is used where available, so watching costs nothing while files are
+    idle. Elsewhere the workspace is scanned every poll_interval seconds.
+
+    Args:
+        latency: seconds to collect changes for before sending them as one batch
+        max_batch: the maximum number of paths in a batch
+        poll_interval: seconds between scans when inotify is not available
+        heartbeat: seconds after which an empty notification is sent if nothing
+            changed, so that the watch ends once the client is gone
+        ignore: names of directories that are not watched. None for the default
+    """
+
+    latency: float = 0.2
+    max_batch: int = 1024
+    poll_interval: float = 1.0
+    heartbeat: float = 10
+    ignore: List[str] = None
+
+    execution = Execution.watch
+
+    def run(self, daemon):
+        daemon.logger.debug(f"Watching {daemon.workspace} for changes")
+
+        watcher = create_watcher(
+            daemon.workspace.workspace,
+            DEFAULT_IGNORE if self.ignore is None else self.ignore,
+            daemon.logger,
+            interval=self.poll_interval,
+        )
+        return self.run_watch(daemon, watcher)
+
+    def run_watch(self, daemon, watcher):
+        token = current_token()
+
+        def stopped():
+            return daemon.finish.is_set() or token.cancelled
+
+        with watcher:
+            batches = watcher.batches(
+                stopped, self.latency, self.max_batch, self.heartbeat
+            )
+            for changes in batches:
+                yield FilesChangedNotification(
+                    sorted(changes.changed), sorted(changes.deleted), changes.overflow
+                )
+
+        return FilesChangedNotification()
+
+
+MessageTypeRegistry.register(WatchRequest, 60)
+MessageTypeRegistry.register(FilesChangedNotification, 61)
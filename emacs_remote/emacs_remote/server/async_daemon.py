@@ -0,0 +1,303 @@
+import asyncio
+import os
+import socket
+import stat
+from functools import partial
+from threading import Event, Thread
+
+from ..messages import CancelledResponse, Request
+from ..messages.startup import SERVER_STARTUP_MSG
+from ..utils.async_socket import AsyncSecureSocket
+from ..utils.compression import CompressionPolicy
+from ..utils.dir_listing import ListingCache
+from ..utils.framing import HEADER_SIZE
+from ..utils.fuzzy import FuzzyFinder
+from ..utils.project_index import ProjectIndex
+from ..utils.spill import FrameLimits
+from ..utils.symbols import SymbolIndex
+from ..workspace import Workspace
+from .pool import (ConnectionRequests, ExecutorBusy, RequestExecutor,
+                   RequestHandle)
+
+
+class AsyncServerDaemon:
+    def __init__(
+        self,
+        emacs_remote_path: str,
+        workspace: str,
+        ports: str,
+        logging_level: str = "info",
+        compression: str = "default",
+        io_workers: int = 16,
+        cpu_workers: int = None,
+        queue_depth: int = 64,
+        max_frame_size: int = FrameLimits.max_frame_size,
+        spill_threshold: int = FrameLimits.spill_threshold,
+        stdio: tuple = None,
+    ):
+        """
+        Server daemon that serves all ports and connections from a single event loop
+
+        Frames are parsed as they stream in and requests are run on a
+        `RequestExecutor`, so any number of requests can be in flight on any number
+        of connections.
+
+        Args:
+            emacs_remote_path: Path to the emacs remote directory
+            workspace: Path to the workspace to monitor
+            ports: Ports to listen on
+            logging_level: The logging level
+            compression: Name of the compression policy to use for responses
+            io_workers: Number of threads running io bound requests
+            cpu_workers: Number of processes running cpu bound requests
+            queue_depth: Number of requests that may wait on each pool
+            max_frame_size: Size in bytes of the largest request accepted
+            spill_threshold: Size in bytes from which requests are received to disk
+            stdio: (read fd, write fd) of a single connection to serve instead of
+                listening on ports, e.g. the stdin and stdout of an ssh session. The
+                daemon finishes once the connection closes
+        """
+        self.workspace = Workspace(None, emacs_remote_path, workspace)
+
+        self.ports = ports
+        self.stdio = stdio
+        self.compression = CompressionPolicy.get(compression)
+        self.limits = FrameLimits(
+            max_frame_size, spill_threshold, self.workspace.workspace_path
+        )
+
+        self.logger = self.workspace.logger("server.daemon")
+
+        self.executor = RequestExecutor(self, io_workers, cpu_workers, queue_depth)
+        # Built on the first ProjectIndexRequest
+        self.project_index = ProjectIndex(self.workspace.workspace, logger=self.logger)
+        self.fuzzy_finder = FuzzyFinder(self.project_index)
+        self.dir_listings = ListingCache()
+        self.symbol_index = SymbolIndex(
+            self.workspace.workspace,
+            self.workspace.workspace_path.joinpath("symbols.index"),
+            logger=self.logger,
+        )
+        self.loop = None
+        self.connections = {}
+        self.thread = None
+        self.started = Event()
+        self.finish = Event()
+        self.error = None
+
+    async def handle_connection(self, reader, writer, port):
+        logger = self.workspace.logger(f"server.{port}")
+        logger.debug(f"Connection accepted from {writer.get_extra_info('peername')}")
+
+        conn = AsyncSecureSocket(reader, writer, logger, self.compression, self.limits)
+        self.connections[conn] = asyncio.current_task()
+        requests = ConnectionRequests(logger)
+        tasks = set()
+        try:
+            await conn.negotiate()
+
+            while True:
+                request_id, request, _ = await conn.recv_message()
+                if request is None:
+                    # Nobody is left to read the responses
+                    requests.cancel_all()
+                    break
+
+                logger.debug(f"Got request with type: {type(request)}")
+                if not isinstance(request, Request):
+                    raise TypeError(f"Expected type Request. Got: {type(request)}")
+
+                if requests.control(request):
+                    continue
+
+                handle = requests.open(request_id, partial(self.emit, conn, request_id))
+                # Stop reading from this connection while the pool is full
+                future = await self.submit(request, handle)
+                task = asyncio.create_task(
+                    self.handle(conn, requests, request_id, handle, future, logger)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+        except asyncio.CancelledError:
+            # The daemon is shutting down
+            pass
+        except Exception as e:
+            logger.error(str(e))
+            requests.cancel_all()
+        finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+            self.connections.pop(conn, None)
+            await conn.close()
+
+    async def submit(self, request, handle):
+        """
+        Submits a request to the executor without blocking the event loop
+        """
+        try:
+            return self.executor.submit(request, handle, block=False)
+        except ExecutorBusy:
+            return await self.loop.run_in_executor(
+                None, self.executor.submit, request, handle
+            )
+
+    def emit(self, conn: AsyncSecureSocket, request_id, message):
+        """
+        Sends part of a streamed response from a worker thread
+
+        Blocks until the frame has been handed off to the transport so that the
+        worker can't get ahead of the client.
+
+        Returns:
+            The size of the frame
+        """
+        header, payload = conn.encode(message, request_id, more=True)
+        asyncio.run_coroutine_threadsafe(
+            conn.send_frame(header, payload), self.loop
+        ).result()
+        return HEADER_SIZE + sum(len(buffer) for buffer in payload)
+
+    async def handle(
+        self,
+        conn: AsyncSecureSocket,
+        requests: ConnectionRequests,
+        request_id,
+        handle: RequestHandle,
+        future,
+        logger,
+    ):
+        """
+        Waits for a request to finish running and sends its response
+        """
+        try:
+            try:
+                response = await asyncio.wrap_future(future)
+            except (Exception, asyncio.CancelledError):
+                if not handle.cancelled:
+                    raise
+            finally:
+                requests.close(request_id)
+
+            if handle.cancelled:
+                # Whatever the request got to, the client only needs to know it
+                # is over
+                logger.debug(f"Request {request_id} was cancelled")
+                response = CancelledResponse()
+
+            # Encode off the event loop as compression can take a while
+            header, payload = await self.loop.run_in_executor(
+                None, conn.encode, response, request_id
+            )
+            await conn.send_frame(header, payload)
+            logger.debug(f"Sent response to request {request_id}")
+        except Exception as e:
+            logger.error(f"Failed to handle request {request_id}: {e}")
+
+    async def open_stdio(self):
+        """
+        Returns a stream reader and writer for the stdio file descriptors
+        """
+        read_fd, write_fd = self.stdio
+
+        if stat.S_ISSOCK(os.fstat(read_fd).st_mode):
+            # sshd may hand over one end of a socket pair as both stdin and stdout. A
+            # write pipe transport would take the data arriving on it for a close
+            os.close(write_fd)
+            return await asyncio.open_connection(sock=socket.socket(fileno=read_fd))
+
+        reader = asyncio.StreamReader()
+        await self.loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), open(read_fd, "rb", 0)
+        )
+
+        # The protocol is only used for flow control and to wait for the pipe to close
+        transport, protocol = await self.loop.connect_write_pipe(
+            lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()),
+            open(write_fd, "wb", 0),
+        )
+        writer = asyncio.StreamWriter(transport, protocol, reader, self.loop)
+        return reader, writer
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+
+        servers = []
+        try:
+            if self.stdio is not None:
+                reader, writer = await self.open_stdio()
+                # Anything printed before this line, e.g. by login scripts, is
+                # skipped by the client
+                writer.write(f"{SERVER_STARTUP_MSG}\n".encode("utf-8"))
+
+                task = asyncio.create_task(
+                    self.handle_connection(reader, writer, "stdio")
+                )
+                # Nobody is left to send requests
+                task.add_done_callback(lambda _: self.finish.set())
+                self.logger.debug("Serving stdio")
+
+            for port in self.ports:
+
+                def on_connect(reader, writer, port=port):
+                    return self.handle_connection(reader, writer, port)
+
+                server = await asyncio.start_server(on_connect, "localhost", int(port))
+                servers.append(server)
+                self.logger.debug(f"Listening on port {port}")
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            self.started.set()
+
+        try:
+            # Woken up by ServerTerminateRequest or __exit__ setting self.finish
+            await self.loop.run_in_executor(None, self.finish.wait)
+        finally:
+            for server in servers:
+                server.close()
+
+            # Stop reading from the connections. Each handler still waits for its
+            # in flight requests to be answered before closing its connection
+            handlers = list(self.connections.values())
+            for handler in handlers:
+                handler.cancel()
+
+            await asyncio.gather(*handlers, return_exceptions=True)
+            for server in servers:
+                await server.wait_closed()
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            self.logger.error(str(e))
+
+    def wait(self):
+        self.finish.wait()
+
+    def __enter__(self):
+        self.logger.info("Starting server event loop...")
+
+        self.thread = Thread(target=self.run)
+        self.thread.start()
+        self.started.wait()
+
+        if self.error is not None:
+            self.thread.join()
+            raise self.error
+
+        return self
+
+    def __exit__(self, *args):
+        self.finish.set()
+
+        self.logger.debug("Waiting for event loop to finish")
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+        self.project_index.close()
+        self.symbol_index.close()
+
+        self.logger.info("Exiting emacs remote server daemon")
@@ -4,6 +4,9 @@ import os
 import signal
 import socket
 import sys
+from concurrent.futures import Future
+from concurrent.futures import wait as wait_futures
+from functools import partial
 from pathlib import Path
 from queue import Empty as EmptyQueue
 from queue import Queue
@@ -11,11 +14,18 @@ from threading import Barrier, Event, Thread
 from time import sleep
 
 from .. import utils
-from ..messages import Request, ShellResponse
+from ..messages import CancelledResponse, Request, ShellResponse
 from ..messages.startup import SERVER_STARTUP_MSG
+from ..utils.compression import CompressionPolicy
+from ..utils.dir_listing import ListingCache
+from ..utils.fuzzy import FuzzyFinder
 from ..utils.logging import LoggerFactory
+from ..utils.project_index import ProjectIndex
+from ..utils.spill import FrameLimits
 from ..utils.stcp_socket import SecureTCPSocket
+from ..utils.symbols import SymbolIndex
 from ..workspace import Workspace
+from .pool import ConnectionRequests, RequestExecutor, RequestHandle
 
 
 class ServerDaemon:
@@ -25,6 +35,12 @@ class ServerDaemon:
         workspace: str,
         ports: str,
         logging_level: str = "info",
+        compression: str = "default",
+        io_workers: int = 16,
+        cpu_workers: int = None,
+        queue_depth: int = 64,
+        max_frame_size: int = FrameLimits.max_frame_size,
+        spill_threshold: int = FrameLimits.spill_threshold,
     ):
         """
         Server daemon process that handles remote computation in the background
@@ -34,15 +50,35 @@ class ServerDaemon:
             workspace: Path to the workspace to monitor
             ports: Ports to listen on
             logging_level: The logging level
+            compression: Name of the compression policy to use for responses
+            io_workers: Number of threads running io bound requests
+            cpu_workers: Number of processes running cpu bound requests
+            queue_depth: Number of requests that may wait on each pool
+            max_frame_size: Size in bytes of the largest request accepted
+            spill_threshold: Size in bytes from which requests are received to disk
         """
         self.workspace = Workspace(None, emacs_remote_path, workspace)
 
         self.ports = ports
+        self.compression = CompressionPolicy.get(compression)
+        self.limits = FrameLimits(
+            max_frame_size, spill_threshold, self.workspace.workspace_path
+        )
 
         self.logger = self.workspace.logger("server.daemon")
 
         self.startup_barrier = Barrier(len(self.ports) + 1)
         self.threads = []
+        self.executor = RequestExecutor(self, io_workers, cpu_workers, queue_depth)
+        # Built on the first ProjectIndexRequest
+        self.project_index = ProjectIndex(self.workspace.workspace, logger=self.logger)
+        self.fuzzy_finder = FuzzyFinder(self.project_index)
+        self.dir_listings = ListingCache()
+        self.symbol_index = SymbolIndex(
+            self.workspace.workspace,
+            self.workspace.workspace_path.joinpath("symbols.index"),
+            logger=self.logger,
+        )
         self.terminate_events = Queue()
         self.finish = Event()
 
@@ -52,20 +88,28 @@ class ServerDaemon:
 
         logger = self.workspace.logger(f"server.{port}")
 
-        with SecureTCPSocket(logger=logger) as s:
+        with SecureTCPSocket(
+            logger=logger, compression=self.compression, limits=self.limits
+        ) as s:
             try:
                 s.bind("localhost", int(port))
+                s.listen()
 
                 self.startup_barrier.wait()
 
-                s.listen()
                 conn, addr = s.accept()
 
                 with conn:
+                    conn.negotiate(initiator=False)
+
+                    in_flight = set()
+                    requests = ConnectionRequests(logger)
                     while not terminate.is_set():
                         try:
-                            request = conn.recvall(timeout=2)
+                            request_id, request, _ = conn.recv_message(timeout=2)
                             if not request:
+                                # Nobody is left to read the responses
+                                requests.cancel_all()
                                 break
 
                             logger.debug(f"Got request with type: {type(request)}")
@@ -74,14 +118,68 @@ class ServerDaemon:
                                     f"Expected type Request. Got: {type(request)}"
                                 )
 
-                            conn.sendall(request.run(self))
-                            logger.debug("Sent response")
+                            if requests.control(request):
+                                continue
+
+                            # Run requests concurrently so that a slow request does
+                            # not hold up the ones that were sent after it. Blocks
+                            # while the pool for this request is full
+                            handle = requests.open(
+                                request_id,
+                                partial(conn.sendall, request_id=request_id, more=True),
+                            )
+                            future = self.executor.submit(request, handle)
+                            in_flight.add(future)
+                            future.add_done_callback(in_flight.discard)
+                            future.add_done_callback(
+                                partial(
+                                    self.send_response,
+                                    conn,
+                                    requests,
+                                    request_id,
+                                    handle,
+                                    logger,
+                                )
+                            )
                         except TimeoutError:
                             pass
+                        except ValueError as e:
+                            # The frame was refused, so the stream can't be resumed
+                            logger.error(str(e))
+                            requests.cancel_all()
+                            break
+
+                    # Make sure all responses are sent before closing the connection
+                    wait_futures(list(in_flight))
 
             except Exception as e:
                 logger.error(str(e))
 
+    def send_response(
+        self,
+        conn: SecureTCPSocket,
+        requests: ConnectionRequests,
+        request_id: int,
+        handle: RequestHandle,
+        logger,
+        future: Future,
+    ):
+        """
+        Sends the response of a finished request tagged with the request's id
+        """
+        requests.close(request_id)
+        try:
+            if handle.cancelled:
+                logger.debug(f"Request {request_id} was cancelled")
+                response = CancelledResponse()
+            else:
+                response = future.result()
+
+            conn.sendall(response, request_id)
+            logger.debug(f"Sent response to request {request_id}")
+        except Exception as e:
+            logger.error(f"Failed to handle request {request_id}: {e}")
+
     def wait(self):
         while not self.finish.is_set():
             sleep(1)
@@ -107,4 +205,8 @@ class ServerDaemon:
         for thread in self.threads:
             thread.join()
 
+        self.executor.shutdown(wait=True)
+        self.project_index.close()
+        self.symbol_index.close()
+
         self.logger.info("Exiting emacs remote server daemon")
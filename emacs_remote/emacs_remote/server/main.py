@@ -5,15 +5,45 @@ import logging
 import os
 from pathlib import Path
 
-from .daemon import ServerDaemon
 from ..messages.startup import SERVER_STARTUP_MSG
+from ..utils.spill import FrameLimits
+from .async_daemon import AsyncServerDaemon
+from .daemon import ServerDaemon
 
 
 def run(args):
+    stdio = None
+    if args.stdio:
+        # Frames go over the original stdin and stdout. The dups aren't inherited,
+        # so subprocesses get /dev/null as stdin and anything printed goes to stderr
+        stdio = (os.dup(0), os.dup(1))
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.close(devnull)
+        os.dup2(2, 1)
+
     print("Ports: ", args.ports, flush=True)
 
-    with ServerDaemon(
-        args.emacs_remote_path, args.workspace, args.ports, args.level
+    # A single connection doesn't need a thread of its own
+    if args.mode == "asyncio" or args.stdio:
+        daemon_type = AsyncServerDaemon
+        kwargs = {"stdio": stdio}
+    else:
+        daemon_type = ServerDaemon
+        kwargs = {}
+
+    with daemon_type(
+        args.emacs_remote_path,
+        args.workspace,
+        args.ports or [],
+        args.level,
+        args.compression,
+        args.io_workers,
+        args.cpu_workers,
+        args.queue_depth,
+        args.max_frame_size,
+        args.spill_threshold,
+        **kwargs,
     ) as daemon:
         print(SERVER_STARTUP_MSG, flush=True)
         daemon.wait()
@@ -41,9 +71,13 @@ def main():
         "-p",
         "--ports",
         nargs="+",
-        required=True,
         help="Ports to listen on",
     )
+    parser.add_argument(
+        "--stdio",
+        action="store_true",
+        help="Serve a single connection over stdin and stdout instead of ports",
+    )
     parser.add_argument(
         "-l",
         "--level",
@@ -51,7 +85,55 @@ def main():
         default="info",
         help="Logger level",
     )
-    run(parser.parse_args())
+    parser.add_argument(
+        "-c",
+        "--compression",
+        choices=["default", "fast", "strong", "none"],
+        default="default",
+        help="Compression policy. Use fast on LAN links and strong on slow links",
+    )
+    parser.add_argument(
+        "-m",
+        "--mode",
+        choices=["threads", "asyncio"],
+        default="threads",
+        help="Serve each port from its own thread or all ports from one event loop",
+    )
+    parser.add_argument(
+        "--io_workers",
+        type=int,
+        default=16,
+        help="Number of threads running io bound requests",
+    )
+    parser.add_argument(
+        "--cpu_workers",
+        type=int,
+        default=None,
+        help="Number of processes running cpu bound requests. Defaults to cpu count",
+    )
+    parser.add_argument(
+        "--queue_depth",
+        type=int,
+        default=64,
+        help="Number of requests that may wait on each pool before reads stall",
+    )
+    parser.add_argument(
+        "--max_frame_size",
+        type=int,
+        default=FrameLimits.max_frame_size,
+        help="Size in bytes of the largest message accepted from the client",
+    )
+    parser.add_argument(
+        "--spill_threshold",
+        type=int,
+        default=FrameLimits.spill_threshold,
+        help="Size in bytes from which messages are received to disk, not memory",
+    )
+    args = parser.parse_args()
+    if not args.ports and not args.stdio:
+        parser.error("one of --ports or --stdio is required")
+
+    run(args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,450 @@
+import inspect
+import os
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from threading import BoundedSemaphore, Lock
+
+from ..messages import Execution, Request
+from ..utils.cancel import CancelToken, cancel_scope
+from ..utils.framing import STREAM_WINDOW
+from ..utils.spill import materialize
+from ..workspace import Workspace
+
+
+class ExecutorBusy(Exception):
+    """
+    Raised when a request is submitted without blocking to a pool that is full
+    """
+
+
+@dataclass
+class ProcessContext:
+    """
+    Stand in for the daemon passed to requests that run on the process pool
+
+    The daemon itself holds sockets, threads and locks, none of which can be sent
+    to another process. CPU bound requests may only use the attributes below.
+    """
+
+    workspace: Workspace
+
+    def __post_init__(self):
+        self.logger = self.workspace.logger("server.worker")
+
+
+def _run_in_process(request: Request, context: ProcessContext):
+    return request.run(context)
+
+
+def run_request(request: Request, daemon):
+    """
+    Runs a request whose response isn't streamed
+
+    Raises:
+        ValueError: if the request streams its response
+    """
+    response = request.run(daemon)
+    if inspect.isgenerator(response):
+        response.close()
+        raise ValueError(f"{type(request)} streams but there is nowhere to emit to")
+
+    return response
+
+
+class RequestHandle:
+    """
+    A request in flight on a connection, which the client can cancel and whose
+    streamed response is flow controlled
+
+    A request streams its response by making `run` a generator. Every yielded
+    message is passed to `send` and the value returned by the generator is the
+    final response. Messages are only sent while the request has credit, which the
+    client grants as it consumes them. Without credit the stream is parked: the
+    generator isn't resumed, and holds no thread, until more credit arrives.
+
+    Args:
+        send: called with each intermediate message of a streamed response.
+            Returns the number of bytes sent
+        credit: the number of bytes that may be sent before more is granted
+    """
+
+    def __init__(self, send, credit: int = STREAM_WINDOW):
+        self.send = send
+        self.credit = credit
+        self.token = CancelToken()
+        self.future = None
+
+        self.resume = None
+        self.lock = Lock()
+
+    @property
+    def cancelled(self):
+        return self.token.cancelled
+
+    def spend(self, size: int):
+        with self.lock:
+            self.credit -= size
+
+    def park(self, resume) -> bool:
+        """
+        Parks the stream if it is out of credit
+
+        Args:
+            resume: called once there is credit again or the request is cancelled
+        Returns:
+            Whether the stream was parked
+        """
+        with self.lock:
+            if self.credit > 0 or self.cancelled:
+                return False
+            self.resume = resume
+            return True
+
+    def _wake(self):
+        with self.lock:
+            resume, self.resume = self.resume, None
+
+        if resume is not None:
+            resume()
+
+    def grant(self, credit: int):
+        with self.lock:
+            self.credit += credit
+            if self.credit <= 0:
+                return
+
+        self._wake()
+
+    def cancel(self):
+        self.token.cancel()
+        if self.future is not None:
+            # Only succeeds if the request hasn't started
+            self.future.cancel()
+        self._wake()
+
+
+class ConnectionRequests:
+    """
+    The requests in flight on a single connection, by request id
+
+    Args:
+        logger: the logger to use
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.handles = {}
+        self.lock = Lock()
+
+    def open(self, request_id: int, send) -> RequestHandle:
+        handle = RequestHandle(send)
+        with self.lock:
+            self.handles[request_id] = handle
+        return handle
+
+    def close(self, request_id: int):
+        """
+        Forgets a request. Called right before its final message is sent
+        """
+        with self.lock:
+            self.handles.pop(request_id, None)
+
+    def control(self, request: Request) -> bool:
+        """
+        Runs request if it is a control request
+
+        Returns:
+            Whether it was a control request
+        """
+        if request.execution != Execution.control:
+            return False
+
+        request.run(self)
+        return True
+
+    def cancel(self, request_id: int):
+        with self.lock:
+            handle = self.handles.get(request_id)
+
+        if handle is not None:
+            self.logger.debug(f"Cancelling request {request_id}")
+            handle.cancel()
+
+    def grant(self, request_id: int, credit: int):
+        with self.lock:
+            handle = self.handles.get(request_id)
+
+        if handle is not None:
+            handle.grant(credit)
+
+    def cancel_all(self):
+        """
+        Cancels every request, e.g. because the client went away
+        """
+        with self.lock:
+            handles = list(self.handles.values())
+
+        for handle in handles:
+            handle.cancel()
+
+
+class RequestExecutor:
+    """
+    Runs requests on a bounded thread pool or process pool
+
+    Each pool accepts at most `workers + queue_depth` requests at once. Submitting
+    to a full pool blocks, which stops the caller from reading further requests off
+    its connection and so pushes back on the client. Parked streams (see
+    `RequestHandle`) don't count, so streams waiting for credit can't stop the
+    credit from being read. The requests of batches take the same slots.
+
+    Args:
+        daemon: the daemon passed to requests run on the thread pool
+        io_workers: number of threads for io bound requests
+        cpu_workers: number of processes for cpu bound requests
+        queue_depth: number of requests that may be waiting on each pool
+        watch_workers: number of threads for requests that wait on changes
+    """
+
+    def __init__(
+        self,
+        daemon,
+        io_workers: int = 16,
+        cpu_workers: int = None,
+        queue_depth: int = 64,
+        watch_workers: int = 16,
+    ):
+        self.daemon = daemon
+        self.logger = daemon.logger
+
+        if cpu_workers is None:
+            cpu_workers = os.cpu_count() or 1
+
+        self.thread_pool = ThreadPoolExecutor(
+            io_workers, thread_name_prefix="server.request"
+        )
+        # Runs the requests of batches. Separate from thread_pool so that a batch
+        # waiting on its requests can never starve them of threads
+        self.batch_pool = ThreadPoolExecutor(
+            io_workers, thread_name_prefix="server.batch"
+        )
+        self.watch_pool = ThreadPoolExecutor(
+            watch_workers, thread_name_prefix="server.watch"
+        )
+        self.cpu_workers = cpu_workers
+        # Only started once the first cpu bound request comes in
+        self.process_pool = None
+        self.process_lock = Lock()
+
+        self.slots = {
+            Execution.io: BoundedSemaphore(io_workers + queue_depth),
+            Execution.cpu: BoundedSemaphore(cpu_workers + queue_depth),
+            Execution.watch: BoundedSemaphore(watch_workers + queue_depth),
+        }
+
+    def get_process_pool(self):
+        with self.process_lock:
+            if self.process_pool is None:
+                self.logger.debug(f"Starting {self.cpu_workers} worker processes")
+                self.process_pool = ProcessPoolExecutor(self.cpu_workers)
+
+            return self.process_pool
+
+    def get_thread_pool(self, request: Request):
+        if request.execution == Execution.watch:
+            return self.watch_pool
+
+        return self.thread_pool
+
+    def submit(
+        self,
+        request: Request,
+        handle: RequestHandle = None,
+        block: bool = True,
+        timeout: float = None,
+    ):
+        """
+        Runs the request on the pool for its `execution` type
+
+        Requests that stream their response can't run on the process pool, and
+        requests on the process pool can only be cancelled before they start.
+
+        Args:
+            request: the request to run
+            handle: where to send a streamed response and how to cancel the
+                request. Required for requests that stream
+            block: whether to wait for room in the pool
+            timeout: seconds to wait for room in the pool if blocking
+        Returns:
+            A future that resolves to the response
+        Raises:
+            ExecutorBusy: if there was no room in the pool
+        """
+        execution = request.execution
+
+        if execution == Execution.inline:
+            future = Future()
+            if handle is not None:
+                handle.future = future
+            self._run(request, handle, future)
+            return future
+
+        slot = self.slots[execution]
+        if not slot.acquire(block, timeout):
+            raise ExecutorBusy(f"Too many {execution.name} bound requests queued")
+
+        try:
+            if execution == Execution.cpu:
+                future = self.get_process_pool().submit(
+                    _run_in_process,
+                    materialize(request),
+                    ProcessContext(self.daemon.workspace),
+                )
+                future.add_done_callback(lambda _: slot.release())
+            else:
+                future = Future()
+                pool = self.get_thread_pool(request)
+                task = pool.submit(self._run, request, handle, future)
+                # The slot is freed once the request is done or its stream parks
+                task.add_done_callback(lambda _: slot.release())
+        except:
+            slot.release()
+            raise
+
+        if handle is not None:
+            handle.future = future
+        return future
+
+    def _run(
+        self, request: Request, handle: RequestHandle, future: Future, stream=None
+    ):
+        """
+        Runs a request on the current thread, or resumes its parked stream
+
+        Args:
+            request: the request to run
+            handle: see `submit`
+            future: set to the response
+            stream: the generator of a parked stream
+        """
+        if stream is None and not future.set_running_or_notify_cancel():
+            return
+
+        token = handle.token if handle is not None else None
+        try:
+            with cancel_scope(token):
+                if stream is None:
+                    response = request.run(self.daemon)
+                    if not inspect.isgenerator(response):
+                        future.set_result(response)
+                        return
+
+                    stream = response
+                    if handle is None:
+                        raise ValueError(
+                            f"{type(request)} streams but there is nowhere to emit to"
+                        )
+
+                while True:
+                    handle.token.check()
+                    resume = partial(self._resume, request, handle, future, stream)
+                    if handle.park(resume):
+                        return
+
+                    try:
+                        message = next(stream)
+                    except StopIteration as e:
+                        future.set_result(e.value)
+                        return
+
+                    handle.spend(handle.send(message))
+        except Exception as e:
+            # Closing the generator lets it clean up if the message can't be sent
+            if stream is not None:
+                stream.close()
+            future.set_exception(e)
+
+    def _resume(self, request, handle, future, stream):
+        try:
+            pool = self.get_thread_pool(request)
+            pool.submit(self._run, request, handle, future, stream)
+        except RuntimeError as e:
+            # The pool was shut down
+            stream.close()
+            future.set_exception(e)
+
+    def submit_batch_item(self, request: Request) -> Future:
+        """
+        Runs a request of a batch on the pool for its `execution` type
+
+        The request takes a slot of that pool like any other request. When there
+        is none, it runs on the batch's own thread instead: that thread already
+        holds a slot, and waiting for another could deadlock with other batches.
+
+        Returns:
+            A future that resolves to the response
+        """
+        execution = request.execution
+        slot = self.slots.get(execution)
+        if slot is None or not slot.acquire(blocking=False):
+            future = Future()
+            try:
+                future.set_result(run_request(request, self.daemon))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        try:
+            if execution == Execution.cpu:
+                future = self.get_process_pool().submit(
+                    _run_in_process,
+                    materialize(request),
+                    ProcessContext(self.daemon.workspace),
+                )
+            else:
+                future = self.batch_pool.submit(run_request, request, self.daemon)
+            future.add_done_callback(lambda _: slot.release())
+        except:
+            slot.release()
+            raise
+
+        return future
+
+    def run_batch(self, requests, ordered: bool = False):
+        """
+        Runs the requests of a batch, each on the pool for its `execution` type
+
+        Args:
+            requests: the requests to run. Requests that stream their response fail
+            ordered: whether to run the requests one after the other, in order.
+                Otherwise they run concurrently
+        Returns:
+            The response of each request, or the exception it raised
+        """
+        if ordered:
+            futures = []
+            for request in requests:
+                future = self.submit_batch_item(request)
+                futures.append(future)
+                # Wait without raising, errors are returned with the results
+                future.exception()
+        else:
+            futures = [self.submit_batch_item(request) for request in requests]
+
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+
+        return results
+
+    def shutdown(self, wait: bool = True):
+        self.thread_pool.shutdown(wait=wait)
+        self.watch_pool.shutdown(wait=wait)
+        self.batch_pool.shutdown(wait=wait)
+        with self.process_lock:
+            if self.process_pool is not None:
+                self.process_pool.shutdown(wait=wait)
@@ -0,0 +1,144 @@
+import asyncio
+
+from ..messages.handshake_request import (Capabilities, accept_handshake,
+                                          is_handshake_probe)
+from .compression import CODEC_MASK, CompressionPolicy
+from .framing import (HEADER_SIZE, MessageUnpacker, decode_message,
+                      encode_message, unpack_header)
+from .logging import LoggerFactory
+from .spill import SPILL_CHUNK_SIZE, FrameLimits, SpillWriter
+
+# Uncompressed payloads smaller than this are decoded on the event loop, as handing
+# them to a thread would cost more than decoding them
+OFFLOAD_SIZE = 64 * 1024
+
+
+class AsyncSecureSocket:
+    """
+    asyncio counterpart of `SecureTCPSocket` using the same framing
+
+    Frames are parsed incrementally off the stream reader so a partially received
+    frame never blocks the event loop. Decompressing, decoding big payloads and
+    writing spilled ones to disk are done on the default executor of the loop.
+
+    Args:
+        reader: the stream reader of the connection
+        writer: the stream writer of the connection
+        logger: the logger to use
+        compression: the compression policy to use for sent frames
+        limits: the limits on received frames
+    """
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        logger=None,
+        compression: CompressionPolicy = None,
+        limits: FrameLimits = None,
+    ):
+        self.reader = reader
+        self.writer = writer
+
+        if logger is None:
+            logger = LoggerFactory().get_logger("AsyncSecureSocket")
+
+        self.logger = logger
+
+        if compression is None:
+            compression = CompressionPolicy()
+
+        self.compression = compression
+
+        if limits is None:
+            limits = FrameLimits()
+
+        self.limits = limits
+        self.unpacker = MessageUnpacker(limits.max_frame_size)
+        self.peer = Capabilities.legacy()
+
+    async def negotiate(self, timeout: float = 10):
+        """
+        Responds to the handshake started by the connecting end
+        """
+        _, request, _ = await asyncio.wait_for(self.recv_message(), timeout)
+        if is_handshake_probe(request):
+            await self.sendall(request.run(None))
+            _, request, _ = await asyncio.wait_for(self.recv_message(), timeout)
+
+        local = Capabilities(max_frame_size=self.limits.max_frame_size)
+        response, self.peer = accept_handshake(request, local)
+        await self.sendall(response)
+
+        self.logger.debug(f"Negotiated: {self.peer}")
+
+    def encode(self, data, request_id: int = 0, more: bool = False):
+        """
+        Encodes a message into a frame. Can be called off the event loop
+        """
+        return encode_message(data, request_id, self.compression, self.peer, more)
+
+    async def send_frame(self, header: bytes, payload: list):
+        # All buffers are written in the same event loop step so frames written by
+        # concurrent tasks never interleave
+        self.writer.writelines((header, *payload))
+        await self.writer.drain()
+
+    async def sendall(self, data, request_id: int = 0, more: bool = False):
+        await self.send_frame(*self.encode(data, request_id, more))
+
+    async def recv_message(self):
+        """
+        Receives the next frame
+
+        Returns:
+            A (request_id, message, flags) tuple. message is None if the
+            connection closed
+        """
+        try:
+            header = await self.reader.readexactly(HEADER_SIZE)
+            message_type, message_size, flags, request_id = unpack_header(header)
+            self.limits.check(message_size)
+            if self.limits.should_spill(message_size):
+                message = await self._recv_spilled(message_type, message_size, flags)
+                return request_id, message, flags
+
+            payload = await self.reader.readexactly(message_size)
+        except asyncio.IncompleteReadError:
+            return 0, None, 0
+
+        args = (message_type, flags, payload, self.limits.max_frame_size, self.unpacker)
+        if flags & CODEC_MASK or message_size >= OFFLOAD_SIZE:
+            loop = asyncio.get_running_loop()
+            message = await loop.run_in_executor(None, decode_message, *args)
+        else:
+            message = decode_message(*args)
+
+        return request_id, message, flags
+
+    async def _recv_spilled(self, message_type: int, message_size: int, flags: int):
+        """
+        Receives a payload into a temp file instead of memory
+
+        Raises:
+            asyncio.IncompleteReadError: if the connection closed
+        """
+        self.logger.debug(f"Spilling {message_size} byte payload to disk")
+
+        loop = asyncio.get_running_loop()
+        writer = await loop.run_in_executor(None, SpillWriter, flags, self.limits)
+        with writer:
+            remaining = message_size
+            while remaining > 0:
+                data = await self.reader.readexactly(min(remaining, SPILL_CHUNK_SIZE))
+                await loop.run_in_executor(None, writer.write, data)
+                remaining -= len(data)
+
+            return await loop.run_in_executor(None, writer.decode, message_type)
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
@@ -40,10 +40,14 @@ class AtomicInt:
         with self.lock:
             self.val += inc
 
+        return self
+
     def __isub__(self, inc):
         with self.lock:
             self.val -= inc
 
+        return self
+
     def __enter__(self):
         with self.lock:
             self.val += 1
@@ -0,0 +1,81 @@
+from contextlib import contextmanager
+from threading import Lock, local
+
+_current = local()
+
+
+class RequestCancelled(Exception):
+    """
+    Raised when a request is cancelled by the client while it runs
+    """
+
+
+class CancelToken:
+    """
+    Signals that the client no longer wants the response to a request
+
+    Requests that run for a long time either check `cancelled` as they go or add
+    a callback that stops them, e.g. by killing a subprocess.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self.callbacks = []
+        self.lock = Lock()
+
+    def cancel(self):
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            callbacks, self.callbacks = self.callbacks, []
+
+        for fn in callbacks:
+            fn()
+
+    def add_callback(self, fn):
+        """
+        Calls fn once the token is cancelled, right away if it already is
+        """
+        with self.lock:
+            if not self.cancelled:
+                self.callbacks.append(fn)
+                return
+
+        fn()
+
+    def remove_callback(self, fn):
+        with self.lock:
+            if fn in self.callbacks:
+                self.callbacks.remove(fn)
+
+    def check(self):
+        """
+        Raises:
+            RequestCancelled: if the token was cancelled
+        """
+        if self.cancelled:
+            raise RequestCancelled()
+
+
+def current_token() -> CancelToken:
+    """
+    Returns the token of the request running on this thread
+
+    Outside of a request a new token is returned, which is never cancelled.
+    """
+    token = getattr(_current, "token", None)
+    return token if token is not None else CancelToken()
+
+
+@contextmanager
+def cancel_scope(token: CancelToken):
+    """
+    Makes token the one returned by `current_token` on this thread
+    """
+    previous = getattr(_current, "token", None)
+    _current.token = token
+    try:
+        yield token
+    finally:
+        _current.token = previous
@@ -0,0 +1,446 @@
+import abc
+import zlib
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Decompressed data is produced this many bytes at a time, so a small payload that
+# decompresses to a lot of data is caught before it is all in memory
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+
+
+def check_decompressed_size(size: int, max_size: int):
+    """
+    Raises:
+        ValueError: if size is bigger than max_size
+    """
+    if max_size is not None and size > max_size:
+        raise ValueError(
+            f"Frame decompresses to more than the maximum frame size of "
+            f"{max_size} bytes"
+        )
+
+
+class Codec(abc.ABC):
+    """
+    Base class for a compression codec that can be used on the wire
+
+    The codec id is stored in the flags of the frame header, so ids must never
+    change once assigned.
+    """
+
+    id: int = None
+    name: str = None
+    default_level: int = None
+    # The range of valid compression levels
+    min_level: int = None
+    max_level: int = None
+
+    def clamp_level(self, level: int = None):
+        """
+        Returns the nearest level this codec accepts, or None for the default
+        """
+        if level is None:
+            return None
+
+        return max(self.min_level, min(level, self.max_level))
+
+    @abc.abstractmethod
+    def compress(self, data, level: int = None) -> bytes:
+        pass
+
+    @abc.abstractmethod
+    def compressobj(self, level: int = None):
+        """
+        Returns an incremental compressor with compress(data) and flush() methods
+
+        Both return the compressed data produced so far, so a payload held in
+        several pieces can be compressed without joining them first.
+        """
+        pass
+
+    def decompress(self, data, max_size: int = None) -> bytes:
+        """
+        Decompresses a whole payload
+
+        Args:
+            data: the compressed payload
+            max_size: the maximum size of the output
+        Raises:
+            ValueError: if the output is bigger than max_size
+        """
+        chunks = []
+        size = 0
+
+        def collect(chunk):
+            nonlocal size
+            size += len(chunk)
+            check_decompressed_size(size, max_size)
+            chunks.append(chunk)
+
+        decompressor = self.stream_decompressor(collect, DECOMPRESS_CHUNK_SIZE)
+        decompressor.write(data)
+        decompressor.flush()
+        return b"".join(chunks)
+
+    @abc.abstractmethod
+    def stream_decompressor(self, write: Callable, chunk_size: int):
+        """
+        Returns an incremental decompressor with write(data) and flush() methods
+
+        The output is handed to write as it is produced, in pieces of at most
+        chunk_size bytes, so it never has to be held in memory all at once.
+        """
+        pass
+
+
+class _LZ4StreamCompressor:
+    def __init__(self, level: int):
+        self.compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        out = self.compressor.compress(data)
+        if self.header:
+            out, self.header = self.header + out, b""
+        return out
+
+    def flush(self):
+        return self.header + self.compressor.flush()
+
+
+class _ZlibStreamDecompressor:
+    def __init__(self, write: Callable, chunk_size: int):
+        self.decompressor = zlib.decompressobj()
+        self.sink = write
+        self.chunk_size = chunk_size
+
+    def write(self, data):
+        while True:
+            out = self.decompressor.decompress(data, self.chunk_size)
+            if out:
+                self.sink(out)
+            # Input that would produce more than chunk_size bytes is left over
+            data = self.decompressor.unconsumed_tail
+            if not data and len(out) < self.chunk_size:
+                return
+
+    def flush(self):
+        out = self.decompressor.flush()
+        if out:
+            self.sink(out)
+
+
+class _LZ4StreamDecompressor:
+    def __init__(self, write: Callable, chunk_size: int):
+        self.decompressor = lz4.frame.LZ4FrameDecompressor()
+        self.sink = write
+        self.chunk_size = chunk_size
+
+    def write(self, data):
+        while True:
+            out = self.decompressor.decompress(data, max_length=self.chunk_size)
+            if out:
+                self.sink(out)
+            # Input that would produce more than chunk_size bytes is kept by the
+            # decompressor until it is asked for more output
+            data = b""
+            if self.decompressor.needs_input or self.decompressor.eof:
+                return
+
+    def flush(self):
+        pass
+
+
+class _ZstdStreamDecompressor:
+    def __init__(self, write: Callable, chunk_size: int):
+        # The stream writer hands over its output as it goes, write_size bytes at
+        # a time
+        self.writer = zstandard.ZstdDecompressor().stream_writer(
+            SimpleNamespace(write=write), write_size=chunk_size
+        )
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def flush(self):
+        pass
+
+
+class ZlibCodec(Codec):
+    id = 1
+    name = "zlib"
+    default_level = 6
+    min_level = 0
+    max_level = 9
+
+    def compress(self, data, level: int = None):
+        return zlib.compress(data, self.default_level if level is None else level)
+
+    def compressobj(self, level: int = None):
+        return zlib.compressobj(self.default_level if level is None else level)
+
+    def decompress(self, data, max_size: int = None):
+        if max_size is None:
+            return zlib.decompress(data)
+
+        decompressor = zlib.decompressobj()
+        out = decompressor.decompress(data, max_size + 1)
+        check_decompressed_size(len(out), max_size)
+        if not decompressor.eof:
+            raise zlib.error("Incomplete or truncated stream")
+        return out
+
+    def stream_decompressor(self, write: Callable, chunk_size: int):
+        return _ZlibStreamDecompressor(write, chunk_size)
+
+
+class LZ4Codec(Codec):
+    id = 2
+    name = "lz4"
+    default_level = 0
+    min_level = 0
+    max_level = 16
+
+    def compress(self, data, level: int = None):
+        return lz4.frame.compress(
+            data,
+            compression_level=self.default_level if level is None else level,
+        )
+
+    def compressobj(self, level: int = None):
+        return _LZ4StreamCompressor(self.default_level if level is None else level)
+
+    def stream_decompressor(self, write: Callable, chunk_size: int):
+        return _LZ4StreamDecompressor(write, chunk_size)
+
+
+class ZstdCodec(Codec):
+    id = 3
+    name = "zstd"
+    default_level = 3
+    min_level = 1
+    max_level = 22
+
+    def compress(self, data, level: int = None):
+        compressor = zstandard.ZstdCompressor(
+            level=self.default_level if level is None else level
+        )
+        return compressor.compress(data)
+
+    def compressobj(self, level: int = None):
+        compressor = zstandard.ZstdCompressor(
+            level=self.default_level if level is None else level
+        )
+        return compressor.compressobj()
+
+    def stream_decompressor(self, write: Callable, chunk_size: int):
+        return _ZstdStreamDecompressor(write, chunk_size)
+
+
+# Compressed frames have the codec id in the lower bits of the header flags.
+# 0 means uncompressed
+NO_COMPRESSION = 0
+CODEC_MASK = 0x0F
+
+_CODECS = [ZstdCodec(), LZ4Codec(), ZlibCodec()]
+_AVAILABLE = {
+    "zlib": True,
+    "lz4": lz4 is not None,
+    "zstd": zstandard is not None,
+}
+
+CODECS_BY_ID = {codec.id: codec for codec in _CODECS if _AVAILABLE[codec.name]}
+CODECS_BY_NAME = {codec.name: codec for codec in _CODECS if _AVAILABLE[codec.name]}
+
+
+def available_codecs() -> List[str]:
+    """
+    Returns the names of the codecs installed locally in order of preference
+    """
+    return [codec.name for codec in _CODECS if _AVAILABLE[codec.name]]
+
+
+def negotiate_codecs(preferred: List[str], supported: List[str]) -> List[str]:
+    """
+    Returns the codecs supported by both sides in the preferred order
+
+    Args:
+        preferred: the codec names of the side that initiated the connection
+        supported: the codec names of the other side
+    """
+    return [name for name in preferred if name in supported]
+
+
+@dataclass
+class CompressionPolicy:
+    """
+    Determines how (and whether) a frame is compressed before being sent
+
+    Args:
+        codecs: codec names to use, in order of preference
+        threshold: payloads smaller than this many bytes are sent uncompressed
+        level: the compression level to use. If None, the codec default is used.
+            Levels outside the range of the codec used are clamped to it
+        levels: compression level overrides keyed by message type name
+        large_threshold: payloads at least this many bytes use `large_level`
+        large_level: the compression level for large payloads. If None, `level`
+            is used for all payloads
+        sample_size: number of bytes of a large payload that are trial compressed
+            to detect data that is already compressed
+        min_ratio: the compressed/original size ratio above which a payload is
+            considered incompressible and sent as is
+    """
+
+    codecs: List[str] = field(default_factory=available_codecs)
+    threshold: int = 1024
+    level: int = None
+    levels: Dict[str, int] = field(default_factory=dict)
+    large_threshold: int = 1024 * 1024
+    large_level: int = None
+    sample_size: int = 16 * 1024
+    min_ratio: float = 0.9
+
+    @staticmethod
+    def fast():
+        """
+        Policy for fast links where compression time dominates transfer time
+        """
+        codecs = [name for name in ("lz4", "zstd", "zlib") if _AVAILABLE[name]]
+        return CompressionPolicy(codecs=codecs, threshold=4096, level=1)
+
+    @staticmethod
+    def strong():
+        """
+        Policy for slow links that only spends extra CPU time on large payloads
+        """
+        if _AVAILABLE["zstd"]:
+            return CompressionPolicy(codecs=["zstd", "zlib"], large_level=19)
+
+        return CompressionPolicy(codecs=["zlib"], large_level=9)
+
+    @staticmethod
+    def get(name: str):
+        if name == "fast":
+            return CompressionPolicy.fast()
+        elif name == "strong":
+            return CompressionPolicy.strong()
+        elif name == "none":
+            return CompressionPolicy(codecs=[])
+        elif name == "default":
+            return CompressionPolicy()
+        else:
+            raise ValueError(f"Invalid compression policy: {name}")
+
+    def get_codec(self, supported: List[str] = None):
+        """
+        Returns the most preferred codec that is also supported by the peer
+        """
+        for name in self.codecs:
+            codec = CODECS_BY_NAME.get(name)
+            if codec is not None and (supported is None or name in supported):
+                return codec
+
+        return None
+
+    def get_level(self, message_type: type, size: int):
+        level = self.levels.get(message_type.__name__)
+        if level is not None:
+            return level
+
+        if self.large_level is not None and size >= self.large_threshold:
+            return self.large_level
+
+        return self.level
+
+    def compress(self, message_type: type, data, supported: List[str] = None):
+        """
+        Compresses the payload if worthwhile
+
+        Args:
+            message_type: the type of the message being sent
+            data: the packed message, or a list of bytes-like objects holding it
+            supported: the codecs negotiated with the peer
+        Returns:
+            A (flags, payload) tuple where flags is the id of the codec used. The
+            payload is data as it was if it wasn't compressed
+        """
+        parts = data if isinstance(data, list) else [data]
+        size = sum(len(part) for part in parts)
+
+        codec = self.get_codec(supported)
+        if codec is None or size < self.threshold:
+            return NO_COMPRESSION, data
+
+        # Levels are set for the preferred codec, which the peer may not support
+        level = codec.clamp_level(self.get_level(message_type, size))
+
+        if size > self.sample_size * 4:
+            # Avoid spending time on data that is already compressed (images,
+            # tarballs, ...) by compressing a sample of it first
+            sample = memoryview(max(parts, key=len))[: self.sample_size]
+            if len(codec.compress(sample, level)) > self.min_ratio * len(sample):
+                return NO_COMPRESSION, data
+
+        # The parts are compressed one at a time rather than copied into one
+        # buffer first
+        compressor = codec.compressobj(level)
+        chunks = []
+        compressed_size = 0
+        for part in parts:
+            chunks.append(compressor.compress(part))
+            compressed_size += len(chunks[-1])
+            if compressed_size >= size:
+                return NO_COMPRESSION, data
+
+        chunks.append(compressor.flush())
+        if compressed_size + len(chunks[-1]) >= size:
+            return NO_COMPRESSION, data
+
+        return codec.id, b"".join(chunks)
+
+
+def get_frame_codec(flags: int):
+    """
+    Returns the codec named in the header flags, or None if uncompressed
+    """
+    codec_id = flags & CODEC_MASK
+    if codec_id == NO_COMPRESSION:
+        return None
+
+    codec = CODECS_BY_ID.get(codec_id)
+    if codec is None:
+        raise ValueError(
+            f"Received frame compressed with unsupported codec: {codec_id}"
+        )
+
+    return codec
+
+
+def decompress(flags: int, payload, max_size: int = None):
+    """
+    Decompresses a payload using the codec named in the header flags
+
+    Args:
+        flags: the flags from the frame header
+        payload: the payload of the frame
+        max_size: the maximum size of the decompressed payload
+    Raises:
+        ValueError: if the payload decompresses to more than max_size bytes
+    """
+    codec = get_frame_codec(flags)
+    if codec is None:
+        return payload
+
+    return codec.decompress(payload, max_size)
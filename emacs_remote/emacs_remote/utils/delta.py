@@ -0,0 +1,169 @@
+import hashlib
+from dataclasses import dataclass, field
+from itertools import accumulate
+from typing import List
+
+DEFAULT_BLOCK_SIZE = 4096
+
+_STRONG_SIZE = 16
+_MOD = 1 << 16
+
+
+def _strong(block) -> bytes:
+    return hashlib.blake2b(block, digest_size=_STRONG_SIZE).digest()
+
+
+def _weak(block):
+    """
+    rsync style weak checksum of a block as its two 16-bit halves
+
+    a is the sum of the bytes and b is the sum of the prefix sums, which is the same
+    as sum((len(block) - i) * x for i, x in enumerate(block)).
+    """
+    return sum(block) % _MOD, sum(accumulate(block)) % _MOD
+
+
+@dataclass
+class FileSignature:
+    """
+    Block signatures of a file, used by the other side to compute a delta
+
+    Args:
+        block_size: the size of each block. The last block may be shorter
+        weak: the rolling checksum of each block
+        strong: the concatenated 16 byte strong hash of each block
+    """
+
+    block_size: int = DEFAULT_BLOCK_SIZE
+    weak: List[int] = field(default_factory=list)
+    strong: bytes = b""
+
+    @staticmethod
+    def compute(data, block_size: int = DEFAULT_BLOCK_SIZE):
+        """
+        Computes the signature of a bytes-like object (or an mmap)
+        """
+        data = memoryview(data)
+        weak = []
+        strong = bytearray()
+        for offset in range(0, len(data), block_size):
+            block = data[offset : offset + block_size]
+            a, b = _weak(block)
+            weak.append(a | (b << 16))
+            strong.extend(_strong(block))
+
+        return FileSignature(block_size, weak, bytes(strong))
+
+
+def compute_delta(signature: FileSignature, data) -> list:
+    """
+    Computes the instructions that turn the signed file into `data`
+
+    Blocks of `data` that appear anywhere in the signed file are replaced by copy
+    instructions. The rolling checksum only has to be rolled byte by byte around
+    changes, so the cost for a small edit is close to one pass of block lookups.
+
+    Args:
+        signature: the signature of the receiver's copy of the file
+        data: the new contents of the file
+    Returns:
+        A list of instructions. Each is either bytes to insert or a
+        [block_index, num_blocks] list of consecutive blocks to copy
+    """
+    block_size = signature.block_size
+    data = memoryview(data)
+    n = len(data)
+
+    blocks = {}
+    for index, weak in enumerate(signature.weak):
+        blocks.setdefault(weak, []).append(index)
+
+    delta = []
+
+    def add_copy(index):
+        if delta and isinstance(delta[-1], list):
+            start, count = delta[-1]
+            if start + count == index:
+                delta[-1][1] += 1
+                return
+
+        delta.append([index, 1])
+
+    def find_block(offset, weak):
+        candidates = blocks.get(weak)
+        if not candidates:
+            return None
+
+        strong = _strong(data[offset : offset + block_size])
+        for index in candidates:
+            begin = index * _STRONG_SIZE
+            if signature.strong[begin : begin + _STRONG_SIZE] == strong:
+                return index
+
+        return None
+
+    literal_start = 0
+    offset = 0
+    a = b = None
+    while offset + block_size <= n:
+        if a is None:
+            a, b = _weak(data[offset : offset + block_size])
+
+        index = find_block(offset, a | (b << 16))
+        if index is not None:
+            if literal_start < offset:
+                delta.append(bytes(data[literal_start:offset]))
+
+            add_copy(index)
+            offset += block_size
+            literal_start = offset
+            a = b = None
+            continue
+
+        # Roll the checksum forward by one byte
+        if offset + block_size < n:
+            out_byte = data[offset]
+            in_byte = data[offset + block_size]
+            a = (a - out_byte + in_byte) % _MOD
+            b = (b - block_size * out_byte + a) % _MOD
+
+        offset += 1
+
+    if literal_start < n:
+        # The tail may still match the (short) last block of the signed file
+        tail = data[literal_start:]
+        last = len(signature.weak) - 1
+        if (
+            last >= 0
+            and 0 < len(tail) < block_size
+            and signature.strong[last * _STRONG_SIZE :] == _strong(tail)
+        ):
+            add_copy(last)
+        else:
+            delta.append(bytes(tail))
+
+    return delta
+
+
+def apply_delta(basis, delta: list, block_size: int, write):
+    """
+    Rebuilds the new file from the receiver's copy and a delta
+
+    Args:
+        basis: the receiver's copy of the file as a bytes-like object (or an mmap)
+        delta: the instructions returned by `compute_delta`
+        block_size: the block size of the signature the delta was computed against
+        write: called with each piece of the new file in order
+    """
+    basis = memoryview(basis)
+    for instruction in delta:
+        if isinstance(instruction, (bytes, bytearray)):
+            write(instruction)
+        else:
+            index, count = instruction
+            start = index * block_size
+            end = start + count * block_size
+            if start >= len(basis):
+                raise ValueError(f"Delta copies block {index} past end of basis file")
+
+            write(basis[start:end])
@@ -0,0 +1,323 @@
+import hashlib
+import os
+import sys
+import time
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import List
+
+KIND_FILE = ord("f")
+KIND_DIRECTORY = ord("d")
+KIND_SYMLINK = ord("l")
+KIND_OTHER = ord("o")
+
+# A directory modified this recently may still change within the same mtime tick,
+# so its listing can't be validated by mtime alone
+RACY_WINDOW_NS = 2_000_000_000
+
+
+def _to_bytes(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode: str, data: bytes) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+@dataclass
+class DirListing:
+    """
+    The entries of a directory, stored column by column
+
+    Every column is a single bytes object, which packs and compresses far better
+    than a list of per entry records.
+
+    Args:
+        mtime_ns: the modification time of the directory
+        names: the names of the entries, NUL separated
+        kinds: one byte per entry. f for files, d for directories, l for symlinks
+            and o for anything else
+        sizes: the sizes of the entries as little endian uint64s
+        mtimes: the modification times of the entries in nanoseconds as little
+            endian int64s
+    """
+
+    mtime_ns: int = 0
+    names: bytes = b""
+    kinds: bytes = b""
+    sizes: bytes = b""
+    mtimes: bytes = b""
+
+    @staticmethod
+    def read(path) -> "DirListing":
+        """
+        Lists a directory. Symlinks are not followed
+
+        Raises:
+            OSError: if the directory can't be listed
+        """
+        mtime_ns = os.stat(path).st_mtime_ns
+
+        names, kinds = [], bytearray()
+        sizes, mtimes = array("Q"), array("q")
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+
+                if entry.is_symlink():
+                    kind = KIND_SYMLINK
+                elif entry.is_dir(follow_symlinks=False):
+                    kind = KIND_DIRECTORY
+                elif entry.is_file(follow_symlinks=False):
+                    kind = KIND_FILE
+                else:
+                    kind = KIND_OTHER
+
+                names.append(os.fsencode(entry.name))
+                kinds.append(kind)
+                sizes.append(st.st_size)
+                mtimes.append(st.st_mtime_ns)
+
+        return DirListing(
+            mtime_ns,
+            b"\0".join(names),
+            bytes(kinds),
+            _to_bytes(sizes),
+            _to_bytes(mtimes),
+        )
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def digest(self) -> str:
+        """
+        Hash of the entries, used to check whether a listing changed
+        """
+        h = hashlib.blake2b(digest_size=16)
+        for column in (self.names, self.kinds, self.sizes, self.mtimes):
+            h.update(len(column).to_bytes(8, "little"))
+            h.update(column)
+        return h.hexdigest()
+
+    def entries(self) -> List[tuple]:
+        """
+        Returns:
+            A (name, kind, size, mtime_ns) tuple for each entry. kind is one of f,
+            d, l or o
+        """
+        if not self.kinds:
+            return []
+
+        names = [os.fsdecode(name) for name in self.names.split(b"\0")]
+        kinds = [chr(kind) for kind in self.kinds]
+        sizes = _from_bytes("Q", self.sizes)
+        mtimes = _from_bytes("q", self.mtimes)
+        return list(zip(names, kinds, sizes, mtimes))
+
+    def subdirectories(self) -> List[str]:
+        if not self.kinds:
+            return []
+
+        names = self.names.split(b"\0")
+        return [
+            os.fsdecode(name)
+            for name, kind in zip(names, self.kinds)
+            if kind == KIND_DIRECTORY
+        ]
+
+
+class ListingCache:
+    """
+    Recent directory listings on the server
+
+    A listing is reused while the directory's mtime is unchanged, which covers
+    entries being added, removed or renamed. Changes to the entries themselves
+    don't touch the directory, so listings are also relisted after max_age
+    seconds to pick up new sizes and mtimes.
+
+    Args:
+        max_entries: the number of listings to keep
+        max_age: the number of seconds a listing is reused for
+    """
+
+    def __init__(self, max_entries: int = 1024, max_age: float = 10):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.listings = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, path) -> DirListing:
+        """
+        Returns the listing of a directory, listing it only if needed
+
+        Raises:
+            OSError: if the directory can't be listed
+        """
+        path = str(path)
+        mtime_ns = os.stat(path).st_mtime_ns
+        now = time.time_ns()
+
+        with self.lock:
+            cached = self.listings.get(path)
+            if cached is not None:
+                listed_at, listing = cached
+                if (
+                    listing.mtime_ns == mtime_ns
+                    and now - listed_at < self.max_age * 1e9
+                ):
+                    self.listings.move_to_end(path)
+                    return listing
+
+        listing = DirListing.read(path)
+        with self.lock:
+            if now - listing.mtime_ns > RACY_WINDOW_NS:
+                self.listings[path] = (now, listing)
+                self.listings.move_to_end(path)
+                while len(self.listings) > self.max_entries:
+                    self.listings.popitem(last=False)
+            else:
+                self.listings.pop(path, None)
+
+        return listing
+
+
+class LocalListingCache:
+    """
+    Directory listings kept on the client
+
+    Listings are dropped as the server reports changes to the files in them, and
+    revalidated once they are older than max_age seconds, which covers directories
+    that the server doesn't watch. Revalidating only transfers the listing if it
+    changed. Listing a directory can prefetch its subdirectories in the background
+    so that completing the next path component doesn't wait on the network.
+
+    Args:
+        fetch: called with a list of (path, validator) tuples, where validator is
+            the digest of the cached listing or None. Returns a future that
+            resolves to a list with the DirListing of each path, None if it still
+            matches the validator or the OSError raised listing it
+        max_entries: the number of listings to keep
+        max_age: the number of seconds a listing is used without being revalidated
+        max_prefetch: the maximum number of subdirectories prefetched at once
+    """
+
+    def __init__(
+        self,
+        fetch,
+        max_entries: int = 4096,
+        max_age: float = 30,
+        max_prefetch: int = 32,
+    ):
+        self.fetch = fetch
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.max_prefetch = max_prefetch
+
+        # path -> (fetched_at, listing)
+        self.listings = OrderedDict()
+        self.prefetching = set()
+        self.lock = Lock()
+
+    def get(self, path: str, prefetch: bool = False) -> DirListing:
+        """
+        Returns the listing of a directory on the server
+
+        Args:
+            path: the absolute path of the directory on the server
+            prefetch: whether to prefetch the subdirectories in the background
+        Raises:
+            OSError: if the directory can't be listed
+        """
+        with self.lock:
+            cached = self.listings.get(path)
+            if cached is not None:
+                self.listings.move_to_end(path)
+
+        now = time.monotonic()
+        if cached is not None and now - cached[0] < self.max_age:
+            listing = cached[1]
+        else:
+            validator = None if cached is None else cached[1].digest()
+            (listing,) = self.fetch([(path, validator)]).result()
+            if isinstance(listing, OSError):
+                raise listing
+            if listing is None:
+                listing = cached[1]
+            self.put(path, listing, now)
+
+        if prefetch:
+            self.prefetch(
+                [os.path.join(path, name) for name in listing.subdirectories()]
+            )
+
+        return listing
+
+    def put(self, path: str, listing: DirListing, fetched_at: float):
+        with self.lock:
+            self.listings[path] = (fetched_at, listing)
+            self.listings.move_to_end(path)
+            while len(self.listings) > self.max_entries:
+                self.listings.popitem(last=False)
+
+    def prefetch(self, paths: List[str]):
+        with self.lock:
+            paths = [
+                path
+                for path in paths
+                if path not in self.listings and path not in self.prefetching
+            ][: self.max_prefetch]
+            self.prefetching.update(paths)
+
+        if not paths:
+            return
+
+        fetched_at = time.monotonic()
+
+        def done(future):
+            with self.lock:
+                self.prefetching.difference_update(paths)
+            if future.exception() is not None:
+                return
+
+            for path, listing in zip(paths, future.result()):
+                if isinstance(listing, DirListing):
+                    self.put(path, listing, fetched_at)
+
+        self.fetch([(path, None) for path in paths]).add_done_callback(done)
+
+    def invalidate(self, paths: List[str] = (), everything: bool = False):
+        """
+        Drops the listings of the directories containing paths, and of paths and
+        everything under them in case they were directories
+
+        Args:
+            paths: absolute paths on the server that changed
+            everything: whether to drop every listing
+        """
+        with self.lock:
+            if everything:
+                self.listings.clear()
+                return
+
+            prefixes = []
+            for path in paths:
+                self.listings.pop(os.path.dirname(path), None)
+                self.listings.pop(path, None)
+                prefixes.append(path + "/")
+
+            if prefixes:
+                prefixes = tuple(prefixes)
+                for cached in [p for p in self.listings if p.startswith(prefixes)]:
+                    del self.listings[cached]
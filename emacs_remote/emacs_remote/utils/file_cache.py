@@ -0,0 +1,286 @@
+import fcntl
+import hashlib
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import astuple, dataclass
+from pathlib import Path
+from threading import Lock
+
+import msgpack
+
+from .files import AtomicFileWriter, map_file
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+
+def content_hasher():
+    """
+    Returns a hash object used to tell whether two copies of a file are identical
+    """
+    return hashlib.blake2b(digest_size=16)
+
+
+def content_digest(data) -> str:
+    hasher = content_hasher()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def is_not_modified(validator, path: Path, stat: os.stat_result) -> bool:
+    """
+    Checks whether the copy of a file described by a validator is up to date
+
+    A matching size and modification time is trusted. If only the time differs,
+    the contents are hashed so that touched but unchanged files are not resent.
+
+    Args:
+        validator: the validator of the copy, as returned by `CacheEntry.validator`.
+            May be None
+        path: the path of the file
+        stat: the result of stat on the file
+    """
+    if validator is None:
+        return False
+
+    mtime_ns, size, digest = validator
+    if size != stat.st_size:
+        return False
+
+    if mtime_ns == stat.st_mtime_ns:
+        return True
+
+    with map_file(path) as m:
+        return content_digest(m) == digest
+
+
+@dataclass
+class CacheEntry:
+    """
+    What is known about the local copy of a file on the server
+
+    Args:
+        mtime_ns: the modification time of the file on the server
+        size: the size of the file in bytes
+        digest: the `content_digest` of the file
+        local_mtime_ns: the modification time of the local copy when it was written.
+            A local copy with a different time was edited and is not trusted
+    """
+
+    mtime_ns: int
+    size: int
+    digest: str
+    local_mtime_ns: int
+
+    @property
+    def validator(self):
+        """
+        The validator sent to the server to skip fetching unchanged files
+        """
+        return [self.mtime_ns, self.size, self.digest]
+
+
+class FileCache:
+    """
+    Persistent index of the files mirrored from the server
+
+    Entries are kept in least recently used order and saved to disk after every
+    change, so the index survives restarts of the client. Once the mirrored files
+    take more than max_bytes, the least recently used local copies are deleted.
+
+    The index is shared by the daemon and the interfaces of a workspace. Changes
+    are made under an exclusive `flock` of a lock file next to it, from reloading
+    the index to saving it, so that no process overwrites the changes of another.
+
+    Args:
+        path: the file the index is stored in
+        local_path: the function mapping (file_path, absolute) to the local copy of
+            a file
+        max_bytes: the maximum total size of the cached files
+    """
+
+    def __init__(self, path: Path, local_path, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = Path(path)
+        self.lock_path = self.path.with_name(f"{self.path.name}.lock")
+        self.local_path = local_path
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_size = 0
+        # Keys used since the index was last saved, in order. Hits aren't saved
+        # right away, so they are applied again whenever the index is reloaded
+        self.used = OrderedDict()
+        self.lock = Lock()
+
+        self.load()
+
+    @staticmethod
+    def key(file_path: str, absolute: bool = False):
+        return f"{int(absolute)}:{file_path}"
+
+    @contextmanager
+    def file_lock(self):
+        """
+        Holds the lock on the index shared with other processes
+        """
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "ab") as f:
+            # Released when the file is closed
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    @contextmanager
+    def locked(self):
+        """
+        Holds the index lock of this process and of other processes, and reloads
+        the index once they are held
+        """
+        with self.lock, self.file_lock():
+            self._reload()
+            yield
+
+    def load(self):
+        try:
+            data = msgpack.unpackb(self.path.read_bytes(), raw=False)
+            entries = [(key, CacheEntry(*fields)) for key, *fields in data]
+        except (FileNotFoundError, ValueError, TypeError):
+            # A missing or corrupt index only means files are fetched again
+            return
+
+        for key, entry in entries:
+            self.entries[key] = entry
+            self.total_size += entry.size
+
+    def _reload(self):
+        self.entries.clear()
+        self.total_size = 0
+        self.load()
+
+        for key in self.used:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+
+    def reload(self):
+        """
+        Reloads the index from disk, as other processes may have updated it
+        """
+        with self.locked():
+            pass
+
+    def save(self):
+        data = [(key, *astuple(entry)) for key, entry in self.entries.items()]
+        with AtomicFileWriter(self.path) as writer:
+            writer.write(msgpack.packb(data, use_bin_type=True))
+            writer.commit()
+
+        self.used.clear()
+
+    def get(self, file_path: str, absolute: bool = False) -> CacheEntry:
+        """
+        Returns the entry of a file if its local copy is unchanged, else None
+        """
+        key = self.key(file_path, absolute)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+
+            try:
+                stat = self.local_path(file_path, absolute).stat()
+            except FileNotFoundError:
+                stat = None
+
+            if (
+                stat is None
+                or stat.st_size != entry.size
+                or stat.st_mtime_ns != entry.local_mtime_ns
+            ):
+                with self.file_lock():
+                    self._reload()
+                    # Unless another process has recorded a new copy since
+                    if self.entries.get(key) == entry:
+                        del self.entries[key]
+                        self.total_size -= entry.size
+                        self.save()
+                return None
+
+            self.entries.move_to_end(key)
+            self.used[key] = None
+            self.used.move_to_end(key)
+            return entry
+
+    def validator(self, file_path: str, absolute: bool = False):
+        """
+        Returns the validator of the local copy of a file, or None if not cached
+        """
+        entry = self.get(file_path, absolute)
+        return entry.validator if entry is not None else None
+
+    def update(
+        self,
+        file_path: str,
+        absolute: bool,
+        mtime_ns: int,
+        size: int,
+        digest: str,
+    ):
+        """
+        Records the server's version of a file after its local copy was written
+        """
+        key = self.key(file_path, absolute)
+        local_path = self.local_path(file_path, absolute)
+        entry = CacheEntry(mtime_ns, size, digest, local_path.stat().st_mtime_ns)
+
+        # Other processes may have updated the index since it was loaded
+        with self.locked():
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.total_size -= previous.size
+
+            self.entries[key] = entry
+            self.total_size += entry.size
+            self.evict()
+            self.save()
+
+    def invalidate(self, file_paths=(), absolute: bool = False, everything=False):
+        """
+        Forgets files that changed on the server so that they are fetched again
+
+        The index is reloaded first as other processes may have updated it.
+
+        Args:
+            file_paths: the files (or directories) that changed
+            absolute: whether the file paths are absolute
+            everything: if True, every file is forgotten
+        """
+        with self.locked():
+            if everything:
+                keys = list(self.entries)
+            else:
+                keys = [self.key(file_path, absolute) for file_path in file_paths]
+                # Paths that aren't cached files may be directories that were removed
+                prefixes = tuple(f"{key}/" for key in keys if key not in self.entries)
+                if prefixes:
+                    keys.extend(key for key in self.entries if key.startswith(prefixes))
+
+            removed = [self.entries.pop(key, None) for key in keys]
+            removed = [entry for entry in removed if entry is not None]
+            if not removed:
+                return
+
+            self.total_size -= sum(entry.size for entry in removed)
+            self.save()
+
+    def evict(self):
+        # The most recently used entry is always kept, even if it is too big
+        while self.total_size > self.max_bytes and len(self.entries) > 1:
+            key, entry = self.entries.popitem(last=False)
+            self.total_size -= entry.size
+
+            absolute, file_path = key.split(":", 1)
+            local_path = self.local_path(file_path, bool(int(absolute)))
+            try:
+                # Local copies that were edited since they were fetched are kept
+                if local_path.stat().st_mtime_ns == entry.local_mtime_ns:
+                    os.unlink(local_path)
+            except FileNotFoundError:
+                pass
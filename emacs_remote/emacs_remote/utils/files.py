@@ -0,0 +1,98 @@
+import mmap
+import os
+import stat
+import tempfile
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+
+
+@contextmanager
+def map_file(path: Path):
+    """
+    Maps a file into memory read only
+
+    Yields an empty bytes object for empty files as they can't be mapped.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            yield m
+
+
+class AtomicFileWriter:
+    """
+    Writes a file through a temporary file that is renamed into place on commit
+
+    The temporary file is created next to the destination so that the rename is
+    atomic. Readers never see a partially written file, and an interrupted transfer
+    leaves the previous contents untouched.
+
+    Args:
+        path: the destination path
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, self.temp_path = tempfile.mkstemp(
+            dir=self.path.parent, prefix=f".{self.path.name}.", suffix=".part"
+        )
+        self.file = os.fdopen(fd, "wb")
+
+        self.size = 0
+        self.checksum = 0
+
+    def write(self, data):
+        """
+        Appends data to the file, updating the running size and crc32 checksum
+        """
+        self.file.write(data)
+        self.size += len(data)
+        self.checksum = zlib.crc32(data, self.checksum)
+
+    def commit(self, size: int = None, checksum: int = None):
+        """
+        Moves the file into place after verifying its size and checksum
+
+        Args:
+            size: the expected size. Not checked if None
+            checksum: the expected crc32 checksum. Not checked if None
+        """
+        self.file.close()
+
+        if size is not None and size != self.size:
+            self.abort()
+            raise ValueError(f"Expected {size} bytes for {self.path}. Got {self.size}")
+
+        if checksum is not None and checksum != self.checksum:
+            self.abort()
+            raise ValueError(f"Checksum mismatch for {self.path}")
+
+        # mkstemp creates files only readable by the owner. Keep the permissions of
+        # the file being replaced instead
+        try:
+            mode = stat.S_IMODE(os.stat(self.path).st_mode)
+        except FileNotFoundError:
+            mode = 0o644
+        os.chmod(self.temp_path, mode)
+
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is not None:
+            self.abort()
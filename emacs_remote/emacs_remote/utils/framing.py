@@ -0,0 +1,354 @@
+import socket
+from dataclasses import is_dataclass
+from threading import local
+
+import msgpack
+
+from ..messages.codec import MessageCodec
+from ..messages.registry import MessageTypeRegistry
+from .compression import CompressionPolicy, decompress
+
+HEADER_SIZE = 16
+
+
+MAX_REQUEST_ID = 2**32 - 1
+
+# Set on every frame of a streamed response except for the last one. The lower
+# bits of the flags are reserved for the compression codec id
+FLAG_MORE = 0x10
+
+# Set when big bytes fields were taken out of the packed message. The payload is
+# then the size of the packed message as 4 big endian bytes, the packed message
+# and the bytes of those fields, in order
+FLAG_BUFFERS = 0x20
+
+# Bytes of a streamed response that may be sent before the client grants more
+# credit. Every stream starts with this much
+STREAM_WINDOW = 4 * 1024 * 1024
+
+
+def pack_header(
+    message_type: int, message_size: int, flags: int = 0, request_id: int = 0
+) -> bytes:
+    """
+    Packs the fixed size frame header that precedes every payload
+
+    Args:
+        message_type: the registry index of the message type
+        message_size: the size of the (compressed) payload in bytes
+        flags: frame flags. The lower bits hold the compression codec id
+        request_id: id used to match a response to its request when multiple
+            requests are in flight on the same connection. 0 if not multiplexed
+    Returns:
+        The header padded with null bytes to HEADER_SIZE bytes
+    """
+    assert 0 <= request_id <= MAX_REQUEST_ID
+    header = msgpack.packb((message_type, message_size, flags, request_id))
+    assert len(header) <= HEADER_SIZE, "Expected header to be less than 16 bytes"
+    return header.ljust(HEADER_SIZE, b"\x00")
+
+
+def unpack_header(header) -> tuple:
+    """
+    Unpacks a header packed by `pack_header`
+
+    Args:
+        header: a bytes-like object of length HEADER_SIZE
+    Returns:
+        A (message_type, message_size, flags, request_id) tuple
+    """
+    # msgpack stops at the end of the first object so the padding can be ignored
+    unpacker = msgpack.Unpacker()
+    unpacker.feed(header)
+    return tuple(unpacker.unpack())
+
+
+_local = local()
+
+# Codecs of the nested dataclasses met so far, which needn't be registered
+_nested_codecs = {}
+
+
+def _pack_default(obj):
+    # Nested dataclasses are sent as lists of their fields. Only the top level is
+    # taken apart here, the packer calls back for any dataclass in the fields
+    codec = _nested_codecs.get(type(obj))
+    if codec is None:
+        if not is_dataclass(obj) or isinstance(obj, type):
+            raise TypeError(f"Cannot serialize {obj!r}")
+
+        codec = _nested_codecs[type(obj)] = MessageCodec(type(obj), None)
+
+    return codec.encode(obj)
+
+
+def _packer() -> msgpack.Packer:
+    # Packers are reused but can't be shared between threads
+    packer = getattr(_local, "packer", None)
+    if packer is None:
+        packer = _local.packer = msgpack.Packer(default=_pack_default)
+    return packer
+
+
+def encode_message(
+    data,
+    request_id: int = 0,
+    compression: CompressionPolicy = None,
+    peer=None,
+    more: bool = False,
+):
+    """
+    Serializes and compresses a message into a frame
+
+    Args:
+        data: the message to encode. Must be of a registered type
+        request_id: the id of the request that the message belongs to
+        compression: the compression policy to use. If None, no compression is used
+        peer: the `Capabilities` negotiated with the peer. If None, the peer is
+            assumed to support every codec and feature
+        more: whether more messages will follow for the same request id
+    Returns:
+        A (header, payload) tuple. payload is a list of bytes-like objects that
+        are sent in order. Big bytes fields of the message are in it as they are
+    Raises:
+        TypeError: if the peer doesn't know the type of the message
+        ValueError: if the payload is bigger than the peer accepts
+    """
+    message_type_cls = type(data)
+    try:
+        codec = MessageTypeRegistry.get_codec(message_type_cls)
+    except KeyError:
+        raise TypeError(f"Expected data to be of a registered type. Got {type(data)}")
+
+    if peer is not None and not peer.supports(message_type_cls):
+        raise TypeError(f"Peer does not support {message_type_cls.__name__}")
+
+    buffers = [] if peer is None or peer.has("buffers") else None
+    packed = _packer().pack(codec.encode(data, buffers))
+
+    flags = 0
+    if buffers:
+        flags |= FLAG_BUFFERS
+        payload = [len(packed).to_bytes(4, "big"), packed, *buffers]
+    else:
+        payload = [packed]
+
+    if peer is not None:
+        # The peer limits the size both before and after decompression
+        size = sum(len(buffer) for buffer in payload)
+        if size > peer.max_frame_size:
+            raise ValueError(
+                f"{message_type_cls.__name__} of {size} bytes exceeds the peer's "
+                f"maximum frame size of {peer.max_frame_size} bytes"
+            )
+
+    if compression is not None:
+        supported = None if peer is None else peer.codecs
+        codec_id, payload = compression.compress(message_type_cls, payload, supported)
+        flags |= codec_id
+        if codec_id:
+            payload = [payload]
+
+    if more:
+        flags |= FLAG_MORE
+
+    size = sum(len(buffer) for buffer in payload)
+    return pack_header(codec.type_id, size, flags, request_id), payload
+
+
+class MessageUnpacker:
+    """
+    Unpacks the messages received on one connection with a single `msgpack.Unpacker`
+
+    Args:
+        max_size: the maximum size of a packed message
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.unpacker = msgpack.Unpacker(max_buffer_size=max_size)
+
+    def unpack(self, data):
+        """
+        Unpacks a whole packed message, like `msgpack.unpackb`
+
+        Raises:
+            ValueError: if data holds less or more than a single object
+        """
+        unpacker = self.unpacker
+        start = unpacker.tell()
+        try:
+            unpacker.feed(data)
+            values = unpacker.unpack()
+            if unpacker.tell() - start != len(data):
+                raise ValueError("Extra data after the packed message")
+        except Exception:
+            # What was left of the message would be read as part of the next one
+            self.unpacker = msgpack.Unpacker(max_buffer_size=self.max_size)
+            raise
+
+        return values
+
+
+def decode_message(
+    message_type: int,
+    flags: int,
+    payload,
+    max_size: int = None,
+    unpacker: MessageUnpacker = None,
+):
+    """
+    Decompresses and deserializes the payload of a frame
+
+    Args:
+        message_type: the message type from the frame header
+        flags: the flags from the frame header
+        payload: a bytes-like object holding the payload
+        max_size: the maximum size of the decompressed payload
+        unpacker: the unpacker of the connection the frame was received on. If
+            None, `msgpack.unpackb` is used
+    Returns:
+        The message
+    Raises:
+        ValueError: if the payload decompresses to more than max_size bytes
+    """
+    data = decompress(flags, payload, max_size)
+    codec = MessageTypeRegistry.get_codec(message_type)
+    unpack = msgpack.unpackb if unpacker is None else unpacker.unpack
+    if not flags & FLAG_BUFFERS:
+        return codec.decode(unpack(data))
+
+    data = memoryview(data)
+    end = 4 + int.from_bytes(data[:4], "big")
+    return codec.decode(unpack(data[4:end]), data[end:])
+
+
+class RecvBuffer:
+    """
+    Preallocated, growable receive buffer
+
+    Bytes are received directly into the buffer using `recv_into` and consumed
+    through memoryview cursors, so no bytes are copied when a frame is taken off the
+    front of the buffer. The buffer is only ever compacted or grown when there is not
+    enough room left at the end of it for the frame currently being received.
+
+    Args:
+        capacity: the initial size of the buffer in bytes
+    """
+
+    def __init__(self, capacity: int = 64 * 1024):
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    @property
+    def capacity(self):
+        return len(self.buffer)
+
+    def reserve(self, size: int):
+        """
+        Makes sure that there is room for at least `size` unconsumed bytes
+
+        Args:
+            size: the number of bytes that will need to be held by the buffer
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        if self.start + size <= self.capacity:
+            return
+
+        pending = self.end - self.start
+        if size <= self.capacity:
+            # Move the unconsumed bytes to the front of the buffer
+            self.view[:pending] = self.view[self.start : self.end]
+        else:
+            # Allocate a new buffer instead of resizing in place as views previously
+            # returned by `consume` may still be referencing the old one
+            capacity = self.capacity
+            while capacity < size:
+                capacity *= 2
+
+            buffer = bytearray(capacity)
+            view = memoryview(buffer)
+            view[:pending] = self.view[self.start : self.end]
+            self.buffer = buffer
+            self.view = view
+
+        self.start = 0
+        self.end = pending
+
+    def fill(self, sock: socket.socket, size: int) -> bool:
+        """
+        Receives from the socket until at least `size` bytes are buffered
+
+        Args:
+            sock: the socket to receive from
+            size: the number of bytes that are required
+        Returns:
+            False if the connection was closed before enough bytes were received
+        """
+        if len(self) >= size:
+            return True
+
+        self.reserve(size)
+        while len(self) < size:
+            num_bytes = sock.recv_into(self.view[self.end :])
+            if num_bytes == 0:
+                return False
+
+            self.end += num_bytes
+
+        return True
+
+    def peek(self, size: int) -> memoryview:
+        """
+        Returns a view of the first `size` unconsumed bytes without consuming them
+        """
+        assert size <= len(self)
+        return self.view[self.start : self.start + size]
+
+    def consume(self, size: int) -> memoryview:
+        """
+        Takes `size` bytes off the front of the buffer without copying them
+
+        The returned view is only valid until the next call to `fill` or `reserve`.
+
+        Args:
+            size: the number of bytes to consume
+        Returns:
+            A memoryview of the consumed bytes
+        """
+        view = self.peek(size)
+        self.start += size
+        return view
+
+
+def send_buffers(sock: socket.socket, *buffers):
+    """
+    Sends all buffers using a single scatter-gather `sendmsg` call where possible
+
+    Args:
+        sock: the socket to send on
+        buffers: the bytes-like objects to send, in order
+    """
+    if not hasattr(sock, "sendmsg"):
+        for buffer in buffers:
+            sock.sendall(buffer)
+        return
+
+    views = [memoryview(buffer).cast("B") for buffer in buffers if len(buffer) > 0]
+    while views:
+        num_bytes = sock.sendmsg(views)
+
+        # Advance past whatever was sent in case of a partial send
+        while views and num_bytes >= len(views[0]):
+            num_bytes -= len(views[0])
+            views.pop(0)
+
+        if views and num_bytes > 0:
+            views[0] = views[0][num_bytes:]
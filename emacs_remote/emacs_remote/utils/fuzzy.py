@@ -0,0 +1,278 @@
+import os
+import re
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from heapq import nsmallest
+from itertools import accumulate
+from threading import Lock
+from typing import List
+
+# Candidates beyond this many are ranked by a cheap key before being scored
+MAX_SCORED = 2_000
+
+_SEPARATORS = "/_-. "
+
+SCORE_MATCH = 16
+BONUS_SEGMENT = 10
+BONUS_SEPARATOR = 8
+BONUS_CAMEL = 7
+BONUS_CONSECUTIVE = 6
+BONUS_BASENAME = 8
+PENALTY_GAP = 1
+
+
+def _lower(path: str) -> str:
+    # Keep one character per character so that match positions line up
+    lower = path.lower()
+    if len(lower) == len(path):
+        return lower
+    return "".join(c.lower() if len(c.lower()) == 1 else c for c in path)
+
+
+def subsequence_pattern(query: str):
+    """
+    Compiles a regex that finds the lines of a `Lines` text that contain query as
+    a subsequence
+
+    Each character only scans up to the next occurrence of itself. None of what it
+    scanned past can be that character, so backtracking into it fails at once and
+    the regex stays linear.
+    """
+    parts = ["\n"]
+    for c in query:
+        c = re.escape(c)
+        parts.append(f"[^{c}\n]*{c}")
+
+    return re.compile("".join(parts))
+
+
+class Lines:
+    """
+    Strings joined into a single text so that a regex can search all of them in
+    one call
+
+    Args:
+        strings: the strings, which must not contain newlines
+        ids: the id of each string, returned by `search`
+    """
+
+    def __init__(self, strings: List[str], ids: array):
+        # Every line starts right after a newline so that patterns can start with
+        # a literal newline, which the regex engine scans for quickly
+        self.text = "\n" + "\n".join(strings)
+        self.ids = ids
+        # The offset of the newline before each line. A list as bisect is much
+        # slower on arrays
+        self.starts = list(accumulate(map((1).__add__, map(len, strings)), initial=0))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, pattern) -> array:
+        """
+        Returns the ids of the lines matched by a `subsequence_pattern`
+        """
+        starts, ids = self.starts, self.ids
+        result = array("I")
+        line = 0
+        for match in pattern.finditer(self.text):
+            # Matches come in order, so only the lines after the last one are searched
+            line = bisect_right(starts, match.start(), line) - 1
+            result.append(ids[line])
+
+        return result
+
+
+def match_positions(lower: str, query: str, start: int = 0):
+    """
+    Finds where the characters of query match in a lowercase path
+
+    The first match found going forward fixes the end of the match. Going back
+    from there finds the shortest match ending there, which avoids matching the
+    first character of the query way before the rest of it.
+
+    Returns:
+        The positions of each character of the query, or None if there's no match
+    """
+    position = start
+    for c in query:
+        position = lower.find(c, position)
+        if position == -1:
+            return None
+        position += 1
+
+    end = position
+    for c in reversed(query):
+        end = lower.rfind(c, start, end)
+    positions = []
+    position = end
+    for c in query:
+        position = lower.find(c, position)
+        positions.append(position)
+        position += 1
+
+    return positions
+
+
+def score_positions(path: str, positions: List[int], basename_start: int) -> int:
+    score = 0
+    previous = None
+    for position in positions:
+        score += SCORE_MATCH
+        before = path[position - 1] if position > 0 else "/"
+        if before == "/":
+            score += BONUS_SEGMENT
+        elif before in _SEPARATORS:
+            score += BONUS_SEPARATOR
+        elif before.islower() and path[position].isupper():
+            score += BONUS_CAMEL
+
+        if previous is not None:
+            if position == previous + 1:
+                score += BONUS_CONSECUTIVE
+            else:
+                score -= PENALTY_GAP * min(position - previous - 1, 16)
+        previous = position
+
+    if positions and positions[0] >= basename_start:
+        score += BONUS_BASENAME
+
+    return score
+
+
+class FuzzyFinder:
+    """
+    Fuzzy matches queries against the paths in a `ProjectIndex`
+
+    The lowercase form and basename offset of every path is computed once per
+    generation of the index. Candidates are found with a single regex scan over all
+    paths, and only the candidates are scored. The candidates of recent queries are
+    kept, so a query that extends a previous one (the next keystroke) only has to
+    scan the previous candidates.
+
+    Args:
+        index: the project index to search
+        max_queries: the number of recent queries whose candidates are kept
+    """
+
+    def __init__(self, index, max_queries: int = 32):
+        self.index = index
+        self.max_queries = max_queries
+
+        self.version = None
+        self.paths = []
+        self.lower = []
+        self.lengths = array("H")
+        self.basename_starts = array("H")
+        self.lines = None
+        self.basenames = None
+
+        self.candidates = OrderedDict()
+        self.lock = Lock()
+
+    def refresh(self):
+        """
+        Rebuilds the precomputed forms if the index changed
+        """
+        with self.index.lock:
+            version = (self.index.index_id, self.index.generation)
+            if version == self.version:
+                return
+            paths = self.index.paths_unlocked()
+
+        self.paths = [os.fsdecode(path) for path in paths]
+        # Newlines separate the lines of the searched text
+        self.lower = [_lower(path).replace("\n", "\0") for path in self.paths]
+        self.lengths = array("H", map(len, self.paths))
+        self.basename_starts = array("H", (path.rfind("/") + 1 for path in self.paths))
+
+        ids = array("I", range(len(self.paths)))
+        self.lines = Lines(self.lower, ids)
+        self.basenames = Lines(
+            [lower[start:] for lower, start in zip(self.lower, self.basename_starts)],
+            ids,
+        )
+
+        self.candidates.clear()
+        self.version = version
+
+    def find_candidates(self, query: str) -> Lines:
+        # Reuse the candidates of the longest previous query that this one extends
+        previous = None
+        for old_query in self.candidates:
+            if query.startswith(old_query) and (
+                previous is None or len(old_query) > len(previous)
+            ):
+                previous = old_query
+
+        if previous == query:
+            self.candidates.move_to_end(query)
+            return self.candidates[query]
+
+        lines = self.lines if previous is None else self.candidates[previous]
+        ids = lines.search(subsequence_pattern(query))
+        candidates = Lines([self.lower[i] for i in ids], ids)
+
+        self.candidates[query] = candidates
+        while len(self.candidates) > self.max_queries:
+            self.candidates.popitem(last=False)
+
+        return candidates
+
+    def rank_candidates(self, query: str, candidates: Lines):
+        """
+        Picks the candidates worth scoring when there are too many to score them all
+
+        Candidates whose basename matches the query come first, then shorter paths.
+        """
+        if len(candidates) <= MAX_SCORED:
+            return candidates.ids
+
+        in_basename = set(self.basenames.search(subsequence_pattern(query)))
+        preferred = [i for i in candidates.ids if i in in_basename]
+        preferred.sort(key=self.lengths.__getitem__)
+        if len(preferred) >= MAX_SCORED:
+            return preferred[:MAX_SCORED]
+
+        others = [i for i in candidates.ids if i not in in_basename]
+        others = nsmallest(
+            MAX_SCORED - len(preferred), others, key=self.lengths.__getitem__
+        )
+        return preferred + others
+
+    def find(self, query: str, k: int = 20):
+        """
+        Finds the paths that best match a query
+
+        Args:
+            query: the characters to match, in order. Case and spaces are ignored
+            k: the number of matches to return
+        Returns:
+            A (num_candidates, matches) tuple where matches is a list of
+            (path, score, positions) sorted from best to worst
+        """
+        query = "".join(_lower(query).split())
+
+        with self.lock:
+            self.refresh()
+            if not query:
+                return len(self.paths), [(path, 0, []) for path in self.paths[:k]]
+
+            candidates = self.find_candidates(query)
+
+            matches = []
+            for i in self.rank_candidates(query, candidates):
+                path, lower = self.paths[i], self.lower[i]
+                basename_start = self.basename_starts[i]
+
+                positions = match_positions(lower, query, basename_start)
+                if positions is None:
+                    positions = match_positions(lower, query)
+                score = score_positions(path, positions, basename_start)
+                matches.append((-score, len(path), path, positions))
+
+            best = nsmallest(k, matches)
+            return len(candidates), [
+                (path, -score, positions) for score, _, path, positions in best
+            ]
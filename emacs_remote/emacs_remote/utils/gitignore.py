@@ -0,0 +1,241 @@
+import os
+import re
+from pathlib import Path
+from threading import Lock
+
+
+def translate_glob(pattern: str) -> str:
+    """
+    Translates a gitignore glob into a regular expression
+    """
+    i, n = 0, len(pattern)
+    out = []
+    while i < n:
+        c = pattern[i]
+        if c == "*":
+            stars = i
+            while i < n and pattern[i] == "*":
+                i += 1
+
+            double = i - stars > 1
+            at_start = stars == 0 or pattern[stars - 1] == "/"
+            if double and at_start and i == n:
+                # Trailing "**" matches everything inside
+                out.append(".*")
+            elif double and at_start and pattern[i] == "/":
+                # "**/" matches zero or more directories
+                out.append("(?:.*/)?")
+                i += 1
+            else:
+                out.append("[^/]*")
+            continue
+
+        if c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            # A "]" right after the opening bracket (or negation) is literal
+            start = i + 1
+            if pattern[start : start + 1] in ("!", "^"):
+                start += 1
+            if pattern[start : start + 1] == "]":
+                start += 1
+
+            end = pattern.find("]", start)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                contents = pattern[i + 1 : end].replace("\\", "\\\\")
+                if contents[0] in "!^":
+                    contents = "^" + contents[1:]
+                out.append(f"[{contents}]")
+                i = end
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        else:
+            out.append(re.escape(c))
+        i += 1
+
+    return "".join(out)
+
+
+class GitIgnore:
+    """
+    The rules of a single .gitignore file
+
+    Args:
+        base: the directory the file is in, relative to the root of the walk.
+            Empty for the root
+        lines: the lines of the file
+    """
+
+    def __init__(self, base: str, lines):
+        self.base = base
+        self.rules = []
+        for line in lines:
+            rule = self.parse(line)
+            if rule is not None:
+                self.rules.append(rule)
+
+    @staticmethod
+    def parse(line: str):
+        line = line.rstrip("\r\n")
+        if not line or line.startswith("#"):
+            return None
+
+        # Trailing spaces are ignored unless escaped
+        while line.endswith(" ") and not line.endswith("\\ "):
+            line = line[:-1]
+
+        negate = line.startswith("!")
+        if negate or line.startswith(("\\!", "\\#")):
+            line = line[1:]
+
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            return None
+
+        # Patterns with a slash anywhere but the end are relative to the .gitignore
+        anchored = "/" in line
+        regex = translate_glob(line.lstrip("/"))
+        if not anchored:
+            regex = "(?:.*/)?" + regex
+
+        return re.compile(regex + r"\Z"), negate, dir_only
+
+    @staticmethod
+    def load(root: Path, base: str, name: str = ".gitignore"):
+        """
+        Loads the rules of a .gitignore file. Returns None if there isn't one
+        """
+        try:
+            with open(os.path.join(root, base, name), errors="replace") as f:
+                return GitIgnore(base, f.readlines())
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            return None
+
+    def match(self, path: str, is_dir: bool):
+        """
+        Returns True if the path is ignored, False if it is explicitly not ignored and
+        None if no rule matches
+
+        Args:
+            path: the path relative to the root of the walk
+            is_dir: whether the path is a directory
+        """
+        if self.base:
+            path = path[len(self.base) + 1 :]
+
+        result = None
+        for regex, negate, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(path):
+                result = not negate
+
+        return result
+
+
+class IgnoreRules:
+    """
+    The gitignore rules that apply inside a directory
+
+    Rules of deeper .gitignore files take precedence over the ones above them.
+
+    Args:
+        root: the root of the walk
+        ignores: the GitIgnore of each directory from the root down
+    """
+
+    def __init__(self, root: Path, ignores=()):
+        self.root = Path(root)
+        self.ignores = tuple(ignores)
+
+    @staticmethod
+    def for_root(root: Path):
+        root = Path(root)
+        ignores = [
+            GitIgnore.load(root, "", os.path.join(".git", "info", "exclude")),
+            GitIgnore.load(root, ""),
+        ]
+        return IgnoreRules(root, [ignore for ignore in ignores if ignore is not None])
+
+    def child(self, path: str):
+        """
+        Returns the rules that apply inside a subdirectory
+
+        Args:
+            path: the subdirectory relative to the root
+        """
+        ignore = GitIgnore.load(self.root, path)
+        if ignore is None:
+            return self
+
+        return IgnoreRules(self.root, self.ignores + (ignore,))
+
+    def ignored(self, path: str, is_dir: bool = False) -> bool:
+        """
+        Whether a path directly inside the directory of these rules is ignored
+
+        Args:
+            path: the path relative to the root
+            is_dir: whether the path is a directory
+        """
+        if is_dir and os.path.basename(path) == ".git":
+            return True
+
+        for ignore in reversed(self.ignores):
+            result = ignore.match(path, is_dir)
+            if result is not None:
+                return result
+
+        return False
+
+
+class IgnoreCache:
+    """
+    Answers whether arbitrary paths under a root are ignored
+
+    Used to filter paths that are not found by a walk, such as files reported by a
+    watcher. The rules of each directory are loaded once.
+
+    Args:
+        root: the root directory
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.rules = {"": IgnoreRules.for_root(self.root)}
+        self.lock = Lock()
+
+    def rules_for(self, directory: str) -> IgnoreRules:
+        with self.lock:
+            rules = self.rules.get(directory)
+        if rules is not None:
+            return rules
+
+        parent = os.path.dirname(directory)
+        rules = self.rules_for(parent).child(directory)
+        with self.lock:
+            self.rules[directory] = rules
+        return rules
+
+    def ignored(self, path: str, is_dir: bool = False) -> bool:
+        """
+        Whether a path, or any directory above it, is ignored
+
+        Args:
+            path: the path relative to the root
+            is_dir: whether the path is a directory
+        """
+        parts = path.split("/")
+        directory = ""
+        for i, part in enumerate(parts):
+            child = f"{directory}/{part}" if directory else part
+            last = i == len(parts) - 1
+            if self.rules_for(directory).ignored(child, is_dir or not last):
+                return True
+            directory = child
+
+        return False
@@ -0,0 +1,155 @@
+import mmap
+from array import array
+from collections import OrderedDict
+from itertools import accumulate, islice
+from threading import Lock
+
+# Number of bytes scanned for newlines at a time while building an index
+_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Number of bytes before the end of the indexed part of a file that are compared
+# with the file before the index is reused
+_CHECK_SIZE = 4096
+
+
+class LineIndex:
+    """
+    Offsets of the start of each line of a file, built lazily
+
+    Only as much of the file as is needed to answer a query is scanned, so asking
+    for the first lines of a huge log is instant. Offsets are stored in an array of
+    unsigned 64-bit ints, 8 bytes per line.
+
+    Args:
+        path: the path of the file to index
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.inode = None
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.offsets = array("Q", [0])
+        # Number of bytes that have been scanned for newlines
+        self.scanned = 0
+        # The last bytes that were scanned
+        self.tail = b""
+
+    def _scan(self, m: mmap.mmap, until_line: int = None):
+        # offsets[-1] is always the start of the first line not fully scanned yet
+        while self.scanned < self.size:
+            if until_line is not None and len(self.offsets) > until_line:
+                return
+
+            # Stop at the last newline of each block so that a partial last line is
+            # scanned again once the rest of it has been written
+            end = min(self.scanned + _BLOCK_SIZE, self.size)
+            last_newline = m.rfind(b"\n", self.scanned, end)
+            if last_newline == -1:
+                # A single line longer than the block
+                last_newline = m.find(b"\n", end, self.size)
+                if last_newline == -1:
+                    return
+
+            block = m[self.scanned : last_newline + 1]
+            lengths = (len(line) + 1 for line in block.split(b"\n")[:-1])
+            offsets = accumulate(lengths, initial=self.scanned)
+            self.offsets.extend(islice(offsets, 1, None))
+            self.scanned = last_newline + 1
+            self.tail = m[max(self.scanned - _CHECK_SIZE, 0) : self.scanned]
+
+    def _check(self, m: mmap.mmap):
+        # A file truncated in place and written past its old size again keeps its
+        # inode, so the index is only reused if it still ends the same way
+        start = self.scanned - len(self.tail)
+        if m[start : self.scanned] != self.tail:
+            self.reset()
+
+    def refresh(self, inode: int, size: int):
+        """
+        Brings the index up to date with the file
+
+        Appended data keeps the index built so far. Anything else (a new file at the
+        same path or a truncated file) throws the index away. Files that were
+        truncated and grew past their old size since are caught by `line_range`.
+        """
+        if inode != self.inode or size < self.size:
+            self.reset()
+            self.inode = inode
+
+        self.size = size
+
+    def line_range(self, m: mmap.mmap, start: int, end: int = None):
+        """
+        Converts a range of lines into a range of bytes
+
+        Negative line numbers count back from the end of the file, which requires
+        the whole file to be indexed.
+
+        Args:
+            m: a mapping of the whole file
+            start: the first line (0-based) of the range
+            end: the line after the last line of the range. If None, the range goes
+                to the end of the file
+        Returns:
+            A (start, end) tuple of byte offsets
+        """
+        with self.lock:
+            self._check(m)
+            if start < 0 or end is None or end < 0:
+                self._scan(m)
+            else:
+                self._scan(m, max(start, end))
+
+            num_lines = len(self.offsets)
+            if self.offsets[-1] == self.size:
+                # The file ends with a newline so there is no line after it
+                num_lines -= 1
+
+            def to_offset(line):
+                if line < 0:
+                    line = max(num_lines + line, 0)
+                if line >= num_lines:
+                    return self.size
+                return self.offsets[line]
+
+            return to_offset(start), self.size if end is None else to_offset(end)
+
+
+class LineIndexCache:
+    """
+    Keeps the line indexes of the most recently used files
+
+    Args:
+        max_files: the maximum number of indexes to keep
+    """
+
+    def __init__(self, max_files: int = 64):
+        self.max_files = max_files
+        self.indexes = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, path, inode: int, size: int) -> LineIndex:
+        """
+        Returns the index of the file, refreshed for its current inode and size
+        """
+        key = str(path)
+        with self.lock:
+            index = self.indexes.pop(key, None)
+            if index is None:
+                index = LineIndex(path)
+
+            self.indexes[key] = index
+            while len(self.indexes) > self.max_files:
+                self.indexes.popitem(last=False)
+
+        with index.lock:
+            index.refresh(inode, size)
+
+        return index
+
+
+line_indexes = LineIndexCache()
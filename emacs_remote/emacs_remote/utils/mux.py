@@ -0,0 +1,370 @@
+from collections import deque
+from concurrent.futures import CancelledError, Future
+from threading import Condition, Lock, Thread
+
+from ..messages.cancel_request import CancelRequest, CreditRequest
+from .atomic import AtomicInt
+from .framing import FLAG_MORE, MAX_REQUEST_ID, STREAM_WINDOW
+from .stcp_socket import SecureTCPSocket
+
+
+class ResponseStream:
+    """
+    Iterates over the messages of a streamed response as they arrive
+
+    The server sends at most STREAM_WINDOW bytes of messages that haven't been
+    consumed yet, and credit is granted back as the stream is iterated over. So a
+    slow consumer slows the server down without ever holding up the other requests
+    on the connection.
+
+    Args:
+        connection: the connection the request is sent on
+    """
+
+    def __init__(self, connection: "MultiplexedConnection" = None):
+        self.connection = connection
+        self.request_id = None
+        # (message, frame size) tuples
+        self.messages = deque()
+        self.consumed = 0
+        self.done = False
+        self.callbacks = []
+        self.condition = Condition()
+
+    def put(self, message, size: int = 0):
+        with self.condition:
+            if self.done:
+                return
+            self.messages.append((message, size))
+            self.condition.notify_all()
+
+    def _finish(self, message, drop: bool = False):
+        with self.condition:
+            if self.done:
+                return
+            if drop:
+                self.messages.clear()
+            self.messages.append((message, 0))
+            self.done = True
+            self.condition.notify_all()
+            callbacks, self.callbacks = self.callbacks, []
+
+        for fn in callbacks:
+            fn(self)
+
+    def add_done_callback(self, fn):
+        """
+        Calls fn with the stream once its final message has arrived, like
+        `Future.add_done_callback`
+        """
+        with self.condition:
+            if not self.done:
+                self.callbacks.append(fn)
+                return
+
+        fn(self)
+
+    def set_result(self, message):
+        self._finish(message)
+
+    def set_exception(self, error: Exception):
+        self._finish(error)
+
+    def abort(self, error: Exception):
+        """
+        Drops the messages not consumed yet and ends the stream with error
+        """
+        self._finish(error, drop=True)
+
+    def cancel(self) -> bool:
+        """
+        Cancels the request, see `MultiplexedConnection.cancel`
+        """
+        if self.connection is None:
+            return False
+        return self.connection.cancel(self)
+
+    def __iter__(self):
+        for message, _ in self.frames():
+            yield message
+
+    def frames(self):
+        """
+        Iterates over the stream like `__iter__`, but yields (message, last) tuples
+        where last tells whether message is the final message of the response
+        """
+        while True:
+            credit = 0
+            with self.condition:
+                self.condition.wait_for(lambda: self.messages)
+                message, size = self.messages.popleft()
+                last = self.done and not self.messages
+
+                self.consumed += size
+                if self.consumed >= STREAM_WINDOW // 2 and not self.done:
+                    credit, self.consumed = self.consumed, 0
+
+            if credit:
+                self.connection.grant(self.request_id, credit)
+
+            if isinstance(message, Exception):
+                raise message
+
+            yield message, last
+
+            if last:
+                return
+
+
+class MultiplexedConnection:
+    """
+    Client end of a persistent connection with many requests in flight at once
+
+    Every request is tagged with a request id in the frame header. Responses are
+    matched back to their requests by a reader thread, so they may arrive in any
+    order.
+
+    The number of requests in flight and the bytes transferred for them so far are
+    tracked so that work can be spread over several connections.
+
+    Args:
+        socket: a connected and negotiated socket
+        logger: the logger to use
+    """
+
+    def __init__(self, socket: SecureTCPSocket, logger=None):
+        self.socket = socket
+        self.logger = logger if logger is not None else socket.logger
+
+        self.pending = {}
+        # request id -> bytes sent and received for the request so far
+        self.pending_bytes = {}
+        self.bytes_in_flight = AtomicInt()
+        # Ids of cancelled requests that the server hasn't sent the end of yet
+        self.cancelled = set()
+        self.lock = Lock()
+        self.next_request_id = 1
+        self.closed = False
+
+        self.reader = Thread(target=self._read_responses)
+        self.reader.daemon = True
+
+    @staticmethod
+    def connect(host: str, port: int, logger=None, compression=None, limits=None):
+        """
+        Opens a new connection and negotiates it with the server
+        """
+        s = SecureTCPSocket(logger=logger, compression=compression, limits=limits)
+        s.connect(host, port)
+        s.negotiate(initiator=True)
+        return MultiplexedConnection(s, logger).start()
+
+    def start(self):
+        self.reader.start()
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def peer(self):
+        """
+        The `Capabilities` negotiated with the server
+        """
+        return self.socket.peer
+
+    def __len__(self):
+        """
+        Returns the number of requests currently in flight
+        """
+        with self.lock:
+            return len(self.pending) + len(self.cancelled)
+
+    def _new_request_id(self):
+        with self.lock:
+            while True:
+                request_id = self.next_request_id
+                self.next_request_id = request_id % MAX_REQUEST_ID + 1
+                if request_id not in self.pending and request_id not in self.cancelled:
+                    return request_id
+
+    def submit(self, request, future=None) -> Future:
+        """
+        Sends a request without waiting for its response
+
+        Args:
+            request: the request to send
+            future: where to put the response. Defaults to a new Future
+        Returns:
+            A future that resolves to the response
+        """
+        if self.closed:
+            raise ConnectionError("Connection is closed")
+
+        if future is None:
+            future = Future()
+
+        request_id = self._new_request_id()
+        future.request_id = request_id
+        with self.lock:
+            self.pending[request_id] = future
+            self.pending_bytes[request_id] = 0
+
+        try:
+            size = self.socket.sendall(request, request_id)
+        except Exception as e:
+            with self.lock:
+                # The reader fails pending requests when the connection breaks
+                failed = self.pending.pop(request_id, None) is not None
+                self.bytes_in_flight -= self.pending_bytes.pop(request_id, 0)
+            if failed:
+                future.set_exception(e)
+        else:
+            # The response may already have arrived
+            with self.lock:
+                if request_id in self.pending_bytes:
+                    self.pending_bytes[request_id] += size
+                    self.bytes_in_flight += size
+
+        return future
+
+    def request(self, request, timeout: float = None):
+        """
+        Sends a request and waits for its response
+
+        Args:
+            request: the request to send
+            timeout: seconds to wait for the response
+        """
+        return self.submit(request).result(timeout=timeout)
+
+    def stream(self, request) -> ResponseStream:
+        """
+        Sends a request whose response is streamed back in multiple messages
+
+        Returns:
+            An iterator over the messages of the response
+        """
+        return self.submit(request, ResponseStream(self))
+
+    def cancel(self, future) -> bool:
+        """
+        Cancels a request sent on this connection
+
+        The future (or stream) of the request is cancelled right away, and the
+        server is told to stop running the request and drop what it has left to
+        send.
+
+        Args:
+            future: the future or stream returned when the request was sent
+        Returns:
+            False if the request already finished or wasn't sent on this connection
+        """
+        request_id = getattr(future, "request_id", None)
+        with self.lock:
+            if self.pending.get(request_id) is not future:
+                return False
+
+            # The id stays reserved until the server has sent the end of the request
+            del self.pending[request_id]
+            self.cancelled.add(request_id)
+
+        self.logger.debug(f"Cancelling request {request_id}")
+        self._send_control(CancelRequest(request_id))
+
+        if isinstance(future, ResponseStream):
+            future.abort(CancelledError())
+        else:
+            future.cancel()
+        return True
+
+    def grant(self, request_id: int, credit: int):
+        """
+        Lets the server send credit more bytes of a streamed response
+        """
+        self._send_control(CreditRequest(request_id, credit))
+
+    def _send_control(self, request):
+        if self.closed:
+            return
+
+        try:
+            self.socket.sendall(request)
+        except OSError as e:
+            self.logger.debug(f"Failed to send {type(request).__name__}: {e}")
+
+    def _read_responses(self):
+        error = None
+        try:
+            while True:
+                received = self.socket.bytes_received
+                request_id, response, flags = self.socket.recv_message()
+                if response is None:
+                    break
+
+                more = flags & FLAG_MORE
+                size = self.socket.bytes_received - received
+                with self.lock:
+                    cancelled = request_id in self.cancelled
+                    if more:
+                        future = self.pending.get(request_id)
+                        if request_id in self.pending_bytes:
+                            self.pending_bytes[request_id] += size
+                            self.bytes_in_flight += size
+                    else:
+                        future = self.pending.pop(request_id, None)
+                        self.cancelled.discard(request_id)
+                        self.bytes_in_flight -= self.pending_bytes.pop(request_id, 0)
+
+                if future is None:
+                    if not cancelled:
+                        self.logger.debug(
+                            f"Dropping response to unknown id {request_id}"
+                        )
+                elif not more:
+                    future.set_result(response)
+                elif isinstance(future, ResponseStream):
+                    future.put(response, size)
+                else:
+                    self.logger.debug(f"Dropping partial response to {request_id}")
+        except Exception as e:
+            if not self.closed:
+                self.logger.error(f"Failed to read response: {e}")
+            error = e
+
+        self.closed = True
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.pending_bytes.clear()
+            self.cancelled.clear()
+            self.bytes_in_flight.value = 0
+
+        for future in pending.values():
+            future.set_exception(ConnectionError(f"Connection closed: {error}"))
+
+    def close(self):
+        if self.closed and not self.reader.is_alive():
+            return
+
+        self.closed = True
+        self.socket.close()
+
+        # Unblock the reader in case it is waiting on a stream nobody is consuming
+        with self.lock:
+            stream_ids = [
+                request_id
+                for request_id, future in self.pending.items()
+                if isinstance(future, ResponseStream)
+            ]
+            streams = [self.pending.pop(request_id) for request_id in stream_ids]
+            for request_id in stream_ids:
+                self.bytes_in_flight -= self.pending_bytes.pop(request_id, 0)
+
+        for stream in streams:
+            stream.set_exception(ConnectionError("Connection closed"))
+
+        if self.reader.is_alive():
+            self.reader.join()
@@ -0,0 +1,455 @@
+import os
+import sys
+import uuid
+from array import array
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import List
+
+from .gitignore import IgnoreCache
+from .watcher import create_watcher
+
+# Number of paths front coded together. Updates only re-encode the blocks they touch
+BLOCK_SIZE = 128
+
+
+class PathBlock:
+    """
+    A sorted run of paths, each stored as the length of the prefix it shares with
+    the previous path and the rest of the path
+
+    Args:
+        shared: the length of the prefix shared with the previous path
+        lengths: the length of the rest of each path
+        suffixes: the rest of each path, concatenated
+    """
+
+    __slots__ = ("first", "shared", "lengths", "suffixes")
+
+    def __init__(self, shared: array, lengths: array, suffixes: bytes):
+        self.shared = shared
+        self.lengths = lengths
+        self.suffixes = suffixes
+        self.first = suffixes[: lengths[0]] if lengths else b""
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @staticmethod
+    def encode(paths: List[bytes]):
+        shared = array("H")
+        lengths = array("H")
+        suffixes = bytearray()
+
+        previous = b""
+        for path in paths:
+            # Binary search on slice comparisons is much faster than a byte by byte
+            # loop in Python
+            prefix, high = 0, min(len(previous), len(path))
+            while prefix < high:
+                middle = (prefix + high + 1) // 2
+                if previous[:middle] == path[:middle]:
+                    prefix = middle
+                else:
+                    high = middle - 1
+
+            shared.append(prefix)
+            lengths.append(len(path) - prefix)
+            suffixes += path[prefix:]
+            previous = path
+
+        return PathBlock(shared, lengths, bytes(suffixes))
+
+    def decode(self) -> List[bytes]:
+        paths = []
+        path = b""
+        offset = 0
+        for shared, length in zip(self.shared, self.lengths):
+            path = path[:shared] + self.suffixes[offset : offset + length]
+            offset += length
+            paths.append(path)
+
+        return paths
+
+    def to_message(self):
+        """
+        Returns the block as a list of bytes that can be sent to the client
+        """
+        shared, lengths = array("H", self.shared), array("H", self.lengths)
+        if sys.byteorder == "big":
+            shared.byteswap()
+            lengths.byteswap()
+
+        return [shared.tobytes(), lengths.tobytes(), self.suffixes]
+
+    @staticmethod
+    def from_message(message):
+        shared, lengths = array("H"), array("H")
+        shared.frombytes(message[0])
+        lengths.frombytes(message[1])
+        if sys.byteorder == "big":
+            shared.byteswap()
+            lengths.byteswap()
+
+        return PathBlock(shared, lengths, message[2])
+
+
+def decode_blocks(messages) -> List[bytes]:
+    """
+    Decodes the blocks of a snapshot sent by `ProjectIndex.snapshot`
+    """
+    paths = []
+    for message in messages:
+        paths.extend(PathBlock.from_message(message).decode())
+
+    return paths
+
+
+class ProjectIndex:
+    """
+    In-memory index of every file in a project that isn't ignored by .gitignore
+
+    The index is built once with a parallel walk and then kept up to date by a file
+    watcher. Paths are kept sorted in front coded blocks, which takes a fraction of
+    the memory of a list of strings. Every batch of changes bumps the generation,
+    and recent changes are kept so that clients can ask for only what changed since
+    the generation they have.
+
+    Args:
+        root: the root of the project
+        workers: number of threads used to walk the project
+        max_history: the maximum number of changed paths kept for deltas
+        logger: the logger to use
+    """
+
+    def __init__(self, root, workers: int = 8, max_history: int = 100_000, logger=None):
+        self.root = Path(root)
+        self.workers = workers
+        self.max_history = max_history
+        self.logger = logger
+
+        self.blocks = []
+        self.firsts = []
+        self.count = 0
+
+        # Changes to a different build of the index can't be applied to a snapshot
+        self.index_id = uuid.uuid4().hex
+        self.generation = 0
+        self.history = deque()
+        self.history_size = 0
+        # The oldest generation that deltas can be computed from
+        self.history_start = 0
+
+        self.listeners = []
+        self.ignores = None
+        self.watcher = None
+        self.thread = None
+        self.started = False
+        self.closed = Event()
+        self.lock = Lock()
+        self.start_lock = Lock()
+
+    def start(self, stop=None):
+        """
+        Builds the index and starts keeping it up to date. Does nothing if it has
+        already been started
+
+        Args:
+            stop: called regularly. Updates stop once it returns True
+        """
+        with self.start_lock:
+            if self.started:
+                return
+
+            # The watcher is created first so that changes made during the walk
+            # are not missed
+            self.ignores = IgnoreCache(self.root)
+            self.watcher = create_watcher(
+                self.root, self.ignored_directory, self.logger
+            )
+
+            paths = self.walk()
+            with self.lock:
+                self.set_paths(paths)
+
+            if self.logger is not None:
+                self.logger.debug(f"Indexed {self.count} files in {self.root}")
+
+            def stopped():
+                return self.closed.is_set() or (stop is not None and stop())
+
+            self.thread = Thread(target=self.update, args=(stopped,))
+            self.thread.daemon = True
+            self.thread.start()
+            self.started = True
+
+    def subscribe(self, listener):
+        """
+        Calls listener after every batch of changes is applied, from the update
+        thread
+
+        Args:
+            listener: called with (updated, removed, rebuilt). updated has every file
+                that was added or modified and removed every file that was removed.
+                rebuilt is True if the index was walked again, in which case files
+                may have been modified without being in updated
+        """
+        self.listeners.append(listener)
+
+    def notify(self, updated: List[bytes], removed: List[bytes], rebuilt: bool):
+        for listener in self.listeners:
+            try:
+                listener(updated, removed, rebuilt)
+            except Exception as e:
+                if self.logger is not None:
+                    self.logger.error(f"Project index listener failed: {e}")
+
+    def close(self):
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def ignored_directory(self, path: str) -> bool:
+        return self.ignores.ignored(path, is_dir=True)
+
+    def walk(self) -> List[bytes]:
+        """
+        Lists every file that isn't ignored, walking directories in parallel
+
+        Returns:
+            The sorted paths relative to the root, encoded as bytes
+        """
+        root = str(self.root)
+
+        def walk_directory(directory: str):
+            files, directories = [], []
+            rules = self.ignores.rules_for(directory)
+            try:
+                entries = list(os.scandir(os.path.join(root, directory)))
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                return files, directories
+
+            for entry in entries:
+                path = f"{directory}/{entry.name}" if directory else entry.name
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    continue
+
+                if rules.ignored(path, is_dir):
+                    continue
+
+                if is_dir:
+                    directories.append(path)
+                else:
+                    files.append(os.fsencode(path))
+
+            return files, directories
+
+        paths = []
+        with ThreadPoolExecutor(self.workers) as executor:
+            pending = {executor.submit(walk_directory, "")}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, directories = future.result()
+                    paths.extend(files)
+                    pending.update(
+                        executor.submit(walk_directory, directory)
+                        for directory in directories
+                    )
+
+        paths.sort()
+        return paths
+
+    def set_paths(self, paths: List[bytes]):
+        self.blocks = [
+            PathBlock.encode(paths[i : i + BLOCK_SIZE])
+            for i in range(0, len(paths), BLOCK_SIZE)
+        ]
+        self.firsts = [block.first for block in self.blocks]
+        self.count = len(paths)
+
+    def paths(self) -> List[bytes]:
+        with self.lock:
+            return self.paths_unlocked()
+
+    def snapshot(self):
+        """
+        Returns:
+            A (index_id, generation, count, blocks) tuple. Use `decode_blocks` to
+            get the paths back from the blocks
+        """
+        with self.lock:
+            blocks = [block.to_message() for block in self.blocks]
+            return self.index_id, self.generation, self.count, blocks
+
+    def changes_since(self, index_id: str, generation: int):
+        """
+        Returns the paths added and removed since a generation
+
+        Returns:
+            A (generation, count, added, removed) tuple with the current generation
+            and number of files, or None if the changes since the generation are no
+            longer known
+        """
+        with self.lock:
+            if index_id != self.index_id or generation < self.history_start:
+                return None
+            if generation > self.generation:
+                return None
+
+            added, removed = set(), set()
+            for entry_generation, entry_added, entry_removed in self.history:
+                if entry_generation <= generation:
+                    continue
+
+                added.difference_update(entry_removed)
+                removed.update(entry_removed)
+                removed.difference_update(entry_added)
+                added.update(entry_added)
+
+            return self.generation, self.count, sorted(added), sorted(removed)
+
+    def update(self, stop):
+        with self.watcher:
+            for changes in self.watcher.batches(stop):
+                if not changes:
+                    continue
+
+                try:
+                    self.apply(changes)
+                except Exception as e:
+                    if self.logger is not None:
+                        self.logger.error(f"Failed to update project index: {e}")
+
+    def apply(self, changes):
+        """
+        Applies a batch of changes reported by the watcher
+        """
+        rebuild = changes.overflow or any(
+            os.path.basename(path) == ".gitignore"
+            for path in changes.changed | changes.deleted
+        )
+        if rebuild:
+            # The ignore rules changed, so any file may have been added or removed
+            self.ignores = IgnoreCache(self.root)
+            paths = self.walk()
+            with self.lock:
+                current = set(self.paths_unlocked())
+                new = set(paths)
+                self.set_paths(paths)
+                added, removed = sorted(new - current), sorted(current - new)
+                self.record(added, removed)
+
+            self.notify(added, removed, True)
+            return
+
+        added, removed, removed_prefixes = [], [], []
+        for path in changes.changed:
+            full_path = self.root.joinpath(path)
+            if full_path.is_dir() and not full_path.is_symlink():
+                continue
+            if not os.path.lexists(full_path) or self.ignores.ignored(path):
+                continue
+            added.append(os.fsencode(path))
+
+        for path in changes.deleted:
+            removed.append(os.fsencode(path))
+            # The path may have been a directory
+            removed_prefixes.append(os.fsencode(path) + b"/")
+
+        updated = added
+        with self.lock:
+            added, removed = self.modify(added, removed, removed_prefixes)
+            self.record(added, removed)
+
+        self.notify(updated, removed, False)
+
+    def paths_unlocked(self) -> List[bytes]:
+        paths = []
+        for block in self.blocks:
+            paths.extend(block.decode())
+        return paths
+
+    def modify(self, added, removed, removed_prefixes):
+        """
+        Adds and removes paths, only re-encoding the blocks that change
+
+        Returns:
+            The (added, removed) paths that actually changed the index
+        """
+        touched = {}
+
+        def block_paths(index):
+            if index not in touched:
+                touched[index] = self.blocks[index].decode()
+            return touched[index]
+
+        def find(path):
+            return max(bisect_right(self.firsts, path) - 1, 0)
+
+        actually_removed = []
+        for path in removed:
+            if not self.blocks:
+                break
+            paths = block_paths(find(path))
+            i = bisect_right(paths, path) - 1
+            if i >= 0 and paths[i] == path:
+                del paths[i]
+                actually_removed.append(path)
+
+        for prefix in removed_prefixes:
+            index = find(prefix)
+            while index < len(self.blocks):
+                paths = block_paths(index)
+                under = [path for path in paths if path.startswith(prefix)]
+                if under:
+                    actually_removed.extend(under)
+                    paths[:] = [path for path in paths if not path.startswith(prefix)]
+
+                # Paths under a directory are contiguous once sorted
+                index += 1
+                if index == len(self.firsts) or not self.firsts[index].startswith(
+                    prefix
+                ):
+                    break
+
+        actually_added = []
+        for path in added:
+            if not self.blocks:
+                self.blocks.append(PathBlock.encode([]))
+                self.firsts.append(b"")
+            paths = block_paths(find(path))
+            i = bisect_right(paths, path)
+            if i == 0 or paths[i - 1] != path:
+                paths.insert(i, path)
+                actually_added.append(path)
+
+        # Re-encode the touched blocks from the back so that indexes stay valid
+        for index in sorted(touched, reverse=True):
+            paths = touched[index]
+            blocks = [
+                PathBlock.encode(paths[i : i + BLOCK_SIZE])
+                for i in range(0, len(paths), BLOCK_SIZE)
+            ]
+            self.blocks[index : index + 1] = blocks
+            self.firsts[index : index + 1] = [block.first for block in blocks]
+
+        self.count += len(actually_added) - len(actually_removed)
+        return actually_added, actually_removed
+
+    def record(self, added: List[bytes], removed: List[bytes]):
+        if not added and not removed:
+            return
+
+        self.generation += 1
+        self.history.append((self.generation, added, removed))
+        self.history_size += len(added) + len(removed)
+        while self.history and self.history_size > self.max_history:
+            generation, old_added, old_removed = self.history.popleft()
+            self.history_size -= len(old_added) + len(old_removed)
+            self.history_start = generation
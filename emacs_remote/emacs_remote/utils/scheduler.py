@@ -0,0 +1,160 @@
+from concurrent.futures import Future
+from threading import BoundedSemaphore
+from typing import List
+
+from ..messages.message import Priority
+from .atomic import AtomicInt
+from .mux import MultiplexedConnection, ResponseStream
+
+
+class RequestScheduler:
+    """
+    Spreads requests over several connections to the server
+
+    Each request is sent on the connection with the least work in flight, counting
+    both the requests and the bytes still being transferred for them. Requests come
+    in two priority classes. When there is more than one connection, bulk requests
+    never use the first one, so requests someone is waiting on always have a
+    connection that isn't stuck behind a large transfer. At most max_bulk bulk
+    requests are in flight at once and the rest wait for their turn.
+
+    Args:
+        connections: open connections to the server
+        max_bulk: the maximum number of bulk requests in flight
+        logger: the logger to use
+    """
+
+    def __init__(
+        self,
+        connections: List[MultiplexedConnection],
+        max_bulk: int = 2,
+        logger=None,
+    ):
+        if not connections:
+            raise ValueError("At least one connection is needed")
+
+        self.connections = list(connections)
+        self.logger = logger if logger is not None else self.connections[0].logger
+
+        self.bulk_in_flight = [AtomicInt() for _ in self.connections]
+        self.bulk_slots = BoundedSemaphore(max_bulk)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def closed(self):
+        return all(connection.closed for connection in self.connections)
+
+    @property
+    def peer(self):
+        """
+        The `Capabilities` negotiated with the server, the same on all connections
+        """
+        return self.connections[0].peer
+
+    def pick(self, priority: Priority = Priority.interactive) -> int:
+        """
+        Returns the index of the connection the next request should be sent on
+
+        Raises:
+            ConnectionError: if every connection usable for priority is closed
+        """
+        candidates = range(len(self.connections))
+        if priority == Priority.bulk and len(self.connections) > 1:
+            candidates = candidates[1:]
+
+        def load(i):
+            connection = self.connections[i]
+            return (
+                self.bulk_in_flight[i].value,
+                len(connection),
+                connection.bytes_in_flight.value,
+            )
+
+        candidates = [i for i in candidates if not self.connections[i].closed]
+        if not candidates:
+            raise ConnectionError("Connection is closed")
+
+        return min(candidates, key=load)
+
+    def _dispatch(self, request, priority: Priority, send):
+        if priority is None:
+            priority = request.priority
+
+        if priority != Priority.bulk:
+            i = self.pick(priority)
+            self.logger.debug(f"Scheduling {type(request).__name__} on connection {i}")
+            return send(self.connections[i])
+
+        self.bulk_slots.acquire()
+        try:
+            i = self.pick(priority)
+        except:
+            self.bulk_slots.release()
+            raise
+
+        self.logger.debug(f"Scheduling bulk {type(request).__name__} on connection {i}")
+        self.bulk_in_flight[i] += 1
+
+        def done(_):
+            self.bulk_in_flight[i] -= 1
+            self.bulk_slots.release()
+
+        try:
+            future = send(self.connections[i])
+        except:
+            done(None)
+            raise
+
+        future.add_done_callback(done)
+        return future
+
+    def submit(self, request, priority: Priority = None) -> Future:
+        """
+        Sends a request without waiting for its response
+
+        Bulk requests block until one of the bulk slots is free.
+
+        Args:
+            request: the request to send
+            priority: overrides the priority of the request's type
+        Returns:
+            A future that resolves to the response
+        """
+        return self._dispatch(
+            request, priority, lambda connection: connection.submit(request)
+        )
+
+    def request(self, request, timeout: float = None, priority: Priority = None):
+        """
+        Sends a request and waits for its response, see `submit`
+        """
+        return self.submit(request, priority).result(timeout=timeout)
+
+    def stream(self, request, priority: Priority = None) -> ResponseStream:
+        """
+        Sends a request whose response is streamed back in multiple messages
+
+        A bulk stream keeps its slot until the final message has arrived.
+
+        Returns:
+            An iterator over the messages of the response
+        """
+        return self._dispatch(
+            request, priority, lambda connection: connection.stream(request)
+        )
+
+    def cancel(self, future) -> bool:
+        """
+        Cancels a request sent with the scheduler, see
+        `MultiplexedConnection.cancel`
+        """
+        return any(connection.cancel(future) for connection in self.connections)
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
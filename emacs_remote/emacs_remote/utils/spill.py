@@ -0,0 +1,212 @@
+import mmap
+import tempfile
+from dataclasses import dataclass, fields, is_dataclass, replace
+
+import msgpack
+
+from ..messages.registry import MessageTypeRegistry
+from .compression import check_decompressed_size, get_frame_codec
+from .framing import FLAG_BUFFERS
+
+# Payloads are received, decompressed and written to disk this many bytes at a time
+SPILL_CHUNK_SIZE = 1024 * 1024
+
+
+@dataclass
+class FrameLimits:
+    """
+    Limits on the frames received from the peer
+
+    A frame bigger than max_frame_size is refused, which drops the connection.
+    Frames of at least spill_threshold bytes are never held in memory. Their
+    payload is decompressed into a temp file as it arrives, and the bytes fields of
+    the message of at least spill_threshold bytes are handed over as memoryviews of
+    the mapped file. Everything that accepts bytes-like objects, like writing to a
+    file or hashing, works on them without reading the data into memory.
+
+    Args:
+        max_frame_size: the maximum size of a payload, both as received and
+            decompressed
+        spill_threshold: the payload size from which frames are spilled to disk
+        spill_dir: where temp files are created. Defaults to the system temp
+            directory, which may well be in memory, so daemons set it to their
+            workspace directory
+    """
+
+    max_frame_size: int = 1024 * 1024 * 1024
+    spill_threshold: int = 16 * 1024 * 1024
+    spill_dir: str = None
+
+    def check(self, message_size: int):
+        """
+        Raises:
+            ValueError: if a frame of message_size bytes is too big
+        """
+        if message_size > self.max_frame_size:
+            raise ValueError(
+                f"Frame of {message_size} bytes exceeds the maximum frame size of "
+                f"{self.max_frame_size} bytes"
+            )
+
+    def should_spill(self, message_size: int) -> bool:
+        return message_size >= self.spill_threshold
+
+
+def _array_header(m, pos: int):
+    """
+    Returns a (length, position after the header) tuple if there is a msgpack
+    array at pos, else None
+    """
+    b = m[pos]
+    if 0x90 <= b <= 0x9F:
+        return b & 0x0F, pos + 1
+    if b == 0xDC:
+        return int.from_bytes(m[pos + 1 : pos + 3], "big"), pos + 3
+    if b == 0xDD:
+        return int.from_bytes(m[pos + 1 : pos + 5], "big"), pos + 5
+    return None
+
+
+def _bin_header(m, pos: int):
+    """
+    Returns a (length, position after the header) tuple if there is a msgpack bin
+    at pos, else None
+    """
+    b = m[pos]
+    if b == 0xC4:
+        return m[pos + 1], pos + 2
+    if b == 0xC5:
+        return int.from_bytes(m[pos + 1 : pos + 3], "big"), pos + 3
+    if b == 0xC6:
+        return int.from_bytes(m[pos + 1 : pos + 5], "big"), pos + 5
+    return None
+
+
+def materialize(message):
+    """
+    Copies the fields of a message that are views of a spilled frame into memory
+
+    Needed before a message is sent to another process, as views can't be pickled.
+
+    Returns:
+        The message if it has no such fields, else a copy of it holding bytes
+    """
+    if not is_dataclass(message):
+        return message
+
+    views = {
+        f.name: bytes(getattr(message, f.name))
+        for f in fields(message)
+        if isinstance(getattr(message, f.name), memoryview)
+    }
+    return replace(message, **views) if views else message
+
+
+class SpillWriter:
+    """
+    Decompresses the payload of a frame into a temp file as it is received
+
+    Args:
+        flags: the flags from the frame header
+        limits: the limits of the connection the frame is received on
+    """
+
+    def __init__(self, flags: int, limits: FrameLimits):
+        self.flags = flags
+        self.limits = limits
+
+        codec = get_frame_codec(flags)
+        self.decompressor = None
+        if codec is not None:
+            # Each piece of output is checked and written before the next one is
+            # produced, however much a part of the payload expands
+            self.decompressor = codec.stream_decompressor(self._write, SPILL_CHUNK_SIZE)
+        self.file = tempfile.TemporaryFile(dir=limits.spill_dir)
+        self.size = 0
+
+    def _write(self, data):
+        self.size += len(data)
+        check_decompressed_size(self.size, self.limits.max_frame_size)
+        self.file.write(data)
+
+    def write(self, data):
+        """
+        Adds the next part of the payload
+        """
+        if self.decompressor is not None:
+            self.decompressor.write(data)
+        else:
+            self._write(data)
+
+    def decode(self, message_type: int):
+        """
+        Decodes the message once the whole payload has been written
+
+        Args:
+            message_type: the message type from the frame header
+        Returns:
+            The message
+        """
+        if self.decompressor is not None:
+            self.decompressor.flush()
+        self.file.flush()
+
+        codec = MessageTypeRegistry.get_codec(message_type)
+        if self.flags & FLAG_BUFFERS:
+            # The big fields were sent after the packed message, so they are handed
+            # over as views without parsing anything. The mapping is kept for as
+            # long as any of its views are alive
+            mapped = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+            end = 4 + int.from_bytes(mapped[:4], "big")
+            values = msgpack.unpackb(mapped[4:end])
+            return codec.decode(values, memoryview(mapped)[end:], copy=False)
+
+        with mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ) as m:
+            header = _array_header(m, 0)
+            if header is None:
+                # Not a dataclass, so there are no fields to hand over from the file
+                self.file.seek(0)
+                return codec.decode(self._unpack())
+
+            count, pos = header
+            fields = []
+            mapped = None
+            for _ in range(count):
+                field = _bin_header(m, pos)
+                if field is not None and field[0] >= self.limits.spill_threshold:
+                    size, start = field
+                    if mapped is None:
+                        # Kept mapped for as long as any of its views are alive
+                        mapped = mmap.mmap(
+                            self.file.fileno(), self.size, access=mmap.ACCESS_READ
+                        )
+                    fields.append(memoryview(mapped)[start : start + size])
+                    pos = start + size
+                else:
+                    self.file.seek(pos)
+                    unpacker = self._unpacker()
+                    fields.append(unpacker.unpack())
+                    pos += unpacker.tell()
+
+        return codec.decode(fields)
+
+    def _unpacker(self):
+        return msgpack.Unpacker(
+            self.file,
+            read_size=SPILL_CHUNK_SIZE,
+            max_buffer_size=self.limits.max_frame_size,
+        )
+
+    def _unpack(self):
+        return self._unpacker().unpack()
+
+    def close(self):
+        # The file was never linked, so closing it and dropping the views of it
+        # frees the disk space
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,279 @@
+import subprocess
+from pathlib import Path
+from threading import Lock, Thread
+from typing import List
+
+from . import md5
+from .logging import LoggerFactory
+
+# Seconds an idle master is kept around after its last session closes, so that
+# restarting the client doesn't pay for a new key exchange and authentication
+CONTROL_PERSIST = 600
+
+# Seconds between keepalives. A master that misses 3 in a row is given up on
+SERVER_ALIVE_INTERVAL = 5
+
+
+class ControlMaster:
+    """
+    A shared ssh connection that sessions are multiplexed over
+
+    The master is addressed by a control socket named after the host, so it is
+    reused by every client of that host: across restarts and across workspaces.
+    Sessions run through `command` open a channel on the master, which takes a
+    round trip rather than a key exchange and authentication. If the master isn't
+    running, the first session starts it.
+
+    Args:
+        host: the host to connect to. Must be usable verbatim as `ssh {host}`
+        control_dir: the directory of the control sockets
+        slot: tells apart several masters of the same host
+        persist: seconds the master is kept open after its last session closes
+        logger: the logger to use
+    """
+
+    def __init__(
+        self,
+        host: str,
+        control_dir: str,
+        slot: int = 0,
+        persist: int = CONTROL_PERSIST,
+        logger=None,
+    ):
+        self.host = host
+        self.control_dir = Path(control_dir)
+        self.control_dir.mkdir(parents=True, exist_ok=True)
+        # Unix socket paths are short, so the host is hashed
+        name = f"{md5(host)[:16]}.{slot}"
+        self.control_path = self.control_dir.joinpath(f"{name}.sock")
+        self.log_path = self.control_dir.joinpath(f"{name}.log")
+        self.persist = persist
+
+        if logger is None:
+            logger = LoggerFactory().get_logger("ControlMaster")
+
+        self.logger = logger
+
+    def options(self) -> List[str]:
+        """
+        Returns the ssh options that multiplex a session over this master
+        """
+        return [
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={self.control_path}",
+            "-o",
+            f"ControlPersist={self.persist}",
+            "-o",
+            f"ServerAliveInterval={SERVER_ALIVE_INTERVAL}",
+        ]
+
+    def client_options(self) -> List[str]:
+        """
+        Returns the ssh options that use this master if it is running, without
+        ever turning the ssh process into a master itself
+
+        The process then stays in the foreground and exits when it is killed.
+        """
+        return ["-o", "ControlMaster=no", "-o", f"ControlPath={self.control_path}"]
+
+    def command(self, remote_cmd: str, ssh_args: List[str] = ()) -> List[str]:
+        """
+        Returns the ssh command that runs remote_cmd on the host through this master
+        """
+        return ["ssh", *self.options(), *ssh_args, self.host, remote_cmd]
+
+    def _control(self, operation: str, timeout: float, args: List[str] = ()):
+        cmd = ["ssh", "-o", f"ControlPath={self.control_path}", "-O", operation]
+        cmd.extend(args)
+        cmd.append(self.host)
+        return subprocess.run(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            timeout=timeout,
+        )
+
+    def check(self, timeout: float = 5) -> bool:
+        """
+        Returns whether the master is running
+        """
+        if not self.control_path.exists():
+            return False
+
+        try:
+            return self._control("check", timeout).returncode == 0
+        except subprocess.TimeoutExpired:
+            return False
+
+    def start(self, timeout: float = 60) -> bool:
+        """
+        Starts the master unless it is already running
+
+        Returns once the master has authenticated with the host.
+
+        Returns:
+            Whether the master is running
+        """
+        if self.check():
+            self.logger.debug(f"Reusing ssh master {self.control_path}")
+            return True
+
+        self.logger.info(f"Starting ssh master {self.control_path}...")
+        # -f backgrounds ssh once it has authenticated. Its stderr would outlive
+        # this call, so errors go to a log file instead
+        cmd = ["ssh", "-f", "-N", "-E", str(self.log_path), *self.options()]
+        cmd.append(self.host)
+        try:
+            code = subprocess.run(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=timeout,
+            ).returncode
+        except subprocess.TimeoutExpired:
+            code = None
+
+        if code != 0:
+            self.logger.info(
+                f"Failed to start ssh master with code {code}. See {self.log_path}"
+            )
+            return False
+
+        return True
+
+    def cancel_forwards(self, forwards: List[str], timeout: float = 5):
+        """
+        Removes local forwards that sessions added to the master
+
+        Forwards requested through a master belong to it, so they outlive the
+        session that requested them.
+
+        Args:
+            forwards: the forwards as passed to `ssh -L`
+        """
+        if not forwards or not self.control_path.exists():
+            return
+
+        args = []
+        for forward in forwards:
+            args.extend(["-L", forward])
+
+        try:
+            self._control("cancel", timeout, args)
+        except subprocess.TimeoutExpired:
+            self.logger.debug(f"Timed out cancelling forwards of {self.control_path}")
+
+    def stop(self, timeout: float = 5):
+        """
+        Closes the master and every session multiplexed over it
+        """
+        if not self.control_path.exists():
+            return
+
+        try:
+            self._control("exit", timeout)
+        except subprocess.TimeoutExpired:
+            self.logger.debug(f"Timed out stopping ssh master {self.control_path}")
+
+
+class SSHConnections:
+    """
+    The ssh master used for sessions, plus an optional warm standby
+
+    The standby is a second master of the same host over its own TCP connection
+    that is kept authenticated. When the active master dies, the standby takes
+    over, so new sessions only need a round trip. A new standby is then started in
+    the background.
+
+    Masters are shared with every other client of the host, so they are never
+    closed from here. A master whose link broke is given up on by ssh once it
+    misses its keepalives, and idle ones exit after ControlPersist.
+
+    Args:
+        host: the host to connect to. Must be usable verbatim as `ssh {host}`
+        control_dir: the directory of the control sockets
+        standby: whether to keep a standby master
+        persist: seconds masters are kept open after their last session closes
+        logger: the logger to use
+    """
+
+    def __init__(
+        self,
+        host: str,
+        control_dir: str,
+        standby: bool = True,
+        persist: int = CONTROL_PERSIST,
+        logger=None,
+    ):
+        if logger is None:
+            logger = LoggerFactory().get_logger("SSHConnections")
+
+        self.logger = logger
+        self.active = ControlMaster(host, control_dir, 0, persist, logger)
+        self.standby = None
+        if standby:
+            self.standby = ControlMaster(host, control_dir, 1, persist, logger)
+
+        self.lock = Lock()
+        self.standby_thread = None
+
+    def start(self):
+        """
+        Starts the active master and the standby in the background
+        """
+        self.active.start()
+        self._start_standby()
+
+    def _start_standby(self):
+        if self.standby is None:
+            return
+
+        self.standby_thread = Thread(target=self.standby.start)
+        self.standby_thread.daemon = True
+        self.standby_thread.start()
+
+    def options(self) -> List[str]:
+        """
+        Returns the ssh options that multiplex a session over the active master
+        """
+        with self.lock:
+            return self.active.options()
+
+    def command(self, remote_cmd: str, ssh_args: List[str] = ()) -> List[str]:
+        """
+        Returns the ssh command that runs remote_cmd on the host through the active
+        master
+        """
+        with self.lock:
+            return self.active.command(remote_cmd, ssh_args)
+
+    def failover(self) -> bool:
+        """
+        Replaces the active master with the standby if the active one died
+
+        The dead master is started again in the background as the new standby.
+        If the standby is down too, nothing changes and the next session starts
+        the active master again itself.
+
+        Returns:
+            Whether the standby took over
+        """
+        with self.lock:
+            if self.standby is None or self.active.check():
+                return False
+
+            if self.standby_thread is not None:
+                self.standby_thread.join()
+
+            if not self.standby.check():
+                self.logger.info("Standby ssh master is down too")
+                return False
+
+            self.logger.info("Failing over to the standby ssh master")
+            self.active, self.standby = self.standby, self.active
+            self._start_standby()
+            return True
@@ -1,13 +1,18 @@
 import random
+import shlex
 import signal
 import socket
 import subprocess
+import sys
 import time
+from pathlib import Path
 from queue import Queue
 from threading import Barrier, Event, Thread
-from typing import Callable
+from typing import Callable, List
 
 from ..workspace import Workspace
+from .logging import LoggerFactory
+from .ssh import SSHConnections
 from .stcp_socket import SecureTCPSocket
 
 
@@ -19,11 +24,27 @@ class SecureTCP:
         host: the host to connect to
             Note, the host must be able to used verbatim as `ssh {host}`
         num_clients: the number of TCP connections to establish
+        logger: the logger to use
+        connections: the ssh masters to run the server through, so that retries
+            don't pay for a new key exchange and authentication
     """
 
-    def __init__(self, workspace: Workspace, num_clients: int = 1, logger=None):
-        self.workspace = Workspace
+    def __init__(
+        self,
+        workspace: Workspace,
+        num_clients: int = 1,
+        logger=None,
+        connections: SSHConnections = None,
+    ):
+        self.workspace = workspace
+        self.host = workspace.host
         self.num_clients = num_clients
+        self.connections = connections
+
+        if logger is None:
+            logger = LoggerFactory().get_logger("SecureTCP")
+
+        self.logger = logger
 
         self.client_ports = []
         self.server_ports = []
@@ -35,7 +56,7 @@ class SecureTCP:
                     if not self.client_ports:
                         yield None
                     else:
-                        if i > len(self.client_ports):
+                        if i >= len(self.client_ports):
                             i = 0
                         yield self.client_ports[i]
                         i += 1
@@ -46,14 +67,32 @@ class SecureTCP:
 
         self.process = None
         self.process_started = Event()
+        # The master the forwards were added to, if any
+        self.master = None
+        self.forwards = []
 
-    def next_client_port():
+    def next_client_port(self):
         return next(self._client_port_generator)
 
+    @staticmethod
+    def server_script_command(workspace: str, ports: List[str], level: str = "info"):
+        """
+        Returns the shell command that runs the bundled server script on ports
+
+        The script is passed inline as it only exists on this machine.
+        """
+        script_path = Path(sys.prefix, "emacs_remote_scripts", "server.sh")
+        script = script_path.read_text()
+        return (
+            f"WORKSPACE={shlex.quote(str(workspace))} "
+            f"PORTS={shlex.quote(' '.join(ports))} LEVEL={shlex.quote(level)} "
+            f"bash -c {shlex.quote(script)}"
+        )
+
     def start(self, cmd_closure: Callable, start_closure: Callable):
         # Generate ports to use to connect to server
         self.client_ports.clear()
-        for i in range(self.num_client):
+        for i in range(self.num_clients):
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                 s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 s.bind(("localhost", 0))
@@ -63,15 +102,26 @@ class SecureTCP:
         def start_server(timeout):
             # No quick way to check free ports on server, so generate randomly
             self.server_ports.clear()
-            while len(server_ports) < len(client_ports):
+            while len(self.server_ports) < len(self.client_ports):
                 port = str(random.randint(9130, 49151))
-                if port not in client_ports:
+                if port not in self.client_ports:
                     self.server_ports.append(port)
 
             cmd = ["ssh"]
+            if self.connections is not None:
+                # Authenticate through the master, but stay in the foreground so
+                # that stop can kill this process
+                self.master = self.connections.active
+                cmd.extend(self.master.client_options())
             # Set up local port forwarding
-            for client_port, server_port in zip(client_ports, server_ports):
-                cmd.extend(["-L", f"{client_port}:localhost:{server_port}"])
+            self.forwards = [
+                f"{client_port}:localhost:{server_port}"
+                for client_port, server_port in zip(
+                    self.client_ports, self.server_ports
+                )
+            ]
+            for forward in self.forwards:
+                cmd.extend(["-L", forward])
             cmd.append(self.host)
             cmd.extend(cmd_closure(self))
 
@@ -80,6 +130,7 @@ class SecureTCP:
             self.process_started.clear()
             self.process = subprocess.Popen(
                 cmd,
+                stdin=subprocess.DEVNULL,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
             )
@@ -95,28 +146,22 @@ class SecureTCP:
                 self.logger.debug(errs.decode("utf-8"))
                 self.logger.debug(f"{'':=^50}")
 
+                self.cancel_forwards()
                 return False
 
             self.process_started.set()
             return True
 
-        try:
-            for i in range(1, 6):
-                if start_server(timeout=i * 2 + 1):
-                    self.logger.info("ssh connection established!")
-                    break
-
-                self.logger.info(" Retrying ssh connection...")
-            else:
-                raise RuntimeError("Unable to start server")
+        for i in range(1, 6):
+            if start_server(timeout=i * 2 + 1):
+                self.logger.info("ssh connection established!")
+                break
 
-        finally:
-            self.barrier.wait()
+            self.logger.info(" Retrying ssh connection...")
+        else:
+            raise RuntimeError("Unable to start server")
 
     def stop(self):
-        for thread in self.client_threads:
-            thread.join()
-
         if self.process:
             self.process.send_signal(signal.SIGINT)
             # self.process.terminate()
@@ -134,6 +179,18 @@ class SecureTCP:
             else:
                 self.logger.info("Successfully cleaned up server process!")
 
+        self.cancel_forwards()
+
+    def cancel_forwards(self):
+        """
+        Removes the forwards of the last attempt from the master they were added to,
+        which would keep them after this process exits
+        """
+        if self.master is not None:
+            self.master.cancel_forwards(self.forwards)
+
+        self.forwards = []
+
     def __bool__(self):
         return self.process and self.process.poll() is None
 
@@ -1,17 +1,30 @@
 import logging
 import select
 import socket
-import zlib
-from dataclasses import astuple, is_dataclass
-
-import msgpack
-
-from ..messages.registry import MessageTypeRegistry
+from threading import Lock
+
+from ..messages.compression_request import (HANDSHAKE_PROBE,
+                                            CompressionRequest,
+                                            CompressionResponse)
+from ..messages.handshake_request import (Capabilities, HandshakeRequest,
+                                          HandshakeResponse, accept_handshake,
+                                          is_handshake_probe)
+from ..utils.compression import CompressionPolicy
+from ..utils.framing import (HEADER_SIZE, MessageUnpacker, RecvBuffer,
+                             decode_message, encode_message, send_buffers,
+                             unpack_header)
 from ..utils.logging import LoggerFactory
+from ..utils.spill import SPILL_CHUNK_SIZE, FrameLimits, SpillWriter
 
 
 class SecureTCPSocket:
-    def __init__(self, s=None, logger=None):
+    def __init__(
+        self,
+        s=None,
+        logger=None,
+        compression: CompressionPolicy = None,
+        limits: FrameLimits = None,
+    ):
         if s is None:
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -24,7 +37,26 @@ class SecureTCPSocket:
 
         self.logger = logger
 
-        self.recv_buffer = bytearray()
+        self.recv_buffer = RecvBuffer()
+        self.send_lock = Lock()
+
+        # Totals of the frames sent and received, headers included
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+        if compression is None:
+            compression = CompressionPolicy()
+
+        self.compression = compression
+
+        if limits is None:
+            limits = FrameLimits()
+
+        self.limits = limits
+        self.unpacker = MessageUnpacker(limits.max_frame_size)
+        # What the other end accepts. Until the handshake, only what every version
+        # does, e.g. zlib is always available
+        self.peer = Capabilities.legacy()
 
     def __enter__(self):
         self.socket.__enter__()
@@ -35,6 +67,17 @@ class SecureTCPSocket:
     def __exit__(self, *args):
         self.socket.__exit__(*args)
 
+    def close(self):
+        """
+        Shuts the connection down, waking up any thread blocked receiving on it
+        """
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        self.socket.close()
+
     def set_logger(self, logger):
         self.logger = logger
 
@@ -55,48 +98,118 @@ class SecureTCPSocket:
     def accept(self):
         conn, addr = self.socket.accept()
         self.logger.debug(f"Connection accepted from {addr}")
-        return SecureTCPSocket(conn, self.logger), addr
+        return (
+            SecureTCPSocket(conn, self.logger, self.compression, self.limits),
+            addr,
+        )
 
     def connect(self, host, port):
+        self.host = host
+        self.port = port
         return self.socket.connect((host, port))
 
-    def sendall(self, data):
-        self.logger.debug(f"Sending data: {data}")
+    def capabilities(self) -> Capabilities:
+        """
+        Returns the capabilities of this end of the connection
+        """
+        return Capabilities(max_frame_size=self.limits.max_frame_size)
 
-        message_type = MessageTypeRegistry.get_index(type(data))
-        self.logger.debug(f"    message_type: {message_type}")
+    def negotiate(
+        self, initiator: bool, timeout: float = 10, local: Capabilities = None
+    ):
+        """
+        Exchanges versions and capabilities with the other end of the connection
 
-        if isinstance(data, str):
-            data = (data,)
-        elif is_dataclass(data):
-            data = astuple(data)
-        elif not isinstance(data, (list, tuple, dict)):
-            raise TypeError(
-                f"Expected data to be one of [str, list, tuple, dict, dataclass]. Got {type(data)}"
-            )
+        Must be called by both ends of a newly established connection before any
+        other message is sent. Afterwards `peer` holds what was agreed on.
+
+        Servers that predate the handshake drop the connection on it, so the
+        initiator first asks whether the server knows it with a
+        `CompressionRequest`, which also agrees on codecs with servers that don't.
+
+        Args:
+            initiator: True for the end of the connection that called `connect`
+            timeout: seconds to wait for the other end to respond
+            local: the capabilities announced to the other end. Defaults to
+                `capabilities`
+        """
+        if local is None:
+            local = self.capabilities()
+        if initiator:
+            self.sendall(CompressionRequest([*local.codecs, HANDSHAKE_PROBE]))
+            response = self.recvall(timeout=timeout)
+            if not isinstance(response, CompressionResponse):
+                raise TypeError(
+                    f"Expected type CompressionResponse. Got: {type(response)}"
+                )
+
+            if HANDSHAKE_PROBE in response.codecs:
+                peer = self._handshake(local, timeout)
+            else:
+                self.logger.info("Server predates the handshake")
+                peer = Capabilities.legacy(response.codecs)
+        else:
+            request = self.recvall(timeout=timeout)
+            if is_handshake_probe(request):
+                self.sendall(request.run(None))
+                request = self.recvall(timeout=timeout)
 
-        packed = msgpack.packb(data)
-        compressed = zlib.compress(packed)
-        self.logger.debug(f"    message_size: {len(compressed)}")
+            response, peer = accept_handshake(request, local)
+            self.sendall(response)
 
-        size_message = msgpack.packb((message_type, len(compressed)))
-        assert len(size_message) <= 16, "Expected size message to be less than 16 bytes"
+        self.peer = peer
+        self.logger.debug(f"Negotiated: {self.peer}")
+
+    def _handshake(self, local: Capabilities, timeout: float):
+        """
+        Exchanges capabilities with a server that knows the handshake
 
-        payload = bytearray()
-        payload.extend(size_message)
-        if len(size_message) < 16:
-            payload.extend(bytes(16 - len(size_message)))
+        Returns:
+            The capabilities to use when sending to the peer
+        """
+        self.sendall(HandshakeRequest(local.to_dict()))
+        response = self.recvall(timeout=timeout)
+        if not isinstance(response, HandshakeResponse):
+            raise TypeError(f"Expected type HandshakeResponse. Got: {type(response)}")
+        if response.error is not None:
+            raise ValueError(f"Handshake refused: {response.error}")
+
+        return local.negotiate(
+            Capabilities.from_dict(response.capabilities), initiator=True
+        )
+
+    def sendall(self, data, request_id: int = 0, more: bool = False):
+        """
+        Sends a message as a single frame
 
-        payload.extend(compressed)
+        Safe to call from multiple threads at once.
+
+        Args:
+            data: the message to send. Must be of a registered type
+            request_id: the id of the request that this message belongs to
+            more: whether more messages will follow for the same request id
+        Returns:
+            The size of the frame sent
+        """
+        self.logger.debug(f"Sending data: {data}")
+
+        header, payload = encode_message(
+            data, request_id, self.compression, self.peer, more
+        )
+        size = HEADER_SIZE + sum(len(buffer) for buffer in payload)
+        self.logger.debug(f"    message_size: {size - HEADER_SIZE}")
 
         try:
-            self.logger.debug(f"    sending payload ({len(payload)})...")
-            self.socket.sendall(payload)
+            self.logger.debug(f"    sending payload ({size})...")
+            with self.send_lock:
+                send_buffers(self.socket, header, *payload)
+                self.bytes_sent += size
         except:
             self.logger.error("Failed to send payload")
             raise
 
         self.logger.debug(f"    Send Complete!")
+        return size
 
     def recvall(self, timeout: float = None):
         """
@@ -109,64 +222,108 @@ class SecureTCPSocket:
             timeout: positive floating value representing seconds after which to return None
                 timeout only applies to waiting for first message. Not second.
         """
+        _, message, _ = self.recv_message(timeout)
+        return message
+
+    def recv_message(self, timeout: float = None):
+        """
+        Same as `recvall` but also returns the request id and flags from the header
+
+        Args:
+            timeout: see `recvall`
+        Returns:
+            A (request_id, message, flags) tuple. message is None if the connection
+            closed
+        """
         self.logger.debug("Receiving data")
 
-        if timeout is not None:
+        if timeout is not None and not self._has_frame():
             assert isinstance(timeout, (int, float)) and timeout > 0
             self.logger.debug(f"    Timeout: {timeout}")
 
-            try:
-                self.socket.setblocking(False)
-                ready = select.select([self.socket], [], [], timeout)
-                if not ready[0]:
-                    self.logger.debug(f"    timed out")
-                    raise TimeoutError()
-            finally:
-                self.socket.setblocking(True)
+            # The socket is left in blocking mode as other threads may be sending
+            ready = select.select([self.socket], [], [], timeout)
+            if not ready[0]:
+                self.logger.debug(f"    timed out")
+                raise TimeoutError()
 
         self.logger.debug(f"    receiving payload...")
-        while len(self.recv_buffer) < 16:
-            data = self.socket.recv(1024)
-            if not data:
-                self.logger.debug(
-                    f"        Received no data (total: {len(self.recv_buffer)})"
-                )
-                return None
-
-            self.recv_buffer.extend(data)
+        if not self.recv_buffer.fill(self.socket, HEADER_SIZE):
             self.logger.debug(
-                f"        received {len(data)} bytes (total: {len(self.recv_buffer)})"
+                f"        Received no data (total: {len(self.recv_buffer)})"
             )
+            return 0, None, 0
 
-        assert len(self.recv_buffer) >= 16
-
-        size_message = self.recv_buffer[:16].strip(b"\x00")
-
-        message_type, message_size = msgpack.unpackb(size_message)
+        message_type, message_size, flags, request_id = unpack_header(
+            self.recv_buffer.peek(HEADER_SIZE)
+        )
         self.logger.debug(f"    message_type: {message_type}")
         self.logger.debug(f"    message_size: {message_size}")
+        self.logger.debug(f"    request_id: {request_id}")
 
-        self.recv_buffer = self.recv_buffer[16:]
-        while len(self.recv_buffer) < message_size:
-            data = self.socket.recv(4096)
-            if len(data) == 0:
-                return None
+        self.limits.check(message_size)
+        if self.limits.should_spill(message_size):
+            self.recv_buffer.consume(HEADER_SIZE)
+            message = self._recv_spilled(message_type, message_size, flags)
+            if message is None:
+                return request_id, None, flags
 
-            self.recv_buffer.extend(data)
-            self.logger.debug(
-                f"        received {len(data)} bytes (total: {len(self.recv_buffer)})"
-            )
+            self.bytes_received += HEADER_SIZE + message_size
+            return request_id, message, flags
 
-        self.logger.debug(f"    Received payload!")
+        # Leave the header in the buffer until the whole frame has arrived so that a
+        # timed out or interrupted receive can be resumed
+        if not self.recv_buffer.fill(self.socket, HEADER_SIZE + message_size):
+            return request_id, None, flags
 
-        payload = self.recv_buffer[:message_size]
-        self.recv_buffer = self.recv_buffer[message_size:]
+        self.logger.debug(f"    Received payload!")
 
-        data = zlib.decompress(payload)
-        data = msgpack.unpackb(data)
-        self.logger.debug(f"    Unpacked data!")
+        self.recv_buffer.consume(HEADER_SIZE)
+        payload = self.recv_buffer.consume(message_size)
+        self.bytes_received += HEADER_SIZE + message_size
 
-        message = MessageTypeRegistry.get_type(message_type, data)
+        message = decode_message(
+            message_type, flags, payload, self.limits.max_frame_size, self.unpacker
+        )
         self.logger.debug(f"    Got message!")
 
-        return message
+        return request_id, message, flags
+
+    def _recv_spilled(self, message_type: int, message_size: int, flags: int):
+        """
+        Receives a payload into a temp file instead of the receive buffer
+
+        Returns:
+            The message, or None if the connection closed
+        """
+        self.logger.debug(f"    spilling payload to disk...")
+
+        with SpillWriter(flags, self.limits) as writer:
+            remaining = message_size
+
+            buffered = min(len(self.recv_buffer), remaining)
+            if buffered:
+                writer.write(self.recv_buffer.consume(buffered))
+                remaining -= buffered
+
+            chunk = bytearray(min(SPILL_CHUNK_SIZE, max(remaining, 1)))
+            view = memoryview(chunk)
+            while remaining > 0:
+                num_bytes = self.socket.recv_into(view[: min(remaining, len(chunk))])
+                if num_bytes == 0:
+                    return None
+
+                writer.write(view[:num_bytes])
+                remaining -= num_bytes
+
+            return writer.decode(message_type)
+
+    def _has_frame(self):
+        """
+        Returns True if a complete frame is already sitting in the receive buffer
+        """
+        if len(self.recv_buffer) < HEADER_SIZE:
+            return False
+
+        _, message_size, _, _ = unpack_header(self.recv_buffer.peek(HEADER_SIZE))
+        return len(self.recv_buffer) >= HEADER_SIZE + message_size
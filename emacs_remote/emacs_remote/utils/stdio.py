@@ -0,0 +1,237 @@
+import shlex
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+from threading import Thread
+from typing import List
+
+from ..messages.startup import SERVER_STARTUP_MSG
+from .compression import CompressionPolicy
+from .logging import LoggerFactory
+from .mux import MultiplexedConnection
+from .spill import FrameLimits
+from .ssh import SSHConnections
+from .stcp_socket import SecureTCPSocket
+
+# Lines of text printed before the startup message, e.g. by login scripts, that are
+# skipped at most
+MAX_STARTUP_LINES = 1024
+
+
+class StdioTransport:
+    """
+    Runs the server as a subprocess and speaks the protocol over its stdin and stdout
+
+    The subprocess gets one end of a socket pair as both its stdin and stdout, so
+    the other end is used like any TCP connection. The server prints
+    SERVER_STARTUP_MSG on a line of its own once it is ready, after which only
+    frames are sent. Requests are multiplexed over the pipe by request id.
+
+    Use `ssh` to run the server on a remote host with a single ssh exec, or `local`
+    to run it on this machine without ssh.
+
+    Args:
+        cmd: the command that runs the server in stdio mode
+        logger: the logger to use
+        compression: the compression policy to use for sent frames
+        limits: the limits on received frames
+        startup_timeout: seconds to wait for the server to start
+    """
+
+    def __init__(
+        self,
+        cmd: List[str],
+        logger=None,
+        compression: CompressionPolicy = None,
+        limits: FrameLimits = None,
+        startup_timeout: float = 60,
+    ):
+        self.cmd = cmd
+
+        if logger is None:
+            logger = LoggerFactory().get_logger("StdioTransport")
+
+        self.logger = logger
+        self.compression = compression
+        self.limits = limits
+        self.startup_timeout = startup_timeout
+
+        self.process = None
+        self.connection = None
+        self.stderr_thread = None
+
+    @staticmethod
+    def ssh(host: str, remote_cmd: str, connections: SSHConnections = None, **kwargs):
+        """
+        Returns a transport that runs remote_cmd on host over ssh
+
+        Args:
+            host: the host to connect to. Must be usable verbatim as `ssh {host}`
+            remote_cmd: the shell command that runs the server in stdio mode
+            connections: the ssh masters to run remote_cmd through, if any
+            kwargs: see `StdioTransport`
+        """
+        # No tty, so nothing gets between the frames and the pipe
+        if connections is not None:
+            return StdioTransport(connections.command(remote_cmd, ["-T"]), **kwargs)
+
+        return StdioTransport(["ssh", "-T", host, remote_cmd], **kwargs)
+
+    @staticmethod
+    def local(
+        emacs_remote_path: str,
+        workspace: str,
+        level: str = "info",
+        server_args: List[str] = (),
+        **kwargs,
+    ):
+        """
+        Returns a transport that runs the server on this machine as a plain
+        subprocess, which stands in for ssh in tests
+        """
+        cmd = [
+            sys.executable,
+            "-m",
+            "emacs_remote.server.main",
+            "--stdio",
+            "-r",
+            emacs_remote_path,
+            "-w",
+            workspace,
+            "-l",
+            level,
+            *server_args,
+        ]
+        return StdioTransport(cmd, **kwargs)
+
+    @staticmethod
+    def server_script_command(workspace: str, level: str = "info") -> str:
+        """
+        Returns the shell command that runs the bundled server script in stdio mode
+
+        The script is passed inline as stdin is taken by the protocol.
+        """
+        script_path = Path(sys.prefix, "emacs_remote_scripts", "server.sh")
+        script = script_path.read_text()
+        return (
+            f"WORKSPACE={shlex.quote(str(workspace))} LEVEL={shlex.quote(level)} "
+            f"STDIO=1 bash -c {shlex.quote(script)}"
+        )
+
+    def start(self) -> MultiplexedConnection:
+        """
+        Starts the server and negotiates the connection with it
+
+        Returns:
+            The connection to the server
+        Raises:
+            RuntimeError: if the server exits or doesn't start in time
+        """
+        ours, theirs = socket.socketpair()
+        self.logger.info(f"cmd: {' '.join(self.cmd)}")
+        try:
+            self.process = subprocess.Popen(
+                self.cmd, stdin=theirs, stdout=theirs, stderr=subprocess.PIPE
+            )
+        except:
+            ours.close()
+            raise
+        finally:
+            theirs.close()
+
+        self.stderr_thread = Thread(target=self._log_stderr)
+        self.stderr_thread.daemon = True
+        self.stderr_thread.start()
+
+        try:
+            self._wait_started(ours)
+
+            s = SecureTCPSocket(ours, self.logger, self.compression, self.limits)
+            s.negotiate(initiator=True)
+        except:
+            ours.close()
+            self.process.kill()
+            self.stop()
+            raise
+
+        self.connection = MultiplexedConnection(s, self.logger).start()
+        return self.connection
+
+    def _wait_started(self, sock: socket.socket):
+        # Read a byte at a time so that nothing after the startup line is consumed.
+        # The server sends nothing more until it has been sent the handshake anyway
+        deadline = time.monotonic() + self.startup_timeout
+        line = bytearray()
+        lines = 0
+        while lines < MAX_STARTUP_LINES:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise RuntimeError("Timed out waiting for the server to start")
+
+            sock.settimeout(timeout)
+            try:
+                byte = sock.recv(1)
+            except socket.timeout:
+                continue
+            finally:
+                sock.settimeout(None)
+
+            if not byte:
+                code = self.process.wait()
+                raise RuntimeError(f"Server exited with code {code} before starting")
+
+            if byte != b"\n":
+                line += byte
+                continue
+
+            text = line.decode("utf-8", errors="replace").strip()
+            if text == SERVER_STARTUP_MSG:
+                self.logger.info("Server started")
+                return
+
+            self.logger.debug(text)
+            line.clear()
+            lines += 1
+
+        raise RuntimeError("Server did not print its startup message")
+
+    def _log_stderr(self):
+        for line in self.process.stderr:
+            self.logger.debug(line.decode("utf-8", errors="replace").rstrip())
+
+    def stop(self, timeout: float = 10):
+        """
+        Closes the connection and waits for the server to exit
+
+        The server exits once its stdin is closed. It is killed if it takes longer
+        than timeout seconds.
+        """
+        if self.connection is not None:
+            self.connection.close()
+
+        if self.process is None:
+            return
+
+        try:
+            code = self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.logger.info("Server did not exit, killing it")
+            self.process.kill()
+            code = self.process.wait()
+
+        if self.stderr_thread is not None:
+            self.stderr_thread.join(timeout)
+
+        self.logger.info(f"Server exited with code {code}")
+
+    def __bool__(self):
+        return self.process is not None and self.process.poll() is None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
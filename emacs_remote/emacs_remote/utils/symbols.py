@@ -0,0 +1,446 @@
+import os
+import re
+from bisect import bisect_left
+from concurrent.futures import wait
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+from typing import List
+
+import msgpack
+
+from .files import AtomicFileWriter
+
+# Bumped whenever the patterns or the format of the stored index change
+INDEX_VERSION = 1
+
+# Files bigger than this are usually generated and are not indexed
+MAX_FILE_SIZE = 1024 * 1024
+
+# Number of files indexed by a worker at once
+CHUNK_SIZE = 256
+
+# Minimum number of seconds between saves of an incrementally updated index
+SAVE_INTERVAL = 60
+
+
+def _patterns(*patterns):
+    return [(kind, re.compile(regex, re.MULTILINE)) for kind, regex in patterns]
+
+
+_C_PATTERNS = _patterns(
+    ("macro", rb"^[ \t]*#[ \t]*define[ \t]+(\w+)"),
+    (
+        "type",
+        rb"^[ \t]*(?:typedef[ \t]+)?(?:struct|union|enum|class)[ \t]+(\w+)[ \t]*(?:[:{]|$)",
+    ),
+    ("type", rb"^[ \t]*typedef[^;(){}]*?(\w+)[ \t]*;"),
+    # The name of a typedef of a struct with a body comes after the body
+    ("type", rb"^\}[ \t]*(\w+)[ \t]*;"),
+    (
+        "function",
+        rb"^(?:[A-Za-z_][\w:<>,*& \t]*?[ \t*&])?((?:\w+::)*~?[A-Za-z_]\w*)[ \t]*\([^;\n]*\)?[ \t]*(?:const[ \t]*)?(?:\{|$)",
+    ),
+)
+
+_PATTERNS = {
+    "python": _patterns(
+        ("function", rb"^[ \t]*(?:async[ \t]+)?def[ \t]+(\w+)"),
+        ("class", rb"^[ \t]*class[ \t]+(\w+)"),
+        ("variable", rb"^(\w+)[ \t]*(?::[^=\n]*)?=(?!=)"),
+    ),
+    "elisp": _patterns(
+        ("function", rb"^\(cl-def(?:un|macro|generic|method|subst)[ \t]+([^\s()]+)"),
+        (
+            "function",
+            rb"^\(def(?:un|macro|subst|generic|method|advice|alias)\*?[ \t]+'?([^\s()]+)",
+        ),
+        (
+            "variable",
+            rb"^\(def(?:var|var-local|custom|const|face|group)[ \t]+([^\s()]+)",
+        ),
+    ),
+    "c": _C_PATTERNS,
+    "go": _patterns(
+        ("function", rb"^func[ \t]+(?:\([^)]*\)[ \t]*)?(\w+)"),
+        ("type", rb"^type[ \t]+(\w+)"),
+        ("variable", rb"^(?:var|const)[ \t]+(\w+)"),
+    ),
+    "rust": _patterns(
+        (
+            "function",
+            rb"^[ \t]*(?:pub(?:\([^)]*\))?[ \t]+)?(?:const[ \t]+)?(?:async[ \t]+)?(?:unsafe[ \t]+)?(?:extern[ \t]+\"[^\"]*\"[ \t]+)?fn[ \t]+(\w+)",
+        ),
+        (
+            "type",
+            rb"^[ \t]*(?:pub(?:\([^)]*\))?[ \t]+)?(?:struct|enum|union|trait|type)[ \t]+(\w+)",
+        ),
+        ("macro", rb"^[ \t]*macro_rules![ \t]*(\w+)"),
+        (
+            "variable",
+            rb"^[ \t]*(?:pub(?:\([^)]*\))?[ \t]+)?(?:const|static)[ \t]+(?:mut[ \t]+)?(\w+)",
+        ),
+    ),
+    "javascript": _patterns(
+        (
+            "function",
+            rb"^[ \t]*(?:export[ \t]+)?(?:default[ \t]+)?(?:async[ \t]+)?function\*?[ \t]+(\w+)",
+        ),
+        (
+            "class",
+            rb"^[ \t]*(?:export[ \t]+)?(?:default[ \t]+)?(?:abstract[ \t]+)?class[ \t]+(\w+)",
+        ),
+        ("type", rb"^[ \t]*(?:export[ \t]+)?(?:interface|type|enum)[ \t]+(\w+)"),
+        ("variable", rb"^[ \t]*(?:export[ \t]+)?(?:const|let|var)[ \t]+(\w+)[ \t]*="),
+    ),
+    "java": _patterns(
+        (
+            "class",
+            rb"^[ \t]*(?:(?:public|private|protected|static|final|abstract|sealed)[ \t]+)*(?:class|interface|enum|record)[ \t]+(\w+)",
+        ),
+        (
+            "function",
+            rb"^[ \t]+(?:(?:public|private|protected|static|final|abstract|synchronized|native)[ \t]+)+[\w<>\[\], ]+?[ \t]+(\w+)[ \t]*\(",
+        ),
+    ),
+    "ruby": _patterns(
+        ("function", rb"^[ \t]*def[ \t]+(?:self\.)?(\w+[?!=]?)"),
+        ("class", rb"^[ \t]*(?:class|module)[ \t]+([\w:]+)"),
+    ),
+    "shell": _patterns(
+        ("function", rb"^[ \t]*(?:function[ \t]+)?([\w.:-]+)[ \t]*\(\)"),
+        ("function", rb"^[ \t]*function[ \t]+([\w.:-]+)[ \t]*\{?$"),
+    ),
+}
+
+_LANGUAGES = {
+    ".py": "python",
+    ".pyi": "python",
+    ".el": "elisp",
+    ".c": "c",
+    ".h": "c",
+    ".cc": "c",
+    ".cpp": "c",
+    ".cxx": "c",
+    ".hh": "c",
+    ".hpp": "c",
+    ".hxx": "c",
+    ".go": "go",
+    ".rs": "rust",
+    ".js": "javascript",
+    ".jsx": "javascript",
+    ".mjs": "javascript",
+    ".ts": "javascript",
+    ".tsx": "javascript",
+    ".java": "java",
+    ".rb": "ruby",
+    ".sh": "shell",
+    ".bash": "shell",
+    ".zsh": "shell",
+}
+
+# Words that the C function pattern picks up from control flow statements
+_C_KEYWORDS = {b"if", b"for", b"while", b"switch", b"return", b"sizeof", b"else"}
+
+
+def language_for(path: str):
+    """
+    Returns the language of a file from its extension, or None if it isn't indexed
+    """
+    return _LANGUAGES.get(os.path.splitext(path)[1].lower())
+
+
+def extract_symbols(data: bytes, language: str) -> List[list]:
+    """
+    Finds the definitions in the contents of a file
+
+    Returns:
+        [name, kind, line] lists sorted by line. line is 1-based
+    """
+    found = []
+    for kind, pattern in _PATTERNS[language]:
+        for match in pattern.finditer(data):
+            name = match.group(1)
+            if language == "c" and name in _C_KEYWORDS:
+                continue
+            found.append((match.start(1), name, kind))
+
+    found.sort()
+    symbols = []
+    line, counted = 1, 0
+    previous = None
+    for offset, name, kind in found:
+        line += data.count(b"\n", counted, offset)
+        counted = offset
+        # Several patterns may match the same definition
+        if (offset, name) == previous:
+            continue
+        previous = (offset, name)
+        symbols.append([name.decode("utf-8", errors="replace"), kind, line])
+
+    return symbols
+
+
+def index_files(root: str, paths: List[str]) -> List[list]:
+    """
+    Extracts the symbols of files. Runs in the worker processes
+
+    Returns:
+        [path, mtime_ns, size, symbols] lists. Files that can't be read are left out
+    """
+    results = []
+    for path in paths:
+        try:
+            with open(os.path.join(root, path), "rb") as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size > MAX_FILE_SIZE:
+                    symbols = []
+                else:
+                    symbols = extract_symbols(f.read(), language_for(path))
+        except (OSError, ValueError):
+            continue
+
+        results.append([path, stat.st_mtime_ns, stat.st_size, symbols])
+
+    return results
+
+
+class SymbolIndex:
+    """
+    Index of the definitions in the files of a `ProjectIndex`, like a TAGS file
+    kept up to date by the server
+
+    Definitions are found with per language regexes, in parallel on a process pool.
+    The index is saved in the server's workspace directory, so restarting the
+    server only reindexes the files whose mtime or size changed. Once started, it
+    is updated from the changes seen by the project index.
+
+    Args:
+        root: the root of the project
+        path: the file the index is saved in
+        logger: the logger to use
+    """
+
+    def __init__(self, root, path, logger=None):
+        self.root = Path(root)
+        self.path = Path(path)
+        self.logger = logger
+
+        # path -> [mtime_ns, size, symbols]
+        self.files = {}
+        # name -> {path: [[kind, line], ...]}
+        self.definitions = {}
+        self.names = None
+
+        self.project_index = None
+        self.pool = None
+        self.started = False
+        self.dirty = False
+        self.saved_at = monotonic()
+        self.lock = Lock()
+        self.update_lock = Lock()
+        self.start_lock = Lock()
+
+    def start(self, project_index, pool=None):
+        """
+        Loads the saved index, brings it up to date with the project and starts
+        following its changes. Does nothing if it has already been started
+
+        Args:
+            project_index: the started `ProjectIndex` of the project
+            pool: the executor files are indexed on. Files are indexed in the
+                calling thread if None
+        """
+        with self.start_lock:
+            if self.started:
+                return
+
+            self.project_index = project_index
+            self.pool = pool
+            # Subscribe first so that no change is missed. Changes seen twice are
+            # just indexed twice
+            project_index.subscribe(self.on_changes)
+            self.load()
+            self.sync(project_index.paths())
+            self.save()
+            self.started = True
+
+    def close(self):
+        if self.started:
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = msgpack.unpack(f, raw=False, strict_map_key=False)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.error(f"Failed to load symbol index {self.path}: {e}")
+            return
+
+        if data.get("version") != INDEX_VERSION or data.get("root") != str(self.root):
+            return
+
+        with self.lock:
+            for path, (mtime_ns, size, symbols) in data["files"].items():
+                self.set_file(path, mtime_ns, size, symbols)
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+
+            data = msgpack.packb(
+                {"version": INDEX_VERSION, "root": str(self.root), "files": self.files},
+                use_bin_type=True,
+            )
+            self.dirty = False
+            self.saved_at = monotonic()
+
+        with AtomicFileWriter(self.path) as writer:
+            writer.write(data)
+            writer.commit()
+
+        if self.logger is not None:
+            self.logger.debug(f"Saved symbol index of {len(self.files)} files")
+
+    def sync(self, paths: List[bytes]):
+        """
+        Reindexes the files whose mtime or size changed and drops the files that
+        are gone
+
+        Args:
+            paths: every file in the project
+        """
+        root = str(self.root)
+        current, stale = set(), []
+        for path in map(os.fsdecode, paths):
+            if language_for(path) is None:
+                continue
+
+            current.add(path)
+            try:
+                stat = os.stat(os.path.join(root, path))
+            except OSError:
+                continue
+
+            entry = self.files.get(path)
+            if entry is None or entry[:2] != [stat.st_mtime_ns, stat.st_size]:
+                stale.append(path)
+
+        with self.lock:
+            removed = [path for path in self.files if path not in current]
+
+        self.update(stale, removed)
+        if self.logger is not None:
+            self.logger.debug(
+                f"Indexed symbols of {len(stale)} files, {len(current)} in total"
+            )
+
+    def on_changes(self, updated: List[bytes], removed: List[bytes], rebuilt: bool):
+        if rebuilt:
+            self.sync(self.project_index.paths())
+        else:
+            updated = [os.fsdecode(path) for path in updated]
+            self.update(
+                [path for path in updated if language_for(path) is not None],
+                [os.fsdecode(path) for path in removed],
+            )
+
+        if monotonic() - self.saved_at > SAVE_INTERVAL:
+            self.save()
+
+    def update(self, updated: List[str], removed: List[str]):
+        # Updates are serialized so that an older read of a file never replaces a
+        # newer one
+        with self.update_lock:
+            results = self.index(updated)
+            with self.lock:
+                for path in removed:
+                    self.remove_file(path)
+                for path in updated:
+                    self.remove_file(path)
+                for path, mtime_ns, size, symbols in results:
+                    self.set_file(path, mtime_ns, size, symbols)
+
+                if removed or updated:
+                    self.dirty = True
+
+    def index(self, paths: List[str]) -> List[list]:
+        root = str(self.root)
+        if self.pool is None or len(paths) <= CHUNK_SIZE:
+            return index_files(root, paths)
+
+        futures = [
+            self.pool.submit(index_files, root, paths[i : i + CHUNK_SIZE])
+            for i in range(0, len(paths), CHUNK_SIZE)
+        ]
+        wait(futures)
+
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def set_file(self, path: str, mtime_ns: int, size: int, symbols: List[list]):
+        self.files[path] = [mtime_ns, size, symbols]
+        for name, kind, line in symbols:
+            locations = self.definitions.setdefault(name, {})
+            if not locations:
+                self.names = None
+            locations.setdefault(path, []).append([kind, line])
+
+    def remove_file(self, path: str):
+        entry = self.files.pop(path, None)
+        if entry is None:
+            return
+
+        for name, _, _ in entry[2]:
+            locations = self.definitions.get(name)
+            if locations is None or locations.pop(path, None) is None:
+                continue
+            if not locations:
+                del self.definitions[name]
+                self.names = None
+
+    def lookup(
+        self, name: str, prefix: bool = False, max_results: int = 100
+    ) -> List[list]:
+        """
+        Finds the definitions of a name, or of every name starting with it
+
+        Returns:
+            [name, kind, path, line] lists, sorted by name then path
+        """
+        with self.lock:
+            if not prefix:
+                names = [name] if name in self.definitions else []
+            else:
+                if self.names is None:
+                    self.names = sorted(self.definitions)
+                start = bisect_left(self.names, name)
+                names = []
+                for candidate in self.names[start:]:
+                    if not candidate.startswith(name) or len(names) == max_results:
+                        break
+                    names.append(candidate)
+
+            results = []
+            for candidate in names:
+                for path, definitions in sorted(self.definitions[candidate].items()):
+                    for kind, line in definitions:
+                        if len(results) == max_results:
+                            return results
+                        results.append([candidate, kind, path, line])
+
+            return results
+
+    def file_symbols(self, path: str) -> List[list]:
+        """
+        Returns the [name, kind, line] definitions in a file, sorted by line
+        """
+        with self.lock:
+            entry = self.files.get(path)
+            return [] if entry is None else list(entry[2])
@@ -0,0 +1,372 @@
+import abc
+import ctypes
+import errno
+import os
+import select
+import struct
+import time
+from pathlib import Path
+
+# Directories that are never watched
+DEFAULT_IGNORE = (".git", "__pycache__", "node_modules")
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_ONLYDIR
+    | IN_EXCL_UNLINK
+)
+_EVENT = struct.Struct("iIII")
+_READ_SIZE = 64 * 1024
+
+
+class Changes:
+    """
+    The files that changed since the last batch
+
+    Events for the same path are coalesced so that only the last state of each path
+    is reported.
+    """
+
+    def __init__(self):
+        self.changed = set()
+        self.deleted = set()
+        # Events were lost. Everything should be assumed to have changed
+        self.overflow = False
+
+    def modified(self, path: str):
+        self.deleted.discard(path)
+        self.changed.add(path)
+
+    def removed(self, path: str):
+        self.changed.discard(path)
+        self.deleted.add(path)
+
+    def __len__(self):
+        return len(self.changed) + len(self.deleted) + int(self.overflow)
+
+
+class FileWatcher(abc.ABC):
+    """
+    Watches the files under a directory for changes
+
+    Args:
+        root: the directory to watch
+        ignore: names of directories that are not watched, or a function that is
+            given the path of a directory relative to root and returns whether the
+            directory is ignored
+    """
+
+    def __init__(self, root, ignore=DEFAULT_IGNORE):
+        self.root = Path(root)
+        self.ignore = ignore if callable(ignore) else set(ignore)
+
+    def relative(self, path: str) -> str:
+        return os.path.relpath(path, self.root)
+
+    def ignored(self, path: str) -> bool:
+        """
+        Whether a directory is ignored
+        """
+        if callable(self.ignore):
+            return self.ignore(self.relative(path))
+
+        return os.path.basename(path) in self.ignore
+
+    def walk(self, path: str):
+        """
+        Yields (path, is_dir) for everything under a directory that isn't ignored
+        """
+        try:
+            entries = list(os.scandir(path))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            return
+
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+
+            if is_dir:
+                if self.ignored(entry.path):
+                    continue
+
+                yield entry.path, True
+                yield from self.walk(entry.path)
+            else:
+                yield entry.path, False
+
+    @abc.abstractmethod
+    def poll(self, changes: Changes, timeout: float):
+        """
+        Waits up to timeout seconds for changes and adds them to changes
+        """
+        pass
+
+    def batches(self, stop, latency=0.2, max_batch=1024, heartbeat=10):
+        """
+        Yields coalesced batches of changes
+
+        Once a change comes in, further changes are collected for `latency` seconds
+        so that a burst of events (a save, a checkout) is sent as a single batch.
+
+        Args:
+            stop: called regularly. The generator ends once it returns True
+            latency: seconds to collect changes for after the first one
+            max_batch: the batch is sent early once this many paths have changed
+            heartbeat: seconds after which an empty batch is yielded if nothing
+                changed, so that a consumer that went away is noticed
+        """
+        while not stop():
+            changes = Changes()
+            idle_since = time.monotonic()
+            while not changes and not stop():
+                if time.monotonic() - idle_since >= heartbeat:
+                    break
+
+                self.poll(changes, min(heartbeat, 0.5))
+
+            if not changes and stop():
+                return
+
+            deadline = time.monotonic() + latency
+            while changes and len(changes) < max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                self.poll(changes, remaining)
+
+            yield changes
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class InotifyWatcher(FileWatcher):
+    """
+    Watches a directory tree with inotify
+
+    Costs nothing while files are idle. Every directory needs its own watch, so very
+    large trees may run into fs.inotify.max_user_watches, in which case an OSError
+    is raised.
+    """
+
+    def __init__(self, root, ignore=DEFAULT_IGNORE):
+        super().__init__(root, ignore)
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+        self.paths = {}
+        self.watches = {}
+        try:
+            self.watch_tree(str(self.root))
+        except OSError:
+            self.close()
+            raise
+
+    def add_watch(self, path: str):
+        wd = self._add_watch(self.fd, os.fsencode(path), _WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                # Removed before it could be watched
+                return
+            raise OSError(e, f"inotify_add_watch {path}: {os.strerror(e)}")
+
+        self.paths[wd] = path
+        self.watches[path] = wd
+
+    def watch_tree(self, path: str, changes: Changes = None):
+        """
+        Watches a directory and all directories under it
+
+        Args:
+            path: the directory to watch
+            changes: if given, every file under the directory is added to it. Files
+                may have been created before the directory was being watched
+        """
+        self.add_watch(path)
+        for child, is_dir in self.walk(path):
+            if is_dir:
+                self.add_watch(child)
+            elif changes is not None:
+                changes.modified(self.relative(child))
+
+    def unwatch_tree(self, path: str):
+        prefix = path + os.sep
+        for watched in [p for p in self.watches if p == path or p.startswith(prefix)]:
+            wd = self.watches.pop(watched)
+            self.paths.pop(wd, None)
+            self._rm_watch(self.fd, wd)
+
+    def poll(self, changes: Changes, timeout: float):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return
+
+        while True:
+            try:
+                data = os.read(self.fd, _READ_SIZE)
+            except BlockingIOError:
+                return
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+
+                self.handle_event(changes, wd, mask, os.fsdecode(name))
+
+    def handle_event(self, changes: Changes, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            changes.overflow = True
+            return
+
+        directory = self.paths.get(wd)
+        if directory is None:
+            return
+
+        if mask & IN_IGNORED:
+            # The watch was removed because the directory is gone
+            self.paths.pop(wd, None)
+            self.watches.pop(directory, None)
+            return
+
+        if not name:
+            # An event on the watched directory itself
+            if mask & IN_DELETE_SELF:
+                changes.removed(self.relative(directory))
+            return
+
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if self.ignored(path):
+                return
+
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(path, changes)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.unwatch_tree(path)
+                changes.removed(self.relative(path))
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            changes.removed(self.relative(path))
+        else:
+            changes.modified(self.relative(path))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class ScanWatcher(FileWatcher):
+    """
+    Watches a directory tree by periodically comparing the size and modification
+    time of every file
+
+    Used where inotify is not available. Only stat calls are made, no files are read.
+
+    Args:
+        interval: seconds between scans
+    """
+
+    def __init__(self, root, ignore=DEFAULT_IGNORE, interval: float = 1.0):
+        super().__init__(root, ignore)
+        self.interval = interval
+        self.files = self.scan()
+        self.next_scan = time.monotonic() + interval
+
+    def scan(self):
+        files = {}
+        for path, is_dir in self.walk(str(self.root)):
+            if not is_dir:
+                try:
+                    stat = os.stat(path, follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                files[path] = (stat.st_mtime_ns, stat.st_size)
+
+        return files
+
+    def poll(self, changes: Changes, timeout: float):
+        wait = self.next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return
+
+        if wait > 0:
+            time.sleep(wait)
+
+        files = self.scan()
+        for path, stat in files.items():
+            if self.files.get(path) != stat:
+                changes.modified(self.relative(path))
+
+        for path in self.files.keys() - files.keys():
+            changes.removed(self.relative(path))
+
+        self.files = files
+        self.next_scan = time.monotonic() + self.interval
+
+
+def create_watcher(root, ignore=DEFAULT_IGNORE, logger=None, **kwargs) -> FileWatcher:
+    """
+    Creates an `InotifyWatcher`, falling back to a `ScanWatcher` if inotify can't
+    be used
+
+    Args:
+        root: the directory to watch
+        ignore: see `FileWatcher`
+        logger: used to log why inotify could not be used
+        kwargs: passed to `ScanWatcher`
+    """
+    try:
+        return InotifyWatcher(root, ignore)
+    except (AttributeError, OSError) as e:
+        if logger is not None:
+            logger.info(f"inotify unavailable ({e}). Scanning for changes instead")
+
+    return ScanWatcher(root, ignore, **kwargs)
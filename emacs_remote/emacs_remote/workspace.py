@@ -1,7 +1,9 @@
 import os
+import posixpath
 from dataclasses import dataclass
 from pathlib import Path
 
+from emacs_remote import utils
 from emacs_remote.utils.logging import LoggerFactory
 
 
@@ -14,7 +16,7 @@ class Workspace:
 
     def __post_init__(self):
         self.workspace = Path(self.workspace)
-        self.workspace_hash = utils.md5((self.host, str(self.workspace)))
+        self.workspace_hash = utils.md5((self.host or "", str(self.workspace)))
 
         self.emacs_remote_path = Path(self.emacs_remote_path)
         self.emacs_remote_path.mkdir(parents=True, exist_ok=True)
@@ -27,11 +29,64 @@ class Workspace:
         self.base_path = self.workspace_path.joinpath(self.workspace.name)
         self.base_path.mkdir(exist_ok=True)
 
-        self.logging_level = logging_level
         self.logging_factory = LoggerFactory(
-            logging_level, self.workspace_path.joinpath("client_interface.log")
+            self.logging_level, self.workspace_path.joinpath("client_interface.log")
         )
 
+    def __getstate__(self):
+        # Loggers can't be pickled. Workspaces sent to worker processes log to stderr
+        state = self.__dict__.copy()
+        del state["logging_factory"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logging_factory = LoggerFactory(self.logging_level)
+
+    def remote_path(self, file_path: str, absolute: bool = False) -> Path:
+        """
+        Path of a file on the server
+
+        Args:
+            file_path: path of the file relative to the workspace, or an absolute path
+            absolute: whether file_path is absolute
+        """
+        if absolute:
+            return Path(file_path)
+
+        return self.workspace.joinpath(file_path)
+
+    def local_path(self, file_path: str, absolute: bool = False) -> Path:
+        """
+        Path of the local copy of a file on the server
+
+        Files inside the workspace are mirrored under base_path. Files outside of it
+        are mirrored under an "absolute" directory so they can't clobber local files.
+
+        Args:
+            file_path: path of the file relative to the workspace, or an absolute path
+            absolute: whether file_path is absolute
+        Raises:
+            ValueError: if the path would map outside of both directories
+        """
+        # ".." is resolved the way the server resolves it before mapping, as the
+        # mapping itself is purely lexical
+        path = Path(posixpath.normpath(self.remote_path(file_path, absolute)))
+        workspace = Path(posixpath.normpath(self.workspace))
+        try:
+            root = self.base_path
+            local = root.joinpath(path.relative_to(workspace))
+        except ValueError:
+            if not path.is_absolute():
+                raise ValueError(f"{file_path} is outside of the local mirror")
+            root = self.workspace_path.joinpath("absolute")
+            local = root.joinpath(*path.parts[1:])
+
+        if ".." in local.relative_to(root).parts:
+            raise ValueError(f"{file_path} is outside of the local mirror")
+
+        return local
+
     def __str__(self):
         return str(self.workspace)
 
@@ -2,9 +2,10 @@
 
 import select
 import socket
-from time import sleep
+from queue import Empty as EmptyQueue
+from queue import Queue
 from threading import Barrier, Event, Thread
-from queue import Queue, Empty as EmptyQueue
+from time import sleep
 
 from emacs_remote.utils.stcp_socket import SecureTCPSocket
 
@@ -9,9 +9,14 @@ mkdir -p $EMACS_REMOTE_PATH
 cd $EMACS_REMOTE_PATH
 
 export PATH=$PATH:$EMACS_REMOTE_PATH/bin
-if ! which emacs-remote-server; then
-    echo "Could not find emacs-remote-server"
+if ! which emacs-remote-server >&2; then
+    echo "Could not find emacs-remote-server" >&2
     exit 1
 fi
 
+# In stdio mode the protocol runs over this script's stdin and stdout
+if [ -n "$STDIO" ]; then
+    exec emacs-remote-server -r $EMACS_REMOTE_PATH --workspace $WORKSPACE --stdio --level="$LEVEL"
+fi
+
 exec emacs-remote-server -r $EMACS_REMOTE_PATH --workspace $WORKSPACE --ports $PORTS --level="$LEVEL"
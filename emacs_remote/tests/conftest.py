@@ -0,0 +1,47 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture
+def fake_ssh(tmp_path, monkeypatch):
+    """
+    Puts an ssh that runs commands on this machine first on the PATH, and returns
+    the directory used as the home of emacs-remote
+    """
+    bin_path = tmp_path.joinpath("bin")
+    bin_path.mkdir()
+    ssh = bin_path.joinpath("ssh")
+    ssh.write_text(
+        f'#!/bin/sh\nexec {sys.executable} {PACKAGE_ROOT}/tests/fake_ssh.py "$@"\n'
+    )
+    ssh.chmod(0o755)
+
+    monkeypatch.setenv("PATH", f"{bin_path}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv(
+        "PYTHONPATH",
+        os.pathsep.join(
+            filter(None, [str(PACKAGE_ROOT), os.environ.get("PYTHONPATH")])
+        ),
+    )
+    # Workspaces change the working directory
+    monkeypatch.chdir(tmp_path)
+
+    return tmp_path.joinpath("emacs_remote")
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    """
+    A workspace on the "server" with a few files in it
+    """
+    path = tmp_path.joinpath("workspace")
+    path.joinpath("pkg").mkdir(parents=True)
+    path.joinpath("pkg", "a.py").write_text("import pkg.b\n")
+    path.joinpath("pkg", "b.py").write_text("x = 1\n")
+    path.joinpath("README").write_text("hello\n")
+    return path
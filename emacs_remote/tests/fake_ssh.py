@@ -0,0 +1,104 @@
+"""
+Stands in for ssh in tests by running the remote command on this machine
+
+Control masters are files at their ControlPath and `-L` forwards are relayed by
+threads of this process, so the client can't tell the difference.
+"""
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+from threading import Thread
+
+
+def pipe(source, sink):
+    try:
+        while True:
+            data = source.recv(65536)
+            if not data:
+                break
+            sink.sendall(data)
+    except OSError:
+        pass
+    finally:
+        for s in (source, sink):
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def forward(listener, port):
+    while True:
+        conn, _ = listener.accept()
+        try:
+            upstream = socket.create_connection(("localhost", port))
+        except OSError:
+            conn.close()
+            continue
+
+        for source, sink in ((conn, upstream), (upstream, conn)):
+            Thread(target=pipe, args=(source, sink), daemon=True).start()
+
+
+def main(args):
+    options = {}
+    flags = []
+    forwards = []
+    i = 0
+    while i < len(args) and args[i].startswith("-"):
+        if args[i] == "-o":
+            key, value = args[i + 1].split("=", 1)
+            options[key] = value
+            i += 2
+        elif args[i] in ("-O", "-E", "-L"):
+            if args[i] == "-L":
+                forwards.append(args[i + 1])
+            else:
+                options[args[i]] = args[i + 1]
+            i += 2
+        else:
+            flags.append(args[i])
+            i += 1
+
+    control_path = options.get("ControlPath")
+    operation = options.get("-O")
+    if operation == "check":
+        return 0 if os.path.exists(control_path) else 255
+    if operation == "exit":
+        if os.path.exists(control_path):
+            os.unlink(control_path)
+        return 0
+    if operation is not None:
+        return 0
+
+    if "-N" in flags:
+        open(control_path, "w").close()
+        return 0
+
+    _host, *command = args[i:]
+    if not forwards:
+        # Killing ssh then closes its end of the pipe, as it would with a real host
+        os.execvp("bash", ["bash", "-c", " ".join(command)])
+
+    for spec in forwards:
+        local_port, _, remote_port = spec.split(":")
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("localhost", int(local_port)))
+        listener.listen()
+        Thread(target=forward, args=(listener, int(remote_port)), daemon=True).start()
+
+    process = subprocess.Popen(["bash", "-c", " ".join(command)])
+
+    def interrupt(signum, frame):
+        process.send_signal(signal.SIGINT)
+
+    signal.signal(signal.SIGINT, interrupt)
+    return process.wait()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
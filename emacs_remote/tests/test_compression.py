@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from emacs_remote.utils.compression import (CODECS_BY_NAME, NO_COMPRESSION,
+                                            CompressionPolicy, ZlibCodec,
+                                            decompress)
+
+
+@pytest.mark.parametrize(
+    "policy",
+    [
+        CompressionPolicy.strong(),
+        # What strong is when zstd is installed
+        CompressionPolicy(codecs=["zstd", "zlib"], large_level=19),
+    ],
+)
+def test_strong_policy_with_zlib_only_peer(policy):
+    data = b"compressible " * (2 * 1024 * 1024 // 13)
+
+    flags, payload = policy.compress(bytes, data, ["zlib"])
+
+    assert flags == ZlibCodec.id
+    assert decompress(flags, payload) == data
+
+
+@pytest.mark.parametrize("name", sorted(CODECS_BY_NAME))
+def test_levels_are_clamped(name):
+    codec = CODECS_BY_NAME[name]
+
+    assert codec.clamp_level(None) is None
+    assert codec.clamp_level(100) == codec.max_level
+    assert codec.clamp_level(-100) == codec.min_level
+
+    data = b"abc" * 10000
+    for level in (codec.min_level, codec.max_level):
+        assert codec.decompress(codec.compress(data, level)) == data
+
+
+def test_parts_are_compressed_without_joining():
+    parts = [b"hello world " * 1000, memoryview(b"abc" * 5000), bytearray(3000)]
+
+    flags, payload = CompressionPolicy().compress(bytes, parts)
+
+    assert flags != NO_COMPRESSION
+    assert decompress(flags, payload) == b"".join(parts)
+
+
+def test_incompressible_data_is_sent_as_is():
+    data = os.urandom(1024 * 1024)
+
+    assert CompressionPolicy().compress(bytes, data) == (NO_COMPRESSION, data)
+
+
+def test_decompressed_size_is_bounded():
+    data = bytes(10 * 1024 * 1024)
+    flags, payload = CompressionPolicy().compress(bytes, data)
+
+    with pytest.raises(ValueError):
+        decompress(flags, payload, max_size=1024 * 1024)
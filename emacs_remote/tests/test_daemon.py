@@ -0,0 +1,196 @@
+import shlex
+import sys
+import time
+from threading import Thread
+
+import pytest
+
+from emacs_remote.client.daemon import ClientDaemon
+from emacs_remote.client.interface import ClientInterface
+from emacs_remote.messages import Priority, ShellRequest, StatRequest
+from emacs_remote.utils.scheduler import RequestScheduler
+from emacs_remote.utils.stcp import SecureTCP
+from emacs_remote.utils.stdio import StdioTransport
+
+
+@pytest.fixture
+def stcp_server(tmp_path, monkeypatch):
+    """
+    Runs the server from this checkout rather than the installed script
+    """
+
+    def server_script_command(workspace, ports, level="info"):
+        return shlex.join(
+            [
+                sys.executable,
+                "-m",
+                "emacs_remote.server.main",
+                "-r",
+                str(tmp_path.joinpath("server")),
+                "-w",
+                str(workspace),
+                "-p",
+                *ports,
+            ]
+        )
+
+    monkeypatch.setattr(
+        SecureTCP, "server_script_command", staticmethod(server_script_command)
+    )
+
+
+@pytest.fixture
+def stdio_server(tmp_path, monkeypatch):
+    """
+    Runs the server from this checkout in stdio mode
+    """
+
+    def server_script_command(workspace, level="info"):
+        return shlex.join(
+            [
+                sys.executable,
+                "-m",
+                "emacs_remote.server.main",
+                "--stdio",
+                "-r",
+                str(tmp_path.joinpath("server")),
+                "-w",
+                str(workspace),
+            ]
+        )
+
+    monkeypatch.setattr(
+        StdioTransport, "server_script_command", staticmethod(server_script_command)
+    )
+
+
+@pytest.fixture
+def streamed(monkeypatch):
+    """
+    Records the (request type, priority) of every request sent by a scheduler
+    """
+    streamed = []
+    stream = RequestScheduler.stream
+
+    def record(self, request, priority=None):
+        streamed.append((type(request), priority))
+        return stream(self, request, priority)
+
+    monkeypatch.setattr(RequestScheduler, "stream", record)
+    return streamed
+
+
+def listen(daemon: ClientDaemon):
+    """
+    Serves client interfaces in the background and waits for the port file
+    """
+    thread = Thread(target=daemon.listen)
+    thread.daemon = True
+    thread.start()
+
+    port_file = daemon.workspace.workspace_path.joinpath("daemon.port")
+    for _ in range(100):
+        if port_file.exists():
+            return thread
+        time.sleep(0.05)
+
+    raise TimeoutError("The daemon didn't write its port")
+
+
+def test_stcp_session(fake_ssh, stcp_server, workspace):
+    daemon = ClientDaemon(fake_ssh, "myhost", workspace, num_clients=2)
+    with daemon:
+        assert daemon.connected.wait(60)
+
+        assert len(daemon.scheduler.connections) == 2
+        assert set(daemon.relay.ports) == set(Priority)
+        assert daemon.prefetcher.thread.is_alive()
+
+        response = daemon.send_request(StatRequest("README"))
+        assert response.exists
+        assert response.size == len("hello\n")
+
+    assert not daemon.server
+
+
+def test_interface_requests_go_through_the_scheduler(
+    fake_ssh, stcp_server, workspace, streamed
+):
+    daemon = ClientDaemon(fake_ssh, "myhost", workspace, num_clients=2)
+    with daemon:
+        listener = listen(daemon)
+
+        with ClientInterface(fake_ssh, "myhost", workspace, "info") as client:
+            assert client.send_request(StatRequest("README")).exists
+            assert client.send_request(StatRequest("pkg"), Priority.bulk).is_dir
+
+            # Served by the daemon itself, on a connection of its own
+            listing = client.list_dir("pkg")
+            assert sorted(entry[0] for entry in listing.listing.entries()) == [
+                "a.py",
+                "b.py",
+            ]
+
+        assert (StatRequest, Priority.interactive) in streamed
+        assert (StatRequest, Priority.bulk) in streamed
+
+    listener.join(5)
+    assert not listener.is_alive()
+    assert not daemon.workspace.workspace_path.joinpath("daemon.port").exists()
+
+
+def test_interface_over_stdio(fake_ssh, stdio_server, workspace, streamed):
+    daemon = ClientDaemon(fake_ssh, "myhost", workspace, transport="stdio")
+    with daemon:
+        listener = listen(daemon)
+
+        with ClientInterface(fake_ssh, "myhost", workspace, "info") as client:
+            assert client.send_request(StatRequest("README")).exists
+
+            response = client.get_file("pkg/a.py")
+            assert response.file_path is not None
+            local_path = client.workspace.local_path("pkg/a.py")
+            assert local_path.read_text() == "import pkg.b\n"
+
+            request = ShellRequest(["echo", "hi"], stream=True)
+            output = list(client.stream_request(request))
+            assert output[0].data == b"hi\n"
+            assert output[-1].returncode == 0
+
+            # The relay keeps serving the interface once the daemon reconnects
+            server = daemon.server
+            server.process.kill()
+            for _ in range(100):
+                if daemon.server not in (None, server):
+                    break
+                time.sleep(0.1)
+            else:
+                raise TimeoutError("The daemon didn't reconnect")
+            assert client.send_request(StatRequest("README")).exists
+
+        assert (StatRequest, Priority.interactive) in streamed
+        assert (ShellRequest, Priority.interactive) in streamed
+
+    listener.join(5)
+    assert not listener.is_alive()
+
+
+def test_opened_files_are_prefetched(fake_ssh, stdio_server, workspace):
+    daemon = ClientDaemon(fake_ssh, "myhost", workspace, transport="stdio")
+    with daemon:
+        listen(daemon)
+
+        with ClientInterface(fake_ssh, "myhost", workspace, "info") as client:
+            client.get_file("pkg/a.py")
+
+            # Imported by pkg/a.py
+            imported = client.workspace.local_path("pkg/b.py")
+            for _ in range(100):
+                if daemon.file_cache.get("pkg/b.py") is not None:
+                    break
+                time.sleep(0.1)
+            else:
+                raise TimeoutError("pkg/b.py wasn't prefetched")
+
+            assert imported.read_text() == "x = 1\n"
+            assert daemon.prefetcher.history == ["pkg/a.py"]
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from emacs_remote.utils.delta import FileSignature, apply_delta, compute_delta
+
+BLOCK_SIZE = 64
+
+
+def roundtrip(basis: bytes, data: bytes):
+    signature = FileSignature.compute(basis, BLOCK_SIZE)
+    delta = compute_delta(signature, data)
+
+    pieces = []
+    apply_delta(basis, delta, BLOCK_SIZE, pieces.append)
+    assert b"".join(pieces) == data
+    return delta
+
+
+def literal_size(delta):
+    return sum(len(i) for i in delta if isinstance(i, bytes))
+
+
+def test_unchanged_file_is_copied():
+    basis = os.urandom(BLOCK_SIZE * 10)
+    assert roundtrip(basis, basis) == [[0, 10]]
+
+
+def test_short_last_block():
+    basis = os.urandom(BLOCK_SIZE * 4 + 10)
+    assert roundtrip(basis, basis) == [[0, 5]]
+
+    # Only the short last block changed
+    data = basis[:-10] + os.urandom(10)
+    delta = roundtrip(basis, data)
+    assert delta[0] == [0, 4]
+    assert literal_size(delta) == 10
+
+    # The short last block moved after an insertion
+    data = basis[:BLOCK_SIZE] + b"new" + basis[BLOCK_SIZE:]
+    delta = roundtrip(basis, data)
+    assert literal_size(delta) == 3
+    assert delta[-1] == [1, 4]
+
+
+@pytest.mark.parametrize("offset", [0, 1, BLOCK_SIZE - 1, BLOCK_SIZE * 3 + 17])
+def test_insertions(offset):
+    basis = os.urandom(BLOCK_SIZE * 8)
+    inserted = os.urandom(5)
+    data = basis[:offset] + inserted + basis[offset:]
+
+    delta = roundtrip(basis, data)
+    # Only the block the bytes were inserted in is sent
+    assert literal_size(delta) <= BLOCK_SIZE + len(inserted)
+
+
+def test_deletions_and_moves():
+    blocks = [os.urandom(BLOCK_SIZE) for _ in range(6)]
+    basis = b"".join(blocks)
+
+    assert roundtrip(basis, b"".join(blocks[3:] + blocks[:3])) == [[3, 3], [0, 3]]
+    # Only what is left of the blocks the deleted bytes were in is sent
+    delta = roundtrip(basis, basis[:100] + basis[200:])
+    assert literal_size(delta) == (100 - BLOCK_SIZE) + (BLOCK_SIZE * 4 - 200)
+    assert delta[-1] == [4, 2]
+
+
+def test_empty_files():
+    data = os.urandom(BLOCK_SIZE * 2 + 3)
+
+    assert FileSignature.compute(b"", BLOCK_SIZE).weak == []
+    assert roundtrip(b"", data) == [data]
+    assert roundtrip(b"", b"") == []
+    assert roundtrip(data, b"") == []
+
+
+def test_copy_past_end_of_basis():
+    with pytest.raises(ValueError):
+        apply_delta(b"short", [[1, 1]], BLOCK_SIZE, lambda data: None)
@@ -0,0 +1,102 @@
+import multiprocessing
+import os
+
+from emacs_remote.utils.file_cache import FileCache, content_digest
+
+
+def new_cache(tmp_path, max_bytes=1024):
+    def local_path(file_path, absolute=False):
+        return tmp_path.joinpath("files", file_path)
+
+    return FileCache(tmp_path.joinpath("cache", "index"), local_path, max_bytes)
+
+
+def fetch(cache, file_path, data: bytes):
+    """
+    Writes a local copy of a file and records it like a fetch does
+    """
+    path = cache.local_path(file_path, False)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    cache.update(file_path, False, 1, len(data), content_digest(data))
+    return path
+
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = new_cache(tmp_path, max_bytes=20)
+    a = fetch(cache, "a", b"a" * 8)
+    b = fetch(cache, "b", b"b" * 8)
+
+    # Using a makes b the least recently used
+    assert cache.get("a") is not None
+    c = fetch(cache, "c", b"c" * 8)
+
+    assert list(cache.entries) == [cache.key("a"), cache.key("c")]
+    assert cache.total_size == 16
+    assert a.exists() and not b.exists() and c.exists()
+
+    # The index on disk agrees
+    assert list(new_cache(tmp_path, max_bytes=20).entries) == list(cache.entries)
+
+
+def test_edited_copies_are_kept(tmp_path):
+    cache = new_cache(tmp_path, max_bytes=10)
+    a = fetch(cache, "a", b"a" * 8)
+    a.write_bytes(b"edited")
+
+    assert cache.get("a") is None
+    assert cache.key("a") not in cache.entries
+
+    fetch(cache, "b", b"b" * 8)
+    a.write_bytes(b"edited again")
+    os.utime(a, ns=(0, 0))
+    fetch(cache, "c", b"c" * 8)
+    assert a.read_bytes() == b"edited again"
+
+
+def test_oversized_file_is_kept(tmp_path):
+    cache = new_cache(tmp_path, max_bytes=4)
+    fetch(cache, "a", b"a" * 8)
+
+    assert cache.get("a") is not None
+
+
+def test_changes_of_other_caches_are_reloaded(tmp_path):
+    first = new_cache(tmp_path)
+    second = new_cache(tmp_path)
+
+    fetch(first, "a", b"a")
+    fetch(second, "b", b"b")
+    assert list(second.entries) == [first.key("a"), first.key("b")]
+
+    first.reload()
+    assert list(first.entries) == list(second.entries)
+
+    first.invalidate(["a"])
+    second.reload()
+    assert list(second.entries) == [first.key("b")]
+    assert second.total_size == 1
+
+
+def fetch_many(tmp_path, worker, count):
+    cache = new_cache(tmp_path, max_bytes=1024 * 1024)
+    for i in range(count):
+        fetch(cache, f"{worker}/{i}", b"x" * (i + 1))
+
+
+def test_processes_do_not_lose_changes(tmp_path):
+    count = 20
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=fetch_many, args=(tmp_path, worker, count))
+        for worker in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    cache = new_cache(tmp_path)
+    assert len(cache.entries) == 4 * count
+    assert cache.total_size == 4 * sum(range(1, count + 1))
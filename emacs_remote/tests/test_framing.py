@@ -0,0 +1,112 @@
+import asyncio
+import os
+import threading
+from dataclasses import dataclass
+
+import msgpack
+import pytest
+
+from emacs_remote.messages import GetFileRangeResponse, PortRequest
+from emacs_remote.utils import async_socket
+from emacs_remote.utils.async_socket import AsyncSecureSocket
+from emacs_remote.utils.compression import CompressionPolicy
+from emacs_remote.utils.framing import (MessageUnpacker, _pack_default,
+                                        decode_message, encode_message,
+                                        unpack_header)
+from emacs_remote.utils.spill import FrameLimits, SpillWriter
+
+
+def roundtrip(message, unpacker, **kwargs):
+    header, payload = encode_message(message, **kwargs)
+    message_type, _, flags, _ = unpack_header(header)
+    return decode_message(message_type, flags, b"".join(payload), None, unpacker)
+
+
+def test_unpacker_is_reused():
+    unpacker = MessageUnpacker(1024 * 1024)
+    reused = unpacker.unpacker
+    messages = [
+        PortRequest(1),
+        GetFileRangeResponse("a", False, 0, b"x" * 100, 100),
+        GetFileRangeResponse("b", False, 4, b"y" * 200 * 1024, 200 * 1024),
+        PortRequest(2),
+    ]
+    for message in messages:
+        assert roundtrip(message, unpacker) == message
+
+    assert unpacker.unpacker is reused
+
+
+def test_unpacker_recovers_from_bad_messages():
+    unpacker = MessageUnpacker(1024)
+    packed = msgpack.packb([1, 2])
+
+    with pytest.raises(ValueError):
+        unpacker.unpack(packed + b"\x01")
+    with pytest.raises(Exception):
+        unpacker.unpack(packed[:-1])
+
+    assert unpacker.unpack(packed) == [1, 2]
+    assert unpacker.unpack(packed) == [1, 2]
+
+
+@dataclass
+class Inner:
+    items: list
+
+
+@dataclass
+class Outer:
+    name: str
+    inner: Inner
+
+
+def test_nested_dataclasses_are_not_copied():
+    inner = Inner([1, 2, 3])
+    fields = _pack_default(Outer("a", inner))
+
+    assert fields[1] is inner
+    assert _pack_default(inner)[0] is inner.items
+    assert msgpack.unpackb(msgpack.packb(Outer("a", inner), default=_pack_default)) == [
+        "a",
+        [[1, 2, 3]],
+    ]
+
+    with pytest.raises(TypeError):
+        _pack_default(Outer)
+
+
+def test_async_socket_decodes_off_the_event_loop(monkeypatch):
+    threads = []
+
+    def record(function):
+        def wrapper(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return function(*args, **kwargs)
+
+        return wrapper
+
+    monkeypatch.setattr(async_socket, "decode_message", record(decode_message))
+    monkeypatch.setattr(SpillWriter, "decode", record(SpillWriter.decode))
+
+    small = PortRequest(1)
+    compressed = GetFileRangeResponse("a", False, 0, b"x" * 4096, 4096)
+    spilled = GetFileRangeResponse("b", False, 0, os.urandom(8192), 8192)
+    compression = CompressionPolicy(codecs=["zlib"])
+
+    async def main():
+        reader = asyncio.StreamReader()
+        for message in (small, compressed, spilled):
+            header, payload = encode_message(message, compression=compression)
+            reader.feed_data(header + b"".join(payload))
+        reader.feed_eof()
+
+        limits = FrameLimits(spill_threshold=1024)
+        conn = AsyncSecureSocket(reader, None, limits=limits)
+        return [(await conn.recv_message())[1] for _ in range(4)]
+
+    assert asyncio.run(main()) == [small, compressed, spilled, None]
+    # The uncompressed request is decoded on the loop, the others in threads
+    assert len(threads) == 3
+    assert threads[0] is threading.main_thread()
+    assert threading.main_thread() not in threads[1:]
@@ -0,0 +1,94 @@
+from threading import Lock
+
+from emacs_remote.utils import fuzzy
+from emacs_remote.utils.fuzzy import FuzzyFinder
+
+
+class Index:
+    def __init__(self, paths):
+        self.lock = Lock()
+        self.index_id = 1
+        self.generation = 0
+        self.paths = paths
+
+    def paths_unlocked(self):
+        return [path.encode() for path in self.paths]
+
+    def set_paths(self, paths):
+        self.paths = paths
+        self.generation += 1
+
+
+def ranked(finder, query, k=20):
+    return [path for path, _, _ in finder.find(query, k)[1]]
+
+
+def test_ranking():
+    finder = FuzzyFinder(
+        Index(
+            [
+                "docs/readme.md",
+                "src/main.py",
+                "src/utils/main_loop.py",
+                "tests/test_main.py",
+                "src/domain/ain.py",
+            ]
+        )
+    )
+
+    # Whole basenames come first and matches spread over the directories last
+    matches = ranked(finder, "main")
+    assert matches[0] == "src/main.py"
+    assert set(matches[1:3]) == {"tests/test_main.py", "src/utils/main_loop.py"}
+    assert matches[3] == "src/domain/ain.py"
+    # Matches at the start of words beat matches inside them
+    assert ranked(finder, "ml")[0] == "src/utils/main_loop.py"
+    # Case and spaces are ignored
+    assert ranked(finder, "RE adme") == ["docs/readme.md"]
+    assert ranked(finder, "zz") == []
+
+
+def test_matches():
+    finder = FuzzyFinder(Index(["src/main.py", "lib/other.py"]))
+
+    num_candidates, matches = finder.find("smp")
+    assert num_candidates == 1
+    ((path, score, positions),) = matches
+    assert path == "src/main.py"
+    assert score > 0
+    assert [path[i] for i in positions] == ["s", "m", "p"]
+
+    # No query lists the paths
+    assert finder.find("", k=1) == (2, [("src/main.py", 0, [])])
+
+
+def test_extended_queries_reuse_candidates():
+    finder = FuzzyFinder(Index(["abc", "abd", "xyz"]), max_queries=2)
+
+    assert ranked(finder, "a") == ["abc", "abd"]
+    assert ranked(finder, "ab") == ["abc", "abd"]
+    assert len(finder.find_candidates("abc")) == 1
+    # Only the most recent queries are kept
+    assert list(finder.candidates) == ["ab", "abc"]
+
+
+def test_index_changes():
+    index = Index(["one.py"])
+    finder = FuzzyFinder(index)
+    assert ranked(finder, "o") == ["one.py"]
+
+    index.set_paths(["one.py", "two.py"])
+    assert ranked(finder, "o") == ["one.py", "two.py"]
+
+
+def test_too_many_candidates(monkeypatch):
+    monkeypatch.setattr(fuzzy, "MAX_SCORED", 3)
+    paths = [f"very/long/directory/name/{i}/f.py" for i in range(10)]
+    paths += ["a/fun.py", "fx.py"]
+    finder = FuzzyFinder(Index(paths))
+
+    # Paths matching in their basename are scored first, then the shortest
+    num_candidates, matches = finder.find("f")
+    assert num_candidates == len(paths)
+    assert len(matches) == 3
+    assert {path for path, _, _ in matches} == {"fx.py", "a/fun.py", paths[0]}
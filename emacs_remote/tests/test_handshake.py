@@ -0,0 +1,102 @@
+import socket
+from threading import Thread
+
+import pytest
+
+from emacs_remote.messages import (ClientTerminateRequest,
+                                   ClientTerminateResponse, StatRequest)
+from emacs_remote.messages.compression_request import (CompressionRequest,
+                                                       CompressionResponse)
+from emacs_remote.messages.handshake_request import (PROTOCOL_VERSION,
+                                                     HandshakeRequest)
+from emacs_remote.server.async_daemon import AsyncServerDaemon
+from emacs_remote.server.daemon import ServerDaemon
+from emacs_remote.utils.compression import available_codecs, negotiate_codecs
+from emacs_remote.utils.mux import MultiplexedConnection
+from emacs_remote.utils.stcp_socket import SecureTCPSocket
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def serve_legacy(s: SecureTCPSocket):
+    """
+    Serves a single connection like the threaded server did before the handshake
+    """
+    conn, _ = s.accept()
+    with conn:
+        try:
+            while True:
+                request = conn.recvall(timeout=5)
+                if not request:
+                    break
+
+                if isinstance(request, HandshakeRequest):
+                    # Its type id was unknown, which ended the connection
+                    raise KeyError(HandshakeRequest.__name__)
+
+                if isinstance(request, CompressionRequest):
+                    codecs = negotiate_codecs(request.codecs, available_codecs())
+                    conn.sendall(CompressionResponse(codecs))
+                else:
+                    conn.sendall(request.run(None))
+        except Exception:
+            pass
+
+    # The port was never listened on again
+    s.close()
+
+
+def test_legacy_threaded_server():
+    s = SecureTCPSocket()
+    s.bind("localhost", 0)
+    port = s.getsockname()[1]
+    s.listen()
+    server = Thread(target=serve_legacy, args=(s,))
+    server.start()
+
+    with SecureTCPSocket() as client:
+        client.connect("localhost", port)
+        client.negotiate(initiator=True)
+
+        assert client.peer.version == 1
+        assert client.peer.codecs == ["zlib"]
+
+        # The connection is still usable
+        client.sendall(ClientTerminateRequest())
+        assert client.recvall(timeout=5) == ClientTerminateResponse(True)
+
+    server.join(5)
+
+
+@pytest.mark.parametrize("daemon_type", [ServerDaemon, AsyncServerDaemon])
+def test_server(tmp_path, monkeypatch, workspace, daemon_type):
+    # Workspaces change the working directory
+    monkeypatch.chdir(tmp_path)
+    port = free_port()
+
+    with daemon_type(str(tmp_path.joinpath("server")), str(workspace), [port]):
+        with MultiplexedConnection.connect("localhost", port) as connection:
+            assert connection.peer.version == PROTOCOL_VERSION
+            assert connection.request(StatRequest("README"), timeout=5).exists
+
+            # A second handshake on the same connection is refused
+            response = connection.request(HandshakeRequest({}), timeout=5)
+            assert response.error is not None
+
+
+def test_legacy_client(tmp_path, monkeypatch, workspace):
+    monkeypatch.chdir(tmp_path)
+    port = free_port()
+
+    with ServerDaemon(str(tmp_path.joinpath("server")), str(workspace), [port]):
+        with SecureTCPSocket() as client:
+            client.connect("localhost", port)
+            client.sendall(CompressionRequest(["zlib"]))
+            assert client.recvall(timeout=5) == CompressionResponse(["zlib"])
+
+            client.sendall(StatRequest("README"))
+            assert client.recvall(timeout=5).exists
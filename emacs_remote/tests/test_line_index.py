@@ -0,0 +1,81 @@
+import mmap
+import os
+
+from emacs_remote.utils import line_index
+from emacs_remote.utils.line_index import LineIndex
+
+
+def line_range(index: LineIndex, path, start, end=None):
+    stat = os.stat(path)
+    index.refresh(stat.st_ino, stat.st_size)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as m:
+        start, end = index.line_range(m, start, end)
+        return m[start:end]
+
+
+def test_lines(tmp_path):
+    path = tmp_path.joinpath("log")
+    path.write_bytes(b"a\nbb\nccc\n")
+    index = LineIndex(path)
+
+    assert line_range(index, path, 0, 1) == b"a\n"
+    assert line_range(index, path, 1) == b"bb\nccc\n"
+    assert line_range(index, path, -1) == b"ccc\n"
+    assert line_range(index, path, 5, 10) == b""
+
+
+def test_partial_last_line(tmp_path):
+    path = tmp_path.joinpath("log")
+    path.write_bytes(b"a\nb")
+    index = LineIndex(path)
+
+    assert line_range(index, path, 1) == b"b"
+    assert line_range(index, path, -1) == b"b"
+
+
+def test_growth(tmp_path, monkeypatch):
+    # Small blocks so that the file is indexed in several steps
+    monkeypatch.setattr(line_index, "_BLOCK_SIZE", 8)
+    path = tmp_path.joinpath("log")
+    lines = [f"line {i}\n".encode() for i in range(100)]
+    path.write_bytes(b"".join(lines[:50]))
+    index = LineIndex(path)
+
+    assert line_range(index, path, 10, 12) == b"".join(lines[10:12])
+    assert line_range(index, path, -1) == lines[49]
+
+    with open(path, "ab") as f:
+        f.write(b"".join(lines[50:]))
+
+    assert line_range(index, path, 48, 52) == b"".join(lines[48:52])
+    assert line_range(index, path, -2) == b"".join(lines[98:])
+
+
+def test_truncation(tmp_path):
+    path = tmp_path.joinpath("log")
+    path.write_bytes(b"first\nsecond\nthird\n")
+    index = LineIndex(path)
+    assert line_range(index, path, -1) == b"third\n"
+
+    with open(path, "r+b") as f:
+        f.truncate(0)
+        f.write(b"x\n")
+
+    assert line_range(index, path, 0) == b"x\n"
+
+
+def test_truncation_then_growth(tmp_path):
+    path = tmp_path.joinpath("log")
+    path.write_bytes(b"first\nsecond\nthird\n")
+    index = LineIndex(path)
+    assert line_range(index, path, -1) == b"third\n"
+    inode = os.stat(path).st_ino
+
+    # copytruncate, then more written than there was before
+    with open(path, "r+b") as f:
+        f.truncate(0)
+        f.write(b"1\n22\n333\n4444\n55555\n")
+    assert os.stat(path).st_ino == inode
+
+    assert line_range(index, path, 1, 3) == b"22\n333\n"
+    assert line_range(index, path, -1) == b"55555\n"
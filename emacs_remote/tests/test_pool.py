@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+from emacs_remote.messages import Execution, GetFileRangeRequest, Request
+from emacs_remote.server.pool import (ExecutorBusy, RequestExecutor,
+                                      RequestHandle)
+
+
+class Daemon:
+    logger = logging.getLogger("test")
+    workspace = SimpleNamespace(
+        remote_path=lambda file_path, absolute=False: Path(file_path)
+    )
+
+
+class Sleep(Request):
+    def __init__(self, seconds=0.05):
+        self.seconds = seconds
+
+    def run(self, daemon):
+        time.sleep(self.seconds)
+        return threading.current_thread().name
+
+
+@pytest.fixture
+def executor():
+    executor = RequestExecutor(
+        Daemon(), io_workers=1, cpu_workers=1, queue_depth=0, watch_workers=2
+    )
+    yield executor
+    executor.shutdown()
+
+
+def test_followers_have_their_own_limit(tmp_path, executor):
+    path = tmp_path.joinpath("log")
+    path.write_bytes(b"line\n")
+
+    sent = []
+    handles = []
+    for _ in range(2):
+        request = GetFileRangeRequest(str(path), follow=True, poll_interval=0.01)
+        assert request.execution == Execution.watch
+
+        handle = RequestHandle(lambda message: sent.append(message) or 1)
+        executor.submit(request, handle, block=False)
+        handles.append(handle)
+
+    # The followers don't take the slot of io bound requests
+    assert executor.submit(Sleep(), block=False).result(5).startswith("server.request")
+
+    with pytest.raises(ExecutorBusy):
+        executor.submit(GetFileRangeRequest(str(path), follow=True), block=False)
+
+    with open(path, "ab") as f:
+        f.write(b"more\n")
+    for _ in range(100):
+        if len(sent) == 4:
+            break
+        time.sleep(0.01)
+    assert sorted(message.data for message in sent) == [
+        b"line\n",
+        b"line\n",
+        b"more\n",
+        b"more\n",
+    ]
+
+    for handle in handles:
+        handle.cancel()
+    for handle in handles:
+        with pytest.raises(Exception):
+            handle.future.result(5)
+
+
+def test_batches_take_slots(executor):
+    active = 0
+    peak = 0
+    lock = threading.Lock()
+
+    class Count(Sleep):
+        def run(self, daemon):
+            nonlocal active, peak
+            with lock:
+                active += 1
+                peak = max(peak, active)
+            try:
+                return super().run(daemon)
+            finally:
+                with lock:
+                    active -= 1
+
+    results = executor.run_batch([Count() for _ in range(5)])
+
+    assert len(results) == 5
+    assert not any(isinstance(result, Exception) for result in results)
+    # The single io slot, plus the calling thread once the slot is taken
+    assert peak <= 2
+    assert executor.slots[Execution.io].acquire(blocking=False)